@@ -1,9 +1,10 @@
 from django.contrib import admin
-from .models import ProcessedFile, Station, Bike, Ride, ProcessingFile
+from .models import ProcessedFile, Station, Bike, Ride, ProcessingFile, StationDailyStats
 
 # Register your models here.
 admin.site.register(ProcessedFile)
 admin.site.register(Station)
 admin.site.register(Bike)
 admin.site.register(Ride)
-admin.site.register(ProcessingFile)
\ No newline at end of file
+admin.site.register(ProcessingFile)
+admin.site.register(StationDailyStats)
\ No newline at end of file
@@ -0,0 +1,172 @@
+import glob
+import os
+from datetime import timezone as dt_timezone
+
+from .models import Ride
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    from pyarrow import fs
+except ImportError:  # pyarrow is optional, only the Parquet archive needs it
+    pa = None
+
+# Columnar copy of the rides of every processed file, as a Parquet dataset partitioned by year=YYYY/month=M
+# of started_at (UTC). Each file's rides are written as <file stem>.part-N.parquet in the partitions it touches.
+
+ARCHIVE_BATCH_SIZE = 100000  # Rides read from the db and written as one record batch
+
+ARCHIVE_COLUMNS = [
+    'ride_id', 'started_at', 'ended_at', 'start_station_id', 'end_station_id', 'bike_id',
+    'rider_birth_year', 'rider_gender', 'rider_member_or_casual', 'duration_seconds', 'distance_m',
+]
+
+
+def require_pyarrow():
+    if pa is None:
+        raise ImportError("The Parquet ride archive needs pyarrow, pip install pyarrow.")
+
+
+def get_schema():
+    """
+    Returns:
+    - pyarrow.Schema: The typed columns of an archived ride, with the source file and the partition columns.
+    """
+    require_pyarrow()
+    timestamp = pa.timestamp('us', tz='UTC')
+    return pa.schema([
+        ('ride_id', pa.int64()),
+        ('started_at', timestamp),
+        ('ended_at', timestamp),
+        ('start_station_id', pa.int64()),
+        ('end_station_id', pa.int64()),
+        ('bike_id', pa.int64()),
+        ('rider_birth_year', pa.int32()),
+        ('rider_gender', pa.int8()),
+        ('rider_member_or_casual', pa.string()),
+        ('duration_seconds', pa.int32()),
+        ('distance_m', pa.int32()),
+        ('source_file', pa.string()),
+        ('year', pa.int16()),
+        ('month', pa.int8()),
+    ])
+
+
+def get_partitioning():
+    require_pyarrow()
+    return ds.partitioning(pa.schema([('year', pa.int16()), ('month', pa.int8())]), flavor='hive')
+
+
+def get_file_stem(file_name):
+    return os.path.splitext(file_name)[0]
+
+
+def delete_archived_file(processed_file, archive_dir):
+    """
+    Deletes the Parquet files written for a ProcessedFile, in every partition.
+
+    Returns:
+    - int: The number of Parquet files deleted.
+    """
+    pattern = os.path.join(glob.escape(archive_dir), "**", f"{glob.escape(get_file_stem(processed_file.file_name))}.part-*.parquet")
+    paths = glob.glob(pattern, recursive=True)
+    for path in paths:
+        os.remove(path)
+    return len(paths)
+
+
+def archive_processed_file(processed_file, archive_dir):
+    """
+    Writes the rides of a ProcessedFile to the Parquet archive, replacing what an earlier version of the file wrote.
+    The rides are read back from the db so the archive has their ride ids, a batch at a time.
+
+    Parameters:
+    - processed_file (ProcessedFile): The file to archive.
+    - archive_dir (str): The root directory of the Parquet dataset.
+
+    Returns:
+    - int: The number of rides archived.
+    """
+    require_pyarrow()
+    schema = get_schema()
+    rows = (Ride.objects.filter(source_file=processed_file).order_by('ride_id')
+            .values_list(*ARCHIVE_COLUMNS).iterator(chunk_size=ARCHIVE_BATCH_SIZE))
+    archived = 0
+
+    def batches():
+        nonlocal archived
+        while True:
+            chunk = [row for _, row in zip(range(ARCHIVE_BATCH_SIZE), rows)]
+            if not chunk:
+                return
+            columns = [list(column) for column in zip(*chunk)]
+            started_at = [value.astimezone(dt_timezone.utc) for value in columns[1]]
+            columns.append([processed_file.file_name] * len(chunk))
+            columns.append([value.year for value in started_at])
+            columns.append([value.month for value in started_at])
+            archived += len(chunk)
+            yield pa.record_batch([pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+                                  schema=schema)
+
+    delete_archived_file(processed_file, archive_dir)
+    ds.write_dataset(
+        pa.RecordBatchReader.from_batches(schema, batches()), archive_dir, format='parquet',
+        partitioning=get_partitioning(), basename_template=f"{get_file_stem(processed_file.file_name)}.part-{{i}}.parquet",
+        existing_data_behavior='overwrite_or_ignore')
+    return archived
+
+
+def month_filter(start, end):
+    """
+    Builds a filter on the year and month partitions covering [start, end), so whole partitions outside the window are skipped.
+    """
+    expression = None
+    if start is not None:
+        start = start.astimezone(dt_timezone.utc)
+        expression = (ds.field('year') > start.year) | (
+            (ds.field('year') == start.year) & (ds.field('month') >= start.month))
+    if end is not None:
+        end = end.astimezone(dt_timezone.utc)
+        before_end = (ds.field('year') < end.year) | ((ds.field('year') == end.year) & (ds.field('month') <= end.month))
+        expression = before_end if expression is None else expression & before_end
+    return expression
+
+
+def read_rides(archive_dir, columns=None, start=None, end=None, start_station=None, end_station=None, source_file=None):
+    """
+    Reads archived rides with memory-mapped Arrow, reading only the requested columns. The filters are
+    pushed down to the partitions (start and end) and to the Parquet row group statistics.
+
+    Parameters:
+    - archive_dir (str): The root directory of the Parquet dataset.
+    - columns (list of str): The columns to read, every column by default.
+    - start, end (datetime): Rides that started in [start, end).
+    - start_station, end_station (int): Rides that started or ended at a station.
+    - source_file (str): Rides loaded from this file.
+
+    Returns:
+    - pyarrow.Table: The matching rides.
+    """
+    require_pyarrow()
+    if not os.path.isdir(archive_dir):
+        return get_schema().empty_table().select(columns or get_schema().names)
+    # With the current schema, files archived before a column was added read it as null
+    dataset = ds.dataset(archive_dir, schema=get_schema(), format='parquet', partitioning=get_partitioning(),
+                         filesystem=fs.LocalFileSystem(use_mmap=True))
+
+    conditions = []
+    if start is not None or end is not None:
+        conditions.append(month_filter(start, end))
+    if start is not None:
+        conditions.append(ds.field('started_at') >= pa.scalar(start, type=pa.timestamp('us', tz='UTC')))
+    if end is not None:
+        conditions.append(ds.field('started_at') < pa.scalar(end, type=pa.timestamp('us', tz='UTC')))
+    for column, value in (('start_station_id', start_station), ('end_station_id', end_station),
+                          ('source_file', source_file)):
+        if value is not None:
+            conditions.append(ds.field(column) == value)
+
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+    return dataset.to_table(columns=columns, filter=expression)
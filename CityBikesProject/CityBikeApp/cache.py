@@ -0,0 +1,140 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Count, Max
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils import timezone
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+
+from .models import ProcessedFile
+
+DEFAULT_LRU_SIZE = 128  # Responses each view keeps in process when no API_CACHE_ALIAS is configured
+
+
+class LRUCache:
+    """
+    A bounded, thread safe, least recently used mapping for cached responses.
+    """
+    def __init__(self, max_size=DEFAULT_LRU_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+_view_caches = {}
+
+
+def clear_caches():
+    """
+    Empties the in process caches of every view and the configured Django cache, if any.
+    """
+    for view_cache in _view_caches.values():
+        view_cache.clear()
+    alias = getattr(settings, 'API_CACHE_ALIAS', None)
+    if alias:
+        caches[alias].clear()
+
+
+def get_dataset_version():
+    """
+    Identifies the current state of the loaded data. The import saves a ProcessedFile when it starts and
+    when it finishes a file, which moves processed_at, and deleting a file changes the count. Changes
+    made in place, like a backfill or a rollup rebuild, move processed_at through touch_dataset_version.
+
+    Returns:
+    - tuple: (str version, datetime of the last change or None when nothing has been loaded)
+    """
+    files = ProcessedFile.objects.aggregate(count=Count('file_id'), last=Max('processed_at'))
+    last_modified = files['last']
+    version = f"{files['count']}-{last_modified.timestamp() if last_modified else 0}"
+    return version, last_modified
+
+
+def touch_dataset_version(file_ids):
+    """
+    Moves the dataset version after rides or rollups were changed in place rather than loaded, so the
+    responses cached over the old values are not served again. Their files are marked as processed now.
+
+    Parameters:
+    - file_ids (iterable of int): The ProcessedFiles whose rides or rollups changed.
+    """
+    ProcessedFile.objects.filter(file_id__in=list(file_ids)).update(processed_at=timezone.now())
+
+
+def is_not_modified(request, etag, last_modified):
+    """
+    Checks the request's revalidation headers against the current ETag and Last-Modified.
+    As in RFC 9110, a request with If-None-Match is decided by its ETags alone, compared weakly so an ETag
+    weakened on the way (W/"...") still matches, and If-Modified-Since is only used without If-None-Match.
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        return etags == ['*'] or etag in (tag.removeprefix('W/') for tag in etags)
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return bool(last_modified and if_modified_since and int(last_modified.timestamp()) <= if_modified_since)
+
+
+def cached_api_view(view_func):
+    """
+    Caches the responses of a GET view per request parameters and dataset version, and adds ETag and
+    Last-Modified headers so clients can revalidate with a 304 instead of refetching.
+    Responses are kept in a bounded LRU per view, or in the Django cache named by settings.API_CACHE_ALIAS.
+    Only complete 200 responses are stored, streaming ones still get the headers.
+    """
+    view_name = f"{view_func.__module__}.{view_func.__name__}"
+    _view_caches[view_name] = LRUCache(getattr(settings, 'API_CACHE_LRU_SIZE', DEFAULT_LRU_SIZE))
+
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        version, last_modified = get_dataset_version()
+        params = sorted(request.GET.lists())
+        key = hashlib.sha256(json.dumps([view_name, version, args, kwargs, params], default=str).encode()).hexdigest()
+        etag = quote_etag(key[:32])
+
+        if is_not_modified(request, etag, last_modified):
+            response = HttpResponseNotModified()
+        else:
+            alias = getattr(settings, 'API_CACHE_ALIAS', None)
+            view_cache = caches[alias] if alias else _view_caches[view_name]
+            cache_key = f"api:{key}"
+            cached = view_cache.get(cache_key)
+            if cached is not None:
+                content, content_type = cached
+                response = HttpResponse(content, content_type=content_type)
+            else:
+                response = view_func(request, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+                if not response.streaming:
+                    view_cache.set(cache_key, (response.content, response['Content-Type']))
+
+        response['ETag'] = etag
+        if last_modified:
+            response['Last-Modified'] = http_date(last_modified.timestamp())
+        return response
+
+    return wrapper
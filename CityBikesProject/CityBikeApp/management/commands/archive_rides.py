@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from CityBikeApp.archive import archive_processed_file
+from CityBikeApp.management.processed_files import select_processed_files
+
+
+class Command(BaseCommand):
+    help = "Writes the rides of processed files to the Parquet archive, replacing what was archived for them before."
+
+    def add_arguments(self, parser):
+        parser.add_argument('archive_dir', help="Root directory of the Parquet dataset")
+        parser.add_argument('file_names', nargs='*', help="ProcessedFile names to archive")
+        parser.add_argument('--all', action='store_true', help="Archive every ProcessedFile")
+
+    def handle(self, *args, **options):
+        processed_files = select_processed_files(options)
+
+        for processed_file in processed_files:
+            try:
+                rides = archive_processed_file(processed_file, options['archive_dir'])
+            except ImportError as e:
+                raise CommandError(str(e))
+            self.stdout.write(f"Archived {rides} rides of {processed_file.file_name}")
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from CityBikeApp.management.processed_files import select_processed_files
+from CityBikeApp.ride_metrics import BACKFILL_BATCH_SIZE, backfill_ride_metrics
+
+
+class Command(BaseCommand):
+    help = "Fills in Ride.duration_seconds and Ride.distance_m for the rides of processed files loaded before the import computed them."
+
+    def add_arguments(self, parser):
+        parser.add_argument('file_names', nargs='*', help="ProcessedFile names to backfill the rides of")
+        parser.add_argument('--all', action='store_true', help="Backfill the rides of every ProcessedFile")
+        parser.add_argument('--batch-size', type=int, default=BACKFILL_BATCH_SIZE, help="Rides updated per transaction")
+        parser.add_argument('--recompute', action='store_true', help="Also recompute rides that have a duration already")
+
+    def handle(self, *args, **options):
+        processed_files = select_processed_files(options)
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be at least 1.")
+
+        for processed_file in processed_files:
+            rides = backfill_ride_metrics(processed_file.rides.all(), options['batch_size'], options['recompute'])
+            self.stdout.write(f"Backfilled {rides} rides of {processed_file.file_name}")
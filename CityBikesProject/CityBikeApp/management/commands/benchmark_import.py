@@ -0,0 +1,144 @@
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+from functools import wraps
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from CityBikeApp.models import Bike, ProcessedFile, ProcessingFile, Station, StationDailyStats
+from CityBikeApp.synthetic import SYNTHETIC_WRITERS
+
+
+class Command(BaseCommand):
+    help = ("Times CityBikeDataImport.process_file on synthetic tripdata files against a scratch SQLite database "
+            "and writes rows/sec, peak RSS and per-stage times as JSON.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000], help="Rows per generated file")
+        parser.add_argument('--formats', nargs='+', choices=sorted(SYNTHETIC_WRITERS), default=['old', 'new'],
+                            help="File layouts to generate, old (tripduration, starttime, ...) or new (ride_id, ...)")
+        parser.add_argument('--ride-writer', choices=['orm', 'raw'], default='orm')
+        parser.add_argument('--columnar', action='store_true', help="Parse with pandas instead of one dict per row")
+        parser.add_argument('--bulk-load', action='store_true', help="Load with the SQLite bulk-load settings")
+        parser.add_argument('--output', help="File to write the JSON report to, stdout by default")
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError("The benchmark runs against a scratch SQLite database.")
+        import CityBikeDataImport as citybike_import  # Sets up its log file, so only imported when benchmarking
+
+        data_dir = tempfile.mkdtemp(prefix="citybike-benchmark-")
+        # A file rather than SQLite's in-memory test database, so the timings include the disk
+        connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(data_dir, "benchmark.sqlite3")
+        old_database_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        directories = {name: os.path.join(data_dir, name) for name in ('PROCESSING_DIR', 'PROCESSED_DIR')}
+        previous_directories = {name: getattr(citybike_import, name) for name in directories}
+        try:
+            for name, path in directories.items():
+                os.makedirs(path)
+                setattr(citybike_import, name, path)
+            results = [
+                self.run_case(citybike_import, file_format, rows, options)
+                for file_format in options['formats'] for rows in options['rows']
+            ]
+        finally:
+            for name, path in previous_directories.items():
+                setattr(citybike_import, name, path)
+            connection.creation.destroy_test_db(old_database_name, verbosity=0)
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+        report = {
+            'commit': self.get_commit(),
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'sqlite': connection.Database.sqlite_version,
+            'options': {key: options[key] for key in ('ride_writer', 'columnar', 'bulk_load')},
+            'results': results,
+        }
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(output + "\n")
+            self.stdout.write(f"Wrote {len(results)} results to {options['output']}")
+        else:
+            self.stdout.write(output)
+
+    def run_case(self, citybike_import, file_format, rows, options):
+        """
+        Loads one generated file into an emptied database.
+
+        Returns:
+        - dict: The throughput, peak RSS and seconds per stage of the load.
+        """
+        for model in (ProcessedFile, ProcessingFile, StationDailyStats, Station, Bike):  # Rides cascade
+            model.objects.all().delete()
+        file_name = f"benchmark-{file_format}-{rows}.csv"
+        file_path = os.path.join(citybike_import.PROCESSING_DIR, file_name)
+        SYNTHETIC_WRITERS[file_format](file_path, rows)
+        ProcessingFile.objects.create(
+            file_name=file_name, file_path=file_path, parent_zip_last_modified=datetime.now(timezone.utc),
+            size=os.path.getsize(file_path))
+
+        importer = citybike_import.CityBikeDataImport(
+            columnar=options['columnar'], bulk_load=options['bulk_load'],
+            ride_writer=options['ride_writer'])
+        stages = {'parse': 0.0, 'load': 0.0, 'insert': 0.0, 'rollup': 0.0}
+        self.time_method(importer, 'parse_rows', stages, 'parse')
+        self.time_method(importer, 'load_rows', stages, 'load')
+        self.time_method(importer, 'insert_rides', stages, 'insert')
+        original_rollup = citybike_import.update_station_daily_stats
+        citybike_import.update_station_daily_stats = self.timed(original_rollup, stages, 'rollup')
+        try:
+            start_time = time.perf_counter()
+            with importer.bulk_load_mode():
+                importer.preload_dimensions()
+                importer.process_file(file_name)
+            seconds = time.perf_counter() - start_time
+        finally:
+            citybike_import.update_station_daily_stats = original_rollup
+
+        # load_rows covers resolving the stations and bikes, building the rows, inserting and the rollup
+        load_seconds = stages.pop('load')
+        stages['resolve'] = load_seconds - stages['insert'] - stages['rollup']
+        result = {
+            'format': file_format,
+            'rows': rows,
+            'file_bytes': os.path.getsize(os.path.join(citybike_import.PROCESSED_DIR, file_name)),
+            'seconds': round(seconds, 4),
+            'rows_per_second': round(rows / seconds) if seconds else 0,
+            'peak_rss_mb': citybike_import.peak_rss_mb(),  # Of the process so far, it never goes down between cases
+            'queries': importer.report.files[file_name]['queries'],
+            'stage_seconds': {stage: round(value, 4) for stage, value in stages.items()},
+        }
+        self.stderr.write(f"{file_format} format, {rows} rows: {result['rows_per_second']} rows/sec")
+        return result
+
+    def time_method(self, importer, name, stages, stage):
+        setattr(importer, name, self.timed(getattr(importer, name), stages, stage))
+
+    def timed(self, function, stages, stage):
+        """
+        Wraps function so the seconds spent in it are added to stages[stage].
+        """
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stages[stage] += time.perf_counter() - start_time
+        return wrapper
+
+    def get_commit(self):
+        try:
+            return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
@@ -0,0 +1,76 @@
+import statistics
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count, Max
+
+from CityBikeApp.models import Ride
+
+
+class Command(BaseCommand):
+    help = "Times the Ride analytics queries with and without the Ride indexes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5, help="Runs of each query, the median is reported")
+        parser.add_argument('--days', type=int, default=7, help="Length of the time window queried")
+
+    def handle(self, *args, **options):
+        if not connection.features.can_rollback_ddl:
+            raise CommandError("The indexes are dropped inside a transaction, which this database cannot roll back.")
+
+        last_ride = Ride.objects.aggregate(last=Max('started_at'))['last']
+        if last_ride is None:
+            raise CommandError("There are no rides to benchmark, run the import first.")
+        station_id = (Ride.objects.values('start_station').annotate(rides=Count('ride_id'))
+                      .order_by('-rides').values_list('start_station', flat=True).first())
+        window = (last_ride - timedelta(days=options['days']), last_ride)
+        queries = self.get_queries(window, station_id)
+
+        with_indexes = self.time_queries(queries, options['repeat'])
+        # DDL is transactional on SQLite and PostgreSQL, so rolling back restores the indexes
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                for index in Ride._meta.indexes:
+                    cursor.execute(f"DROP INDEX {connection.ops.quote_name(index.name)}")
+            without_indexes = self.time_queries(queries, options['repeat'])
+            transaction.set_rollback(True)
+
+        self.stdout.write(f"{Ride.objects.count()} rides, window {window[0]} - {window[1]}, station {station_id}")
+        self.stdout.write(f"{'query':<28}{'indexed ms':>12}{'unindexed ms':>14}{'speedup':>9}")
+        for name in queries:
+            indexed, unindexed = with_indexes[name], without_indexes[name]
+            speedup = unindexed / indexed if indexed else 0
+            self.stdout.write(f"{name:<28}{indexed * 1000:>12.2f}{unindexed * 1000:>14.2f}{speedup:>8.1f}x")
+
+    def get_queries(self, window, station_id):
+        """
+        Returns:
+        - dict: The query shapes the indexes are meant for, by name.
+        """
+        in_window = Ride.objects.filter(started_at__range=window)
+        return {
+            'time_window_count': in_window.values('ride_id'),
+            'arrivals_in_window': Ride.objects.filter(ended_at__range=window).values('ride_id'),
+            'station_departures': in_window.filter(start_station_id=station_id).values('started_at'),
+            'station_arrivals': Ride.objects.filter(end_station_id=station_id, ended_at__range=window).values('ended_at'),
+            'origin_destination_pairs': (in_window.values('start_station', 'end_station')
+                                         .annotate(rides=Count('ride_id'))),
+            'member_split': in_window.values('rider_member_or_casual').annotate(rides=Count('ride_id')),
+        }
+
+    def time_queries(self, queries, repeat):
+        """
+        Returns:
+        - dict: The median seconds to fetch every row of each query, by name.
+        """
+        timings = {}
+        for name, queryset in queries.items():
+            runs = []
+            for _ in range(repeat):
+                start_time = time.perf_counter()
+                list(queryset.all())  # .all() gives a fresh queryset without a result cache
+                runs.append(time.perf_counter() - start_time)
+            timings[name] = statistics.median(runs)
+        return timings
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from CityBikeApp.station_index import update_station_index
+
+
+class Command(BaseCommand):
+    help = ("Compiles the rides into the memory-mapped station index, building the segments of new and reloaded "
+            "files and removing those of deleted files.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('index_dir', help="Directory of the station index")
+        parser.add_argument('--rebuild', action='store_true', help="Rebuild every segment, not only the stale ones")
+
+    def handle(self, *args, **options):
+        try:
+            stats = update_station_index(options['index_dir'], rebuild=options['rebuild'])
+        except ImportError as e:
+            raise CommandError(str(e))
+        self.stdout.write(f"Built {stats['built']}, removed {stats['removed']} and kept {stats['kept']} segments")
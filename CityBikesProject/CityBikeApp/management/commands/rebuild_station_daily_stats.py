@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from CityBikeApp.management.processed_files import select_processed_files
+from CityBikeApp.rollups import rebuild_station_daily_stats
+
+
+class Command(BaseCommand):
+    help = "Recomputes the StationDailyStats rollup from Ride for the days covered by processed files."
+
+    def add_arguments(self, parser):
+        parser.add_argument('file_names', nargs='*', help="ProcessedFile names to rebuild the rollup for")
+        parser.add_argument('--all', action='store_true', help="Rebuild the rollup for every ProcessedFile")
+
+    def handle(self, *args, **options):
+        processed_files = select_processed_files(options)
+
+        for processed_file in processed_files:
+            rows = rebuild_station_daily_stats(processed_file)
+            self.stdout.write(f"Rebuilt {rows} StationDailyStats rows for {processed_file.file_name}")
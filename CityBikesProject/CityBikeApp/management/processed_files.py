@@ -0,0 +1,27 @@
+from django.core.management.base import CommandError
+
+from CityBikeApp.models import ProcessedFile
+
+
+def select_processed_files(options):
+    """
+    Selects the ProcessedFiles a command works on from its file_names and --all options.
+
+    Parameters:
+    - options (dict): The options of the command.
+
+    Returns:
+    - QuerySet: The ProcessedFiles, all of them with --all.
+
+    Raises:
+    - CommandError: If a name is not a ProcessedFile or the command was given neither names nor --all.
+    """
+    if options['all']:
+        return ProcessedFile.objects.all()
+    if not options['file_names']:
+        raise CommandError("Name at least one ProcessedFile or pass --all.")
+    processed_files = ProcessedFile.objects.filter(file_name__in=options['file_names'])
+    missing = set(options['file_names']) - {processed_file.file_name for processed_file in processed_files}
+    if missing:
+        raise CommandError(f"No ProcessedFile named {', '.join(sorted(missing))}")
+    return processed_files
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('CityBikeApp', '0010_rename_bike_id_ride_bike'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ride',
+            index=models.Index(fields=['started_at'], name='ride_started_at_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ride',
+            index=models.Index(fields=['ended_at'], name='ride_ended_at_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ride',
+            index=models.Index(fields=['start_station', 'started_at'], name='ride_start_station_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ride',
+            index=models.Index(fields=['end_station', 'ended_at'], name='ride_end_station_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ride',
+            index=models.Index(fields=['start_station', 'end_station', 'started_at'], name='ride_od_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ride',
+            index=models.Index(fields=['rider_member_or_casual', 'started_at'], name='ride_member_time_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:42
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('CityBikeApp', '0011_ride_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StationDailyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('departures', models.IntegerField(default=0)),
+                ('arrivals', models.IntegerField(default=0)),
+                ('member_departures', models.IntegerField(default=0)),
+                ('casual_departures', models.IntegerField(default=0)),
+                ('station', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_stats', to='CityBikeApp.station')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['date'], name='station_daily_stats_date_idx')],
+                'constraints': [models.UniqueConstraint(fields=('station', 'date'), name='station_daily_stats_station_date_unique')],
+            },
+        ),
+    ]
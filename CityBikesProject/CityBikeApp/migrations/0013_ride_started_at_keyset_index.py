@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('CityBikeApp', '0012_stationdailystats'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='ride',
+            name='ride_started_at_idx',
+        ),
+        migrations.AddIndex(
+            model_name='ride',
+            index=models.Index(fields=['started_at', 'ride_id'], name='ride_started_at_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('CityBikeApp', '0013_ride_started_at_keyset_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='processedfile',
+            name='processed_at',
+            field=models.DateTimeField(auto_now=True, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('CityBikeApp', '0014_processedfile_processed_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='processedfile',
+            name='parent_zip_name',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='processingfile',
+            name='parent_zip_name',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+    ]
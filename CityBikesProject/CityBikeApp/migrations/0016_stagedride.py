@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('CityBikeApp', '0015_parent_zip_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StagedRide',
+            fields=[
+                ('staged_ride_id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('ride_id', models.IntegerField(blank=True, null=True)),
+                ('started_at', models.DateTimeField()),
+                ('ended_at', models.DateTimeField()),
+                ('rider_birth_year', models.IntegerField(blank=True, null=True)),
+                ('rider_gender', models.IntegerField(blank=True, default=0, null=True)),
+                ('rider_member_or_casual', models.CharField(blank=True, max_length=255, null=True)),
+                ('bike', models.ForeignKey(blank=True, db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='CityBikeApp.bike')),
+                ('end_station', models.ForeignKey(db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='CityBikeApp.station')),
+                ('source_file', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='staged_rides', to='CityBikeApp.processedfile')),
+                ('start_station', models.ForeignKey(db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='CityBikeApp.station')),
+            ],
+        ),
+    ]
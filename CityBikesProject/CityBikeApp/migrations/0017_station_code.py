@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:01
+
+from django.db import migrations, models
+from django.db.models.functions import Cast
+
+
+def backfill_station_codes(apps, schema_editor):
+    # The import used to store the integer station id of the files as the station_id
+    Station = apps.get_model('CityBikeApp', 'Station')
+    Station.objects.filter(station_code='').update(station_code=Cast('station_id', models.CharField(max_length=32)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('CityBikeApp', '0016_stagedride'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='station',
+            name='station_code',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=32),
+        ),
+        migrations.RunPython(backfill_station_codes, migrations.RunPython.noop),
+    ]
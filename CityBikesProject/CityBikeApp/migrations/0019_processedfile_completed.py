@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:16
+
+from django.db import migrations, models
+
+
+def mark_finished_loads(apps, schema_editor):
+    # Until now a load only set number_of_rows when it finished
+    ProcessedFile = apps.get_model('CityBikeApp', 'ProcessedFile')
+    ProcessedFile.objects.filter(number_of_rows__gt=0).update(completed=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('CityBikeApp', '0018_ride_duration_distance'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='processedfile',
+            name='completed',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(mark_finished_loads, migrations.RunPython.noop),
+    ]
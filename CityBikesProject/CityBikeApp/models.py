@@ -8,9 +8,13 @@ class ProcessedFile(models.Model):
     file_id = models.AutoField(primary_key=True)
     file_name = models.CharField(max_length=255, unique=True)
     file_path = models.CharField(max_length=255)
+    parent_zip_name = models.CharField(max_length=255, blank=True, default='')  # The zip file the csv file came from
     parent_zip_last_modified = models.DateTimeField()
     size = models.BigIntegerField()
     number_of_rows = models.IntegerField(default=0)
+    processed_at = models.DateTimeField(auto_now=True, null=True)  # Moves whenever the import saves the record
+    # Set once every ride of the file is loaded, an interrupted load is picked up again by the next run
+    completed = models.BooleanField(default=False)
 
     def __str__(self):
         return f"{self.file_name} ({self.size} MB) Last Modified: {self.parent_zip_last_modified}"
@@ -23,6 +27,7 @@ class ProcessingFile(models.Model):
     file_id = models.AutoField(primary_key=True)
     file_name = models.CharField(max_length=255, unique=True)
     file_path = models.CharField(max_length=255)
+    parent_zip_name = models.CharField(max_length=255, blank=True, default='')  # The zip file the csv file came from
     parent_zip_last_modified = models.DateTimeField()
     size = models.BigIntegerField()
     number_of_rows = models.IntegerField(default=0)
@@ -36,6 +41,8 @@ class Station(models.Model):
     Each station has a unique identifier, a name, and a geographical location represented by latitude and longitude.
     """
     station_id = models.AutoField(primary_key=True)
+    # The station id of the tripdata files, e.g. "72" or "5905.14", see CityBikeApp.stations
+    station_code = models.CharField(max_length=32, blank=True, default='', db_index=True)
     station_name = models.CharField(max_length=255)
     lat = models.FloatField()
     lon = models.FloatField()
@@ -79,6 +86,72 @@ class Ride(models.Model):
     rider_gender = models.IntegerField(choices=GENDER_CHOICES, default=0, null=True, blank=True)
     rider_member_or_casual = models.CharField(max_length=255, null=True, blank=True)
     source_file = models.ForeignKey(ProcessedFile, on_delete=models.CASCADE,related_name='rides')
+    # Computed by the import (see CityBikeApp.ride_metrics), distance_m is the straight line between the stations
+    duration_seconds = models.IntegerField(null=True, blank=True)
+    distance_m = models.IntegerField(null=True, blank=True)
+
+    class Meta:
+        # Matched to the analytics queries: time windows, per-station time series and origin-destination pairs.
+        # Every index slows the import down a little, see the benchmark_ride_indexes command.
+        indexes = [
+            # ride_id breaks ties between rides starting at the same time, for keyset pagination
+            models.Index(fields=['started_at', 'ride_id'], name='ride_started_at_idx'),
+            models.Index(fields=['ended_at'], name='ride_ended_at_idx'),
+            models.Index(fields=['start_station', 'started_at'], name='ride_start_station_time_idx'),
+            models.Index(fields=['end_station', 'ended_at'], name='ride_end_station_time_idx'),
+            models.Index(fields=['start_station', 'end_station', 'started_at'], name='ride_od_time_idx'),
+            models.Index(fields=['rider_member_or_casual', 'started_at'], name='ride_member_time_idx'),
+            models.Index(fields=['duration_seconds'], name='ride_duration_idx'),
+            models.Index(fields=['distance_m'], name='ride_distance_idx'),
+        ]
 
     def __str__(self):
         return f"Ride {self.ride_id} from Station {self.start_station_id} to Station {self.end_station_id}"
+
+
+class StagedRide(models.Model):
+    """
+    The StagedRide model holds the rides of a changed file while the import reloads it.
+    Once the whole file is loaded they replace the file's rides in one transaction, see CityBikeDataImport.swap_staged_rides.
+    It has the columns of Ride, without the indexes and foreign key constraints that would slow the load down.
+    """
+    staged_ride_id = models.BigAutoField(primary_key=True)
+    ride_id = models.IntegerField(null=True, blank=True)  # Set when the file has numeric ride ids, otherwise Ride assigns one
+    started_at = models.DateTimeField()
+    ended_at = models.DateTimeField()
+    start_station = models.ForeignKey(Station, on_delete=models.DO_NOTHING, null=True, db_index=False, db_constraint=False, related_name='+')
+    end_station = models.ForeignKey(Station, on_delete=models.DO_NOTHING, null=True, db_index=False, db_constraint=False, related_name='+')
+    bike = models.ForeignKey(Bike, on_delete=models.DO_NOTHING, null=True, blank=True, db_index=False, db_constraint=False, related_name='+')
+    rider_birth_year = models.IntegerField(null=True, blank=True)
+    rider_gender = models.IntegerField(default=0, null=True, blank=True)
+    rider_member_or_casual = models.CharField(max_length=255, null=True, blank=True)
+    source_file = models.ForeignKey(ProcessedFile, on_delete=models.CASCADE, related_name='staged_rides')
+    duration_seconds = models.IntegerField(null=True, blank=True)
+    distance_m = models.IntegerField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Staged ride {self.staged_ride_id} of {self.source_file_id}"
+
+
+class StationDailyStats(models.Model):
+    """
+    The StationDailyStats model is a daily rollup of the rides at a station, kept up to date by the import.
+    Each row counts the departures and arrivals at one station on one day, and splits the departures into member and casual riders.
+    """
+    station = models.ForeignKey(Station, on_delete=models.CASCADE, related_name='daily_stats')
+    date = models.DateField()
+    departures = models.IntegerField(default=0)
+    arrivals = models.IntegerField(default=0)
+    member_departures = models.IntegerField(default=0)
+    casual_departures = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['station', 'date'], name='station_daily_stats_station_date_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['date'], name='station_daily_stats_date_idx'),
+        ]
+
+    def __str__(self):
+        return f"Station {self.station_id} on {self.date}: {self.departures} departures, {self.arrivals} arrivals"
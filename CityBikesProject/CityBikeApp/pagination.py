@@ -0,0 +1,70 @@
+import base64
+import json
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class RideKeysetPagination(BasePagination):
+    """
+    Pages through rides ordered by (started_at, ride_id) with opaque cursors.
+    A cursor holds the key of the last ride of the previous page, so every page is an index range seek
+    on ride_started_at_idx and page 10,000 costs the same as page 1. Only forward links are given.
+    """
+    page_size = 100
+    max_page_size = 1000
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    ordering = ('started_at', 'ride_id')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        queryset = queryset.order_by(*self.ordering)
+
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            started_at, ride_id = self.decode_cursor(cursor)
+            # The started_at__gte term lets the db seek the index, the OR only breaks ties
+            queryset = queryset.filter(
+                Q(started_at__gte=started_at) & (Q(started_at__gt=started_at) | Q(ride_id__gt=ride_id)))
+
+        rides = list(queryset[:self.page_size + 1])
+        self.has_next = len(rides) > self.page_size
+        self.rides = rides[:self.page_size]
+        return self.rides
+
+    def get_paginated_response(self, data):
+        return Response({'next': self.get_next_link(), 'results': data})
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        last_ride = self.rides[-1]
+        cursor = self.encode_cursor(last_ride.started_at, last_ride.ride_id)
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, cursor)
+
+    def encode_cursor(self, started_at, ride_id):
+        key = json.dumps([started_at.isoformat(), ride_id]).encode()
+        return base64.urlsafe_b64encode(key).decode()
+
+    def decode_cursor(self, cursor):
+        try:
+            started_at, ride_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            started_at = parse_datetime(started_at)
+            if started_at is None or not isinstance(ride_id, int):
+                raise ValueError
+        except (TypeError, ValueError):
+            raise NotFound("Invalid cursor")
+        return started_at, ride_id
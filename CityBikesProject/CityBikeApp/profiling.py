@@ -0,0 +1,116 @@
+import heapq
+import itertools
+import logging
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections, transaction
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TOP_QUERIES = 5  # Slowest statements kept by a QueryProfiler
+MAX_SQL_LENGTH = 1000  # Characters of a statement kept in the profile, bulk INSERTs run very long
+
+# How each backend shows the plan of a statement, others are profiled without plans
+EXPLAIN_PREFIXES = {'sqlite': "EXPLAIN QUERY PLAN ", 'postgresql': "EXPLAIN "}
+
+
+class QueryProfiler:
+    """
+    Counts and times the SQL statements run on a db connection while it is active, through
+    Django's connection.execute_wrapper, and keeps the slowest ones with their query plans.
+
+    Usage:
+        with QueryProfiler() as profiler:
+            ...
+        profiler.count, profiler.seconds, profiler.slowest
+    """
+    def __init__(self, using=DEFAULT_DB_ALIAS, top=DEFAULT_TOP_QUERIES, explain=True):
+        self.using = using
+        self.top = top
+        self.explain = explain
+        self.count = 0
+        self.seconds = 0.0
+        self.slowest = []  # Filled in on exit, slowest first
+        self._heap = []  # (seconds, order, sql, params, many), smallest first
+        self._order = itertools.count()
+        self._wrapper = None
+
+    def __call__(self, execute, sql, params, many, context):
+        start_time = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            seconds = time.perf_counter() - start_time
+            self.count += 1
+            self.seconds += seconds
+            if self.top:
+                # executemany parameters can be a one-shot iterator, so they are not kept
+                entry = (seconds, next(self._order), sql, None if many else params, many)
+                if len(self._heap) < self.top:
+                    heapq.heappush(self._heap, entry)
+                elif seconds > self._heap[0][0]:
+                    heapq.heapreplace(self._heap, entry)
+
+    def __enter__(self):
+        self._wrapper = connections[self.using].execute_wrapper(self)
+        self._wrapper.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._wrapper.__exit__(exc_type, exc_value, traceback)
+        self.slowest = [
+            {
+                'sql': sql if len(sql) <= MAX_SQL_LENGTH else sql[:MAX_SQL_LENGTH] + "...",
+                'seconds': round(seconds, 6),
+                'many': many,
+                'plan': self.get_plan(sql, params) if self.explain and not many else None,
+            }
+            for seconds, _, sql, params, many in sorted(self._heap, reverse=True)
+        ]
+
+    def get_plan(self, sql, params):
+        """
+        Returns:
+        - list of str or None: The rows of the statement's query plan, None where the backend cannot explain it.
+        """
+        connection = connections[self.using]
+        prefix = EXPLAIN_PREFIXES.get(connection.vendor)
+        if prefix is None:
+            return None
+        try:
+            # The savepoint keeps a statement that cannot be explained from breaking the caller's transaction
+            with transaction.atomic(using=self.using), connection.cursor() as cursor:
+                cursor.execute(prefix + sql, params)
+                return [" ".join(str(value) for value in row) for row in cursor.fetchall()]
+        except DatabaseError:
+            return None
+
+    def as_dict(self):
+        return {'queries': self.count, 'seconds': round(self.seconds, 6), 'slowest': self.slowest}
+
+
+class QueryProfilerMiddleware:
+    """
+    Profiles the queries of every API request when settings.API_PROFILE_QUERIES is on. It adds X-Query-Count
+    and X-Query-Seconds headers and logs the slowest statements with their plans.
+    Queries run while a streaming response is consumed happen after the middleware and are not counted.
+    """
+    def __init__(self, get_response):
+        if not getattr(settings, 'API_PROFILE_QUERIES', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not request.path.startswith('/api/'):
+            return self.get_response(request)
+
+        with QueryProfiler() as profiler:
+            response = self.get_response(request)
+        response['X-Query-Count'] = str(profiler.count)
+        response['X-Query-Seconds'] = f"{profiler.seconds:.6f}"
+        logger.info(f"{request.method} {request.get_full_path()}: {profiler.count} queries in {profiler.seconds:.4f}s")
+        for query in profiler.slowest:
+            logger.debug(f"{query['seconds']:.6f}s {query['sql']} plan: {query['plan']}")
+        return response
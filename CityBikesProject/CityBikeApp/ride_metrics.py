@@ -0,0 +1,107 @@
+from django.db import connection, transaction
+
+from .cache import touch_dataset_version
+from .models import Ride, Station
+from .spatial import EARTH_RADIUS_M, haversine_m
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, without it the distances are computed one ride at a time
+    np = None
+
+# Ride.duration_seconds and Ride.distance_m, stored so duration and distance filters and histograms run
+# in SQL on indexed integers. The distance is the straight line between the start and end stations,
+# so a ride back to the station it started from has a distance of 0.
+
+BACKFILL_BATCH_SIZE = 10000  # Rides read and updated per transaction by backfill_ride_metrics
+
+
+def get_station_coordinates(stations):
+    """
+    Parameters:
+    - stations (iterable of tuple): (station_id, lat, lon) of the stations.
+
+    Returns:
+    - dict: (lat, lon) keyed by station id, without the stations whose coordinates are unknown (0, 0).
+    """
+    return {station_id: (lat, lon) for station_id, lat, lon in stations if lat or lon}
+
+
+def haversine_m_array(lat1, lon1, lat2, lon2):
+    """
+    Vectorized haversine_m over numpy arrays of coordinates.
+
+    Returns:
+    - numpy.ndarray: The great-circle distances in meters.
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(array) for array in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.minimum(1.0, np.sqrt(a)))
+
+
+def add_ride_metrics(rides, coordinates):
+    """
+    Sets duration_seconds and distance_m on a chunk of rides, the distances as one vectorized
+    computation when numpy is installed.
+
+    Parameters:
+    - rides (list of dict): Rides keyed by Ride column, as built by the import. Changed in place.
+    - coordinates (dict): (lat, lon) keyed by station id, see get_station_coordinates.
+      Rides with a station missing from it get no distance.
+    """
+    measured = []
+    for index, ride in enumerate(rides):
+        started_at, ended_at = ride['started_at'], ride['ended_at']
+        ride['duration_seconds'] = round((ended_at - started_at).total_seconds()) if started_at and ended_at else None
+        ride['distance_m'] = None
+        start, end = coordinates.get(ride['start_station_id']), coordinates.get(ride['end_station_id'])
+        if start is not None and end is not None:
+            measured.append((index, start[0], start[1], end[0], end[1]))
+    if not measured:
+        return
+
+    if np is not None:
+        indexes, lat1, lon1, lat2, lon2 = (np.array(column) for column in zip(*measured))
+        distances = np.rint(haversine_m_array(lat1, lon1, lat2, lon2)).astype(np.int64).tolist()
+        indexes = indexes.tolist()
+    else:
+        indexes = [row[0] for row in measured]
+        distances = [round(haversine_m(*row[1:])) for row in measured]
+    for index, distance in zip(indexes, distances):
+        rides[index]['distance_m'] = distance
+
+
+def backfill_ride_metrics(rides, batch_size=BACKFILL_BATCH_SIZE, recompute=False):
+    """
+    Computes duration_seconds and distance_m of rides already in the db, a batch at a time in ride id order.
+    Each batch is its own transaction, so an interrupted backfill carries on from where it stopped, and
+    moves the dataset version of the files it touched so cached responses filtered on the metrics are not reused.
+
+    Parameters:
+    - rides (QuerySet): The rides to backfill.
+    - batch_size (int): Rides read and updated at a time.
+    - recompute (bool): Also recompute the rides that have a duration already.
+
+    Returns:
+    - int: The number of rides updated.
+    """
+    coordinates = get_station_coordinates(Station.objects.values_list('station_id', 'lat', 'lon'))
+    if not recompute:
+        rides = rides.filter(duration_seconds__isnull=True)
+    rides = rides.order_by('ride_id').values(
+        'ride_id', 'started_at', 'ended_at', 'start_station_id', 'end_station_id', 'source_file_id')
+    table = connection.ops.quote_name(Ride._meta.db_table)
+    updated = 0
+    last_ride_id = None
+    while True:
+        batch = list((rides if last_ride_id is None else rides.filter(ride_id__gt=last_ride_id))[:batch_size])
+        if not batch:
+            return updated
+        add_ride_metrics(batch, coordinates)
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.executemany(
+                f"UPDATE {table} SET duration_seconds = %s, distance_m = %s WHERE ride_id = %s",
+                [(ride['duration_seconds'], ride['distance_m'], ride['ride_id']) for ride in batch])
+            touch_dataset_version({ride['source_file_id'] for ride in batch})
+        updated += len(batch)
+        last_ride_id = batch[-1]['ride_id']
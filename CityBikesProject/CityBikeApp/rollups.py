@@ -0,0 +1,165 @@
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+
+from django.db import transaction
+from django.db.models import Count, F, Max, Min, Q
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .cache import touch_dataset_version
+from .models import Ride, StationDailyStats
+
+# rider_member_or_casual values of the new format and their old format equivalents
+MEMBER_TYPES = ('member', 'Subscriber')
+CASUAL_TYPES = ('casual', 'Customer')
+
+STAT_FIELDS = ['departures', 'arrivals', 'member_departures', 'casual_departures']
+
+
+def count_station_days(rides):
+    """
+    Counts rides per station and day the way StationDailyStats stores them.
+
+    Parameters:
+    - rides (iterable of dict): Rides keyed by Ride column, as built by the import.
+
+    Returns:
+    - dict: [departures, arrivals, member_departures, casual_departures] keyed by (station_id, date).
+    """
+    current_timezone = timezone.get_current_timezone()  # Days are in the same time zone TruncDate uses
+    counts = defaultdict(lambda: [0, 0, 0, 0])
+    for ride in rides:
+        if ride['start_station_id'] is not None and ride['started_at'] is not None:
+            stats = counts[(ride['start_station_id'], ride['started_at'].astimezone(current_timezone).date())]
+            stats[0] += 1
+            if ride['rider_member_or_casual'] in MEMBER_TYPES:
+                stats[2] += 1
+            elif ride['rider_member_or_casual'] in CASUAL_TYPES:
+                stats[3] += 1
+        if ride['end_station_id'] is not None and ride['ended_at'] is not None:
+            counts[(ride['end_station_id'], ride['ended_at'].astimezone(current_timezone).date())][1] += 1
+    return counts
+
+
+def apply_station_day_counts(counts, sign=1):
+    """
+    Adds (or with sign=-1 subtracts) counts from count_station_days to StationDailyStats.
+    Reads the existing rows of the days involved once and writes them back in bulk.
+    """
+    if not counts:
+        return
+    dates = {date for _, date in counts}
+    existing = {
+        (stats.station_id, stats.date): stats
+        for stats in StationDailyStats.objects.filter(date__in=dates)
+    }
+
+    new_stats = []
+    changed_stats = []
+    for (station_id, date), values in counts.items():
+        stats = existing.get((station_id, date))
+        if stats is None:
+            new_stats.append(StationDailyStats(
+                station_id=station_id, date=date,
+                **{field: sign * value for field, value in zip(STAT_FIELDS, values)}))
+            continue
+        for field, value in zip(STAT_FIELDS, values):
+            setattr(stats, field, getattr(stats, field) + sign * value)
+        changed_stats.append(stats)
+
+    StationDailyStats.objects.bulk_create(new_stats)
+    StationDailyStats.objects.bulk_update(changed_stats, STAT_FIELDS)
+
+
+def update_station_daily_stats(rides):
+    """
+    Adds a chunk of rides that was just inserted to StationDailyStats.
+    """
+    apply_station_day_counts(count_station_days(rides))
+
+
+def station_day_counts(departing_rides, arriving_rides=None):
+    """
+    Counts rides per station and day in the db, the way count_station_days does for rides in memory.
+
+    Parameters:
+    - departing_rides (QuerySet): Rides whose departures are counted, Ride or StagedRide.
+    - arriving_rides (QuerySet): Rides whose arrivals are counted, departing_rides by default.
+
+    Returns:
+    - dict: [departures, arrivals, member_departures, casual_departures] keyed by (station_id, date).
+    """
+    if arriving_rides is None:
+        arriving_rides = departing_rides
+    is_member = Q(rider_member_or_casual__in=MEMBER_TYPES)
+    is_casual = Q(rider_member_or_casual__in=CASUAL_TYPES)
+    departures = (
+        departing_rides.filter(start_station__isnull=False)
+        .values(station=F('start_station'), date=TruncDate('started_at'))
+        .annotate(rides=Count('pk'), members=Count('pk', filter=is_member), casuals=Count('pk', filter=is_casual))
+        .order_by()
+    )
+    arrivals = (
+        arriving_rides.filter(end_station__isnull=False)
+        .values(station=F('end_station'), date=TruncDate('ended_at'))
+        .annotate(rides=Count('pk'))
+        .order_by()
+    )
+
+    counts = defaultdict(lambda: [0, 0, 0, 0])
+    for row in departures:
+        stats = counts[(row['station'], row['date'])]
+        stats[0], stats[2], stats[3] = row['rides'], row['members'], row['casuals']
+    for row in arrivals:
+        counts[(row['station'], row['date'])][1] = row['rides']
+    return counts
+
+
+def replace_station_day_counts(old_rides, new_rides):
+    """
+    Moves StationDailyStats from counting old_rides to counting new_rides, writing only the station days that differ.
+    Used when a file's rides are replaced, so the work is proportional to the file rather than the whole table.
+    """
+    counts = station_day_counts(new_rides)
+    for key, values in station_day_counts(old_rides).items():
+        stats = counts[key]
+        for index, value in enumerate(values):
+            stats[index] -= value
+    apply_station_day_counts({key: values for key, values in counts.items() if any(values)})
+
+
+def rebuild_station_daily_stats(processed_file):
+    """
+    Recomputes StationDailyStats from Ride for every day from the first to the last day the rides of a
+    ProcessedFile touch. Rides from other files on those days are counted too, so the rebuilt rows are complete.
+    The days are read as half-open started_at and ended_at ranges, which the time indexes of Ride can serve.
+    Moves the dataset version, so cached responses are not served from the old rows.
+
+    Returns:
+    - int: The number of StationDailyStats rows written.
+    """
+    bounds = Ride.objects.filter(source_file=processed_file).aggregate(
+        first_start=Min('started_at'), last_start=Max('started_at'),
+        first_end=Min('ended_at'), last_end=Max('ended_at'))
+    times = [value for value in bounds.values() if value is not None]
+    if times:
+        first_date = timezone.localtime(min(times)).date()
+        last_date = timezone.localtime(max(times)).date()
+        # Midnights in the time zone TruncDate uses, so the ranges hold exactly the rides of those days
+        start = timezone.make_aware(datetime.combine(first_date, time.min))
+        end = timezone.make_aware(datetime.combine(last_date + timedelta(days=1), time.min))
+        counts = station_day_counts(Ride.objects.filter(started_at__gte=start, started_at__lt=end),
+                                    Ride.objects.filter(ended_at__gte=start, ended_at__lt=end))
+        days = StationDailyStats.objects.filter(date__gte=first_date, date__lte=last_date)
+    else:
+        counts, days = {}, StationDailyStats.objects.none()
+
+    with transaction.atomic():
+        days.delete()
+        StationDailyStats.objects.bulk_create([
+            StationDailyStats(station_id=station_id, date=date,
+                              **{field: value for field, value in zip(STAT_FIELDS, values)})
+            for (station_id, date), values in counts.items()
+        ])
+        touch_dataset_version([processed_file.file_id])
+    return len(counts)
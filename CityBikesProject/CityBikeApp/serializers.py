@@ -1,7 +1,21 @@
 from rest_framework import serializers
-from .models import ProcessedFile
+from .models import ProcessedFile, Ride
 
 class ProcessedFileSerializer(serializers.ModelSerializer):
     class Meta:
         model = ProcessedFile
-        fields = ['file_name', 'file_path', 'last_modified', 'size']
\ No newline at end of file
+        fields = ['file_name', 'file_path', 'last_modified', 'size']
+
+class RideSerializer(serializers.ModelSerializer):
+    """
+    A lean Ride representation for listing, the related names come from select_related.
+    """
+    start_station_name = serializers.CharField(source='start_station.station_name', default=None)
+    end_station_name = serializers.CharField(source='end_station.station_name', default=None)
+    bike_type = serializers.CharField(source='bike.bike_type', default=None)
+
+    class Meta:
+        model = Ride
+        fields = ['ride_id', 'started_at', 'ended_at', 'start_station', 'start_station_name', 'end_station',
+                  'end_station_name', 'bike', 'bike_type', 'rider_member_or_casual', 'duration_seconds', 'distance_m']
+        read_only_fields = fields
@@ -0,0 +1,132 @@
+import math
+import threading
+from collections import defaultdict
+
+from django.db.models import Count, Max
+
+from .models import Station
+
+GRID_CELL_DEGREES = 0.01  # Side of a grid cell, about 1.1 km of latitude
+MAX_BBOX_CELLS = 10000  # Past this many cells a bounding box is answered by scanning every station
+EARTH_RADIUS_M = 6371008.8
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS_M / 180
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """
+    Returns:
+    - float: The great-circle distance between two points in meters.
+    """
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+class StationGrid:
+    """
+    A uniform lat/lon grid over the stations, so nearest-station and bounding-box queries only look at
+    the stations in the cells around the query instead of every station.
+    """
+    def __init__(self, stations, cell_degrees=GRID_CELL_DEGREES):
+        """
+        Parameters:
+        - stations (iterable of tuple): (station_id, station_name, lat, lon) of every station.
+        - cell_degrees (float): Side of a grid cell in degrees.
+        """
+        self.cell_degrees = cell_degrees
+        self.stations = list(stations)
+        self.cells = defaultdict(list)
+        for station in self.stations:
+            self.cells[self.get_cell(station[2], station[3])].append(station)
+        if self.cells:
+            rows = [row for row, _ in self.cells]
+            columns = [column for _, column in self.cells]
+            self.bounds = (min(rows), min(columns), max(rows), max(columns))
+
+    def get_cell(self, lat, lon):
+        return math.floor(lat / self.cell_degrees), math.floor(lon / self.cell_degrees)
+
+    def bbox(self, min_lat, min_lon, max_lat, max_lon):
+        """
+        Returns:
+        - list of tuple: The stations inside the box, edges included, ordered by station id.
+        """
+        min_row, min_column = self.get_cell(min_lat, min_lon)
+        max_row, max_column = self.get_cell(max_lat, max_lon)
+        if (max_row - min_row + 1) * (max_column - min_column + 1) > MAX_BBOX_CELLS:
+            candidates = self.stations
+        else:
+            candidates = [station for row in range(min_row, max_row + 1) for column in range(min_column, max_column + 1)
+                          for station in self.cells.get((row, column), ())]
+        return sorted(
+            (station for station in candidates if min_lat <= station[2] <= max_lat and min_lon <= station[3] <= max_lon),
+            key=lambda station: station[0])
+
+    def scan(self, lat, lon, k):
+        """
+        Returns:
+        - list of tuple: Up to k (distance in meters, station), nearest first, from every station.
+        """
+        found = [(haversine_m(lat, lon, station[2], station[3]), station) for station in self.stations]
+        found.sort(key=lambda item: (item[0], item[1][0]))
+        return found[:k]
+
+    def nearest(self, lat, lon, k):
+        """
+        Searches rings of cells outwards from the query point until the k nearest stations found
+        are closer than anything the next ring could hold. The search starts at the first ring that
+        reaches an occupied cell, and once it would look at more cells than are occupied it scans
+        every station instead, so a point far from the stations costs no more than a scan.
+
+        Returns:
+        - list of tuple: Up to k (distance in meters, station), nearest first.
+        """
+        if not self.cells or k <= 0:
+            return []
+        center_row, center_column = self.get_cell(lat, lon)
+        max_ring = max(abs(center_row - self.bounds[0]), abs(center_row - self.bounds[2]),
+                       abs(center_column - self.bounds[1]), abs(center_column - self.bounds[3]))
+        first_ring = max(0, self.bounds[0] - center_row, center_row - self.bounds[2],
+                         self.bounds[1] - center_column, center_column - self.bounds[3])
+
+        found = []
+        visited = 0
+        for ring in range(first_ring, max_ring + 1):
+            visited += 8 * ring or 1
+            if visited > len(self.cells):
+                return self.scan(lat, lon, k)
+            for row in range(center_row - ring, center_row + ring + 1):
+                step = 1 if abs(row - center_row) == ring else 2 * ring  # Only the ring's edge, not its inside
+                for column in range(center_column - ring, center_column + ring + 1, max(step, 1)):
+                    for station in self.cells.get((row, column), ()):
+                        found.append((haversine_m(lat, lon, station[2], station[3]), station))
+            if len(found) >= k:
+                found.sort(key=lambda item: (item[0], item[1][0]))
+                # Stations past this ring are at least ring cells away, a cell of longitude is narrowest
+                # at the highest latitude the ring reaches
+                highest_lat = min(89.0, abs(lat) + ring * self.cell_degrees)
+                if found[k - 1][0] <= ring * self.cell_degrees * METERS_PER_DEGREE * math.cos(math.radians(highest_lat)):
+                    break
+        found.sort(key=lambda item: (item[0], item[1][0]))
+        return found[:k]
+
+
+_grid_lock = threading.Lock()
+_grid = None
+_grid_version = None
+
+
+def get_station_grid():
+    """
+    Returns the StationGrid of the current stations, rebuilt when the import has added stations since it was built.
+    """
+    global _grid, _grid_version
+    stations = Station.objects.aggregate(count=Count('station_id'), last=Max('station_id'))
+    version = (stations['count'], stations['last'])
+    with _grid_lock:
+        if _grid is None or _grid_version != version:
+            # Stations stored at (0, 0) have no known coordinates, as in ride_metrics.get_station_coordinates
+            _grid = StationGrid(
+                Station.objects.exclude(lat=0, lon=0).values_list('station_id', 'station_name', 'lat', 'lon'))
+            _grid_version = version
+        return _grid
@@ -0,0 +1,212 @@
+import json
+import os
+import re
+import shutil
+from datetime import timezone as dt_timezone
+
+from .models import ProcessedFile, Ride
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, only the station index needs it
+    np = None
+
+# A compiled index of ride departures by station and time, one segment directory per ProcessedFile:
+#   station_ids.npy  sorted start station ids (int64)
+#   offsets.npy      rides of station_ids[i] are at [offsets[i], offsets[i + 1]) of the arrays below (int64)
+#   started_at.npy   start times in UTC, sorted within each station (datetime64[us])
+#   ride_ids.npy     the ride ids, in the same order (int64)
+#   meta.json        the file, its processed_at and the time range, to skip or rebuild the segment
+# A new or reloaded file only costs building its own segment.
+
+SEGMENT_ARRAYS = ('station_ids', 'offsets', 'started_at', 'ride_ids')
+# Names of the segment directories and of the directories build_segment writes them in. Nothing else in
+# the index directory is touched, so it may share a directory with other data
+SEGMENT_NAME = re.compile(r'file-\d+')
+BUILDING_NAME = re.compile(r'file-\d+\.building')
+INDEX_BATCH_SIZE = 100000  # Rides read from the db at a time while building a segment
+
+
+def require_numpy():
+    if np is None:
+        raise ImportError("The station index needs numpy, pip install numpy.")
+
+
+def to_datetime64(value):
+    return np.datetime64(value.astimezone(dt_timezone.utc).replace(tzinfo=None), 'us')
+
+
+def get_segment_dir(index_dir, processed_file):
+    return os.path.join(index_dir, f"file-{processed_file.file_id}")
+
+
+def build_segment(processed_file, index_dir):
+    """
+    Compiles the departures of one ProcessedFile into its segment, replacing the segment if it exists.
+
+    Returns:
+    - int: The number of rides indexed.
+    """
+    require_numpy()
+    rows = (Ride.objects.filter(source_file=processed_file, start_station__isnull=False)
+            .values_list('start_station_id', 'started_at', 'ride_id').iterator(chunk_size=INDEX_BATCH_SIZE))
+    station_ids, started_at, ride_ids = [], [], []
+    for station_id, ride_started_at, ride_id in rows:
+        station_ids.append(station_id)
+        started_at.append(ride_started_at.astimezone(dt_timezone.utc).replace(tzinfo=None))
+        ride_ids.append(ride_id)
+    station_ids = np.array(station_ids, dtype=np.int64)
+    started_at = np.array(started_at, dtype='datetime64[us]')
+    ride_ids = np.array(ride_ids, dtype=np.int64)
+
+    order = np.lexsort((started_at, station_ids))
+    station_ids, started_at, ride_ids = station_ids[order], started_at[order], ride_ids[order]
+    unique_station_ids, first_rides = np.unique(station_ids, return_index=True)
+    arrays = {
+        'station_ids': unique_station_ids,
+        'offsets': np.append(first_rides, len(station_ids)).astype(np.int64),
+        'started_at': started_at,
+        'ride_ids': ride_ids,
+    }
+    meta = {
+        'file_id': processed_file.file_id,
+        'file_name': processed_file.file_name,
+        'processed_at': processed_file.processed_at.isoformat() if processed_file.processed_at else None,
+        'rides': len(ride_ids),
+        'first_started_at': str(started_at.min()) if len(started_at) else None,
+        'last_started_at': str(started_at.max()) if len(started_at) else None,
+    }
+
+    # Written next to the segment and swapped in, so readers never see half a segment
+    segment_dir = get_segment_dir(index_dir, processed_file)
+    building_dir = segment_dir + ".building"
+    shutil.rmtree(building_dir, ignore_errors=True)
+    os.makedirs(building_dir)
+    for name, array in arrays.items():
+        np.save(os.path.join(building_dir, f"{name}.npy"), array)
+    with open(os.path.join(building_dir, "meta.json"), 'w') as file:
+        json.dump(meta, file)
+    shutil.rmtree(segment_dir, ignore_errors=True)
+    os.replace(building_dir, segment_dir)
+    return len(ride_ids)
+
+
+def read_meta(segment_dir):
+    try:
+        with open(os.path.join(segment_dir, "meta.json")) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def update_station_index(index_dir, rebuild=False):
+    """
+    Brings the index in line with ProcessedFile: builds the segments of new and reloaded files and
+    removes those of deleted files, along with segments left half built. Segments that are up to date
+    are left alone unless rebuild is set, and so is anything in index_dir that is not a segment.
+
+    Returns:
+    - dict: The number of segments built, removed and kept.
+    """
+    require_numpy()
+    os.makedirs(index_dir, exist_ok=True)
+    stats = {'built': 0, 'removed': 0, 'kept': 0}
+    wanted = set()
+    for processed_file in ProcessedFile.objects.all():
+        segment_dir = get_segment_dir(index_dir, processed_file)
+        wanted.add(os.path.basename(segment_dir))
+        meta = read_meta(segment_dir)
+        processed_at = processed_file.processed_at.isoformat() if processed_file.processed_at else None
+        if not rebuild and meta is not None and meta['processed_at'] == processed_at:
+            stats['kept'] += 1
+            continue
+        build_segment(processed_file, index_dir)
+        stats['built'] += 1
+
+    for name in os.listdir(index_dir):
+        if SEGMENT_NAME.fullmatch(name) and name not in wanted:
+            shutil.rmtree(os.path.join(index_dir, name), ignore_errors=True)
+            stats['removed'] += 1
+        elif BUILDING_NAME.fullmatch(name):
+            shutil.rmtree(os.path.join(index_dir, name), ignore_errors=True)
+    return stats
+
+
+class StationIndex:
+    """
+    Answers departure counts and histograms per station from the memory-mapped segments,
+    with a binary search for the station and for the time window in each segment.
+    """
+    def __init__(self, index_dir):
+        require_numpy()
+        self.segments = []
+        if not os.path.isdir(index_dir):
+            return
+        for name in sorted(os.listdir(index_dir)):
+            if not SEGMENT_NAME.fullmatch(name):
+                continue
+            segment_dir = os.path.join(index_dir, name)
+            meta = read_meta(segment_dir)
+            if meta is None or not meta['rides']:
+                continue
+            segment = {array: np.load(os.path.join(segment_dir, f"{array}.npy"), mmap_mode='r')
+                       for array in SEGMENT_ARRAYS}
+            segment['first'] = np.datetime64(meta['first_started_at'], 'us')
+            segment['last'] = np.datetime64(meta['last_started_at'], 'us')
+            self.segments.append(segment)
+
+    def get_start_times(self, station_id, start, end):
+        """
+        Returns:
+        - list of numpy.ndarray: The sorted departure times of the station in [start, end), one array per segment.
+        """
+        start, end = to_datetime64(start), to_datetime64(end)
+        times = []
+        for segment in self.segments:
+            if segment['last'] < start or segment['first'] >= end:
+                continue
+            station_ids = segment['station_ids']
+            position = np.searchsorted(station_ids, station_id)
+            if position == len(station_ids) or station_ids[position] != station_id:
+                continue
+            station_times = segment['started_at'][segment['offsets'][position]:segment['offsets'][position + 1]]
+            first, last = np.searchsorted(station_times, [start, end])
+            times.append(station_times[first:last])
+        return times
+
+    def count(self, station_id, start, end):
+        """
+        Returns:
+        - int: The number of rides that left the station in [start, end).
+        """
+        return int(sum(len(times) for times in self.get_start_times(station_id, start, end)))
+
+    def histogram(self, station_id, start, end, bin_seconds=3600):
+        """
+        Returns:
+        - numpy.ndarray: Departures from the station per bin of bin_seconds, from start up to end.
+
+        Raises:
+        - ValueError: If end is before start or bin_seconds is not positive.
+        """
+        if end < start:
+            raise ValueError("The end of a histogram cannot be before its start.")
+        if bin_seconds <= 0:
+            raise ValueError("bin_seconds must be positive.")
+        bin_width = np.timedelta64(bin_seconds, 's')
+        bins = int(np.ceil((to_datetime64(end) - to_datetime64(start)) / bin_width))
+        counts = np.zeros(bins, dtype=np.int64)
+        for times in self.get_start_times(station_id, start, end):
+            counts += np.bincount((times - to_datetime64(start)) // bin_width, minlength=bins)
+        return counts
+
+    def hour_of_day_counts(self, station_id, start, end):
+        """
+        Returns:
+        - numpy.ndarray: Departures from the station in [start, end) by hour of the day in UTC, 24 counts.
+        """
+        counts = np.zeros(24, dtype=np.int64)
+        for times in self.get_start_times(station_id, start, end):
+            hours = times.astype('datetime64[h]').astype(np.int64) % 24
+            counts += np.bincount(hours, minlength=24)
+        return counts
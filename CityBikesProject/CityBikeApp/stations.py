@@ -0,0 +1,163 @@
+import math
+from collections import Counter
+
+from .models import Station
+
+# The station ids of the tripdata files are codes: integers in the old format ("72"), text like "5905.14"
+# or "JC013" in the new one. They are kept as text in Station.station_code so that 5905.14 and 5905.15 stay
+# two stations, and station_id is only a key. Stations with an integer code keep it as their id when it is free.
+
+ALLOCATED_STATION_ID_START = 1000000  # Stations whose code is not a free integer get ids from here up
+COORDINATE_DECIMALS = 6  # Coordinates of a new station are rounded to about 0.1 m
+MISSING_CODES = {'', 'NAN', 'NULL', 'NONE', '\\N'}
+
+
+def canonical_station_code(raw_code):
+    """
+    Returns:
+    - str: The canonical code of a raw station id, '' if the row has none.
+      Codes are stripped and upper cased, integers lose leading zeros and a float's ".0" ("72.0" is "72").
+    """
+    if raw_code is None:
+        return ''
+    code = str(raw_code).strip().upper()
+    if code in MISSING_CODES:
+        return ''
+    if code.endswith('.0') and code[:-2].isdigit():
+        code = code[:-2]
+    if code.isdigit():
+        code = str(int(code))
+    return code
+
+
+def to_coordinate(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return 0.0
+    return round(value, COORDINATE_DECIMALS) if math.isfinite(value) else 0.0
+
+
+class StationResolver:
+    """
+    Resolves the (station id, name, coordinates) of rides to Stations through a hash table of the canonical
+    codes built once per run. Each distinct (raw id, name) of a run is resolved once, every other row is
+    a single dict lookup. Rows without a code are left without a station rather than guessed from their name,
+    so a file always resolves the same way whatever was loaded before it.
+
+    Counts what it merged in stats:
+    - station_names_merged: (code, name) pairs whose name differs from the name of the code's station.
+    - station_id_collisions: new integer codes whose own number was already another station's id.
+    - station_rows_unresolved: rows without a code, left without a station.
+    """
+    def __init__(self, stations=()):
+        """
+        Parameters:
+        - stations (iterable of tuple): (station_id, station_code, station_name, lat, lon) of the stations in the db.
+          Stations without a code are keyed by their id, which is how the import stored them before codes.
+        """
+        self.by_code = {}
+        self.names = {}
+        self.coordinates = {}  # (lat, lon) of the stations whose coordinates are known, see CityBikeApp.ride_metrics
+        self.used_ids = set()
+        self.next_id = ALLOCATED_STATION_ID_START
+        self.resolved = {}  # (raw id, name) to station id or None
+        self.stats = Counter()
+        for station in stations:
+            self.add(*station)
+
+    @classmethod
+    def from_db(cls):
+        return cls(Station.objects.values_list('station_id', 'station_code', 'station_name', 'lat', 'lon'))
+
+    def add(self, station_id, station_code, station_name, lat, lon):
+        self.by_code.setdefault(station_code or str(station_id), station_id)
+        self.names[station_id] = station_name
+        if lat or lon:
+            self.coordinates[station_id] = (lat, lon)
+        self.used_ids.add(station_id)
+        self.next_id = max(self.next_id, station_id + 1)
+
+    def resolve(self, raw_code, name, lat, lon, new_stations):
+        """
+        Resolves the station of a row, creating it when its code is new.
+
+        Parameters:
+        - raw_code (str): The station id as it is in the file.
+        - name (str): The station name.
+        - lat, lon (str or float): The coordinates as they are in the file.
+        - new_stations (dict): Stations created in this chunk that are not in the db yet, keyed by id.
+          New stations are added to it.
+
+        Returns:
+        - int or None: The station id, None if the row has no code.
+        """
+        key = (raw_code, name)
+        try:
+            station_id = self.resolved[key]
+        except KeyError:
+            station_id = self.resolved[key] = self.resolve_code(raw_code, name, lat, lon, new_stations)
+        if station_id is None:
+            self.stats['station_rows_unresolved'] += 1
+        return station_id
+
+    def resolve_columns(self, columns, new_stations):
+        """
+        Resolves whole columns of stations at once, such as the start and end stations of a chunk.
+        Each distinct (raw id, name) is resolved once, in the order the rows first name it, so new stations
+        get the ids that resolving the rows one at a time would give them.
+
+        Parameters:
+        - columns (list of tuple): (raw ids, names, lats, lons) lists, one tuple per column.
+        - new_stations (dict): Stations created in this chunk that are not in the db yet, keyed by id.
+
+        Returns:
+        - list of list: The station ids of each column, None where a row has no code.
+        """
+        keys = [list(zip(raw_codes, names)) for raw_codes, names, _, _ in columns]
+        first_rows = []
+        for column, column_keys in enumerate(keys):
+            # Reversed, so each key ends up with the first row it is on
+            rows = dict(zip(reversed(column_keys), range(len(column_keys) - 1, -1, -1)))
+            first_rows.extend((row, column, key) for key, row in rows.items() if key not in self.resolved)
+        for row, column, key in sorted(first_rows, key=lambda first_row: first_row[:2]):
+            if key not in self.resolved:
+                _, _, lats, lons = columns[column]
+                self.resolved[key] = self.resolve_code(key[0], key[1], lats[row], lons[row], new_stations)
+
+        station_ids = [list(map(self.resolved.__getitem__, column_keys)) for column_keys in keys]
+        self.stats['station_rows_unresolved'] += sum(column_ids.count(None) for column_ids in station_ids)
+        return station_ids
+
+    def resolve_code(self, raw_code, name, lat, lon, new_stations):
+        code = canonical_station_code(raw_code)
+        if not code:
+            return None
+
+        station_id = self.by_code.get(code)
+        if station_id is None:
+            return self.create(code, name, lat, lon, new_stations)
+        if name and name != self.names[station_id]:
+            self.stats['station_names_merged'] += 1
+        return station_id
+
+    def create(self, code, name, lat, lon, new_stations):
+        if code.isdigit() and int(code) not in self.used_ids:
+            station_id = int(code)
+        else:
+            if code.isdigit():
+                self.stats['station_id_collisions'] += 1
+            station_id = self.next_id
+        station = Station(station_id=station_id, station_code=code, station_name=name or "unknown",
+                          lat=to_coordinate(lat), lon=to_coordinate(lon))
+        new_stations[station_id] = station
+        self.add(station_id, code, station.station_name, station.lat, station.lon)
+        return station_id
+
+    def pop_stats(self):
+        """
+        Returns:
+        - Counter: The stats counted since the last call.
+        """
+        stats, self.stats = self.stats, Counter()
+        return stats
@@ -0,0 +1,49 @@
+import csv
+from datetime import datetime, timedelta
+
+# Synthetic tripdata files in the two layouts the import reads, for the tests and the benchmark_import command
+
+OLD_FORMAT_HEADER = [
+    "tripduration", "starttime", "stoptime", "start station id", "start station name",
+    "start station latitude", "start station longitude", "end station id", "end station name",
+    "end station latitude", "end station longitude", "bikeid", "usertype", "birth year", "gender",
+]
+
+NEW_FORMAT_HEADER = [
+    "ride_id", "rideable_type", "started_at", "ended_at", "start_station_name", "start_station_id",
+    "end_station_name", "end_station_id", "start_lat", "start_lng", "end_lat", "end_lng", "member_casual",
+]
+
+
+def write_old_format_csv(file_path, number_of_rows):
+    with open(file_path, mode='w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(OLD_FORMAT_HEADER)
+        for i in range(number_of_rows):
+            started_at = datetime(2017, 4, 1) + timedelta(seconds=i * 37)
+            ended_at = started_at + timedelta(seconds=600)
+            writer.writerow([
+                600, started_at.strftime('%Y-%m-%d %H:%M:%S'), ended_at.strftime('%Y-%m-%d %H:%M:%S'),
+                i % 7 + 1, f"Station {i % 7 + 1}", 40.70 + (i % 7) / 100, -73.99,
+                i % 5 + 1, f"Station {i % 5 + 1}", 40.70 + (i % 5) / 100, -73.99,
+                1000 + i % 11, "Subscriber" if i % 3 else "Customer",
+                "\\N" if i % 4 == 0 else "" if i % 13 == 6 else 1980, "" if i % 10 == 7 else i % 3,
+            ])
+
+
+def write_new_format_csv(file_path, number_of_rows):
+    with open(file_path, mode='w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(NEW_FORMAT_HEADER)
+        for i in range(number_of_rows):
+            started_at = datetime(2024, 3, 1) + timedelta(seconds=i * 41, microseconds=i * 1000)
+            ended_at = started_at + timedelta(seconds=900)
+            writer.writerow([
+                f"{i:016X}", ("classic_bike", "electric_bike", "docked_bike")[i % 3],
+                started_at.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3], ended_at.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3],
+                f"Station {i % 6}", f"{5900 + i % 6}.{i % 3 + 10}", f"Station {i % 4}", "" if i % 9 == 0 else f"{6100 + i % 4}.0{i % 2}",
+                40.70 + (i % 6) / 100, -73.98, 40.74 + (i % 4) / 100, -73.95, "member" if i % 2 else "casual",
+            ])
+
+
+SYNTHETIC_WRITERS = {'old': write_old_format_csv, 'new': write_new_format_csv}
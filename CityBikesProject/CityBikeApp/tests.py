@@ -1,3 +1,999 @@
-from django.test import TestCase
+import csv
+import io
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.models import F
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+import CityBikeDataImport as citybike_import
+from . import archive, station_index, views
+from .cache import LRUCache, clear_caches, get_dataset_version
+from .profiling import QueryProfiler
+from .models import Bike, ProcessedFile, ProcessingFile, Ride, StagedRide, Station, StationDailyStats
+from .rollups import rebuild_station_daily_stats
+from .spatial import StationGrid, haversine_m
+from .stations import ALLOCATED_STATION_ID_START, StationResolver
+from .synthetic import OLD_FORMAT_HEADER, write_new_format_csv, write_old_format_csv
+
+RIDE_FIELDS = [
+    'started_at', 'ended_at', 'start_station_id', 'end_station_id', 'bike_id',
+    'rider_birth_year', 'rider_gender', 'rider_member_or_casual', 'duration_seconds', 'distance_m',
+]
+
+
+def create_rides(number_of_rides, file_name="202403-citibike-tripdata.csv", stations=5):
+    """
+    Creates rides directly through the ORM, hourly from 2024-03-01, cycling through the stations.
+    """
+    for station_id in range(1, stations + 1):
+        Station.objects.get_or_create(
+            station_id=station_id,
+            defaults={'station_name': f"Station {station_id}", 'lat': 40.70 + station_id / 100, 'lon': -73.99})
+    bike, _ = Bike.objects.get_or_create(bike_id=1, defaults={'bike_type': 'classic'})
+    processed_file = ProcessedFile.objects.create(
+        file_name=file_name, file_path=file_name, parent_zip_last_modified=timezone.now(), size=1,
+        number_of_rows=number_of_rides)
+    start = timezone.make_aware(datetime(2024, 3, 1))
+    Ride.objects.bulk_create([
+        Ride(started_at=start + timedelta(hours=i), ended_at=start + timedelta(hours=i, minutes=20),
+             start_station_id=i % stations + 1, end_station_id=(i + 1) % stations + 1, bike=bike,
+             rider_birth_year=0, rider_gender=0, rider_member_or_casual="member" if i % 2 else "casual",
+             source_file=processed_file)
+        for i in range(number_of_rides)
+    ])
+    return processed_file
+
+
+class ImportTestCase(TransactionTestCase):
+    """
+    Runs the import against temporary processing and processed directories.
+    Not wrapped in a transaction, the import manages its own transactions.
+    """
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.processing_dir = os.path.join(self.data_dir, "Processing")
+        self.processed_dir = os.path.join(self.data_dir, "Processed")
+        os.makedirs(self.processing_dir)
+        os.makedirs(self.processed_dir)
+        for name, value in (('PROCESSING_DIR', self.processing_dir), ('PROCESSED_DIR', self.processed_dir)):
+            patcher = mock.patch.object(citybike_import, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.data_dir, ignore_errors=True)
+
+    def add_processing_file(self, file_name, number_of_rows, write_csv=write_old_format_csv):
+        file_path = os.path.join(self.processing_dir, file_name)
+        write_csv(file_path, number_of_rows)
+        ProcessingFile.objects.create(
+            file_name=file_name, file_path=file_path, parent_zip_last_modified=timezone.now(),
+            size=os.path.getsize(file_path))
+
+    def reset_processing_file(self, file_name):
+        ProcessedFile.objects.filter(file_name=file_name).delete()
+        shutil.move(os.path.join(self.processed_dir, file_name), os.path.join(self.processing_dir, file_name))
+        ProcessingFile.objects.create(
+            file_name=file_name, file_path=os.path.join(self.processing_dir, file_name),
+            parent_zip_last_modified=timezone.now(), size=0)
+
+    def ride_values(self):
+        return list(Ride.objects.order_by('ride_id').values_list(*RIDE_FIELDS))
+
+    def station_values(self):
+        return list(Station.objects.order_by('station_id').values_list('station_id', 'station_name', 'lat', 'lon'))
+
+
+class ChunkedImportTests(ImportTestCase):
+    def test_file_larger_than_a_chunk_is_loaded_whole(self):
+        started_at = [timezone.make_aware(datetime(2017, 4, 1) + timedelta(seconds=i * 37)) for i in range(250)]
+        for columnar in (False, True):
+            with self.subTest(columnar=columnar):
+                self.add_processing_file("201704-citibike-tripdata.csv", 250)
+                importer = citybike_import.CityBikeDataImport(columnar=columnar)
+                load_rows = importer.load_rows
+                chunk_sizes = []
+
+                def counted_load_rows(parsed_rows, processed_file):
+                    chunk_sizes.append(len(parsed_rows))
+                    return load_rows(parsed_rows, processed_file)
+                importer.load_rows = counted_load_rows
+                with mock.patch.object(citybike_import, 'CHUNK_SIZE', 100):
+                    importer.process_files()
+
+                self.assertEqual(chunk_sizes, [100, 100, 50])
+                self.assertEqual(ProcessedFile.objects.get().number_of_rows, 250)
+                # Every row in file order, so the first rows of the chunks (0, 100 and 200) too
+                self.assertEqual(list(Ride.objects.order_by('ride_id').values_list('started_at', flat=True)), started_at)
+
+                ProcessedFile.objects.all().delete()
+                os.remove(os.path.join(self.processed_dir, "201704-citibike-tripdata.csv"))
+
+
+class ParallelImportTests(ImportTestCase):
+    def test_parallel_import_matches_serial_import(self):
+        self.add_processing_file("201704-citibike-tripdata.csv", 120)
+
+        citybike_import.CityBikeDataImport().process_files()
+        serial_rides = self.ride_values()
+
+        self.reset_processing_file("201704-citibike-tripdata.csv")
+        citybike_import.CityBikeDataImport(workers=2).process_files(range_size=1024)
+
+        self.assertEqual(len(serial_rides), 120)
+        self.assertEqual(self.ride_values(), serial_rides)
+        self.assertEqual(ProcessedFile.objects.get().number_of_rows, 120)
+
+
+    def test_spawned_worker_appends_to_the_log(self):
+        # A spawned worker imports the module in a fresh interpreter, as this does
+        with open(os.path.join(self.data_dir, "citybike_data_import.log"), 'w') as file:
+            file.write("started the run\n")
+        subprocess.run(
+            [sys.executable, "-c", "import CityBikeDataImport as m; m.init_parse_worker(); m.logger.info('worker')"],
+            cwd=self.data_dir, check=True, env={**os.environ, 'PYTHONPATH': os.path.dirname(citybike_import.__file__)})
+
+        with open(os.path.join(self.data_dir, "citybike_data_import.log")) as file:
+            log = file.read()
+        self.assertTrue(log.startswith("started the run\n"))
+        self.assertIn("worker", log)
+
+
+class ColumnarParserTests(ImportTestCase):
+    def assert_parsers_match(self, file_name, write_csv):
+        self.add_processing_file(file_name, 90, write_csv)
+
+        citybike_import.CityBikeDataImport(columnar=False).process_files()
+        row_rides, row_stations = self.ride_values(), self.station_values()
+
+        self.reset_processing_file(file_name)
+        citybike_import.CityBikeDataImport(columnar=True).process_files()
+
+        self.assertEqual(len(row_rides), 90)
+        self.assertEqual(self.ride_values(), row_rides)
+        return row_rides
+        self.assertEqual(self.station_values(), row_stations)
+
+    def test_columnar_parser_matches_row_parser_for_old_format(self):
+        rides = self.assert_parsers_match("201704-citibike-tripdata.csv", write_old_format_csv)
+
+        # The fixture has blank birth years (row 6) and genders (row 7), both parsers load them as 0
+        birth_year, gender = RIDE_FIELDS.index('rider_birth_year'), RIDE_FIELDS.index('rider_gender')
+        self.assertEqual((rides[6][birth_year], rides[7][gender]), (0, 0))
+        self.assertEqual((rides[1][birth_year], rides[1][gender]), (1980, 1))
+
+    def test_columnar_parser_matches_row_parser_for_new_format(self):
+        self.assert_parsers_match("202403-citibike-tripdata.csv", write_new_format_csv)
+
+
+class ZipStreamingTests(ImportTestCase):
+    def test_streaming_from_zip_matches_extracting(self):
+        self.add_processing_file("201704-citibike-tripdata.csv", 80)
+        file_path = os.path.join(self.processing_dir, "201704-citibike-tripdata.csv")
+        with open(file_path, newline='') as file:
+            rows = list(csv.reader(file))
+        rows[1][OLD_FORMAT_HEADER.index("start station name")] = "Broadway\r\n& W 41 St"
+        with open(file_path, 'w', newline='') as file:
+            csv.writer(file).writerows(rows)
+        citybike_import.CityBikeDataImport().process_files()
+        extracted_rides, extracted_stations = self.ride_values(), self.station_values()
+        self.assertIn("Broadway\r\n& W 41 St", [name for _, name, _, _ in extracted_stations])
+
+        ProcessedFile.objects.all().delete()
+        Station.objects.all().delete()
+        zip_path = os.path.join(self.data_dir, "201704-citibike-tripdata.csv.zip")
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+            zip_ref.write(os.path.join(self.processed_dir, "201704-citibike-tripdata.csv"),
+                          "201704-citibike-tripdata/201704-citibike-tripdata.csv")
+        importer = citybike_import.CityBikeDataImport(stream_from_zip=True)
+        zip_file = {'filename': "201704-citibike-tripdata.csv.zip", 'size': "1", 'last_modified': "2024-02-22T14:26:20.000Z"}
+        importer.add_files_to_ProcessingFile(importer.list_zip_members(zip_file, zip_path))
+        importer.process_files()
+
+        self.assertEqual(self.ride_values(), extracted_rides)
+        self.assertEqual(self.station_values(), extracted_stations)
+        self.assertEqual(ProcessedFile.objects.get().number_of_rows, 80)
+        self.assertFalse(ProcessingFile.objects.exists())
+        self.assertEqual(os.listdir(self.processing_dir), [])
+
+
+class StationDailyStatsTests(ImportTestCase):
+    def stats_values(self):
+        return list(StationDailyStats.objects.order_by('station_id', 'date').values_list(
+            'station_id', 'date', 'departures', 'arrivals', 'member_departures', 'casual_departures'))
+
+    def test_import_keeps_rollup_equal_to_a_rebuild(self):
+        self.add_processing_file("201704-citibike-tripdata.csv", 3000)
+        self.add_processing_file("202403-citibike-tripdata.csv", 500, write_new_format_csv)
+        with mock.patch.object(citybike_import, 'CHUNK_SIZE', 700):
+            citybike_import.CityBikeDataImport(columnar=True).process_files()
+        incremental = self.stats_values()
+
+        StationDailyStats.objects.all().delete()
+        for processed_file in ProcessedFile.objects.all():
+            rebuild_station_daily_stats(processed_file)
+
+        self.assertEqual(sum(row[2] for row in incremental), Ride.objects.filter(start_station__isnull=False).count())
+        self.assertEqual(self.stats_values(), incremental)
+
+
+class ExportRidesTests(TestCase):
+    def setUp(self):
+        create_rides(48)
+
+    def streamed(self, response):
+        return b"".join(response.streaming_content).decode()
+
+    def test_exports_filtered_rides_as_ndjson(self):
+        response = self.client.get('/api/rides/export', {'start': '2024-03-01T12:00:00', 'end': '2024-03-02', 'station': 3})
+
+        rides = [json.loads(line) for line in self.streamed(response).splitlines()]
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(len(rides), 5)
+        self.assertTrue(all(3 in (ride['start_station_id'], ride['end_station_id']) for ride in rides))
+        self.assertEqual(rides[0]['started_at'], '2024-03-01T12:00:00+00:00')
+
+    def test_exports_rides_as_csv(self):
+        response = self.client.get('/api/rides/export', {'format': 'csv', 'source_file': '202403-citibike-tripdata.csv'})
+
+        rows = list(csv.DictReader(io.StringIO(self.streamed(response))))
+        self.assertEqual(len(rows), 48)
+        self.assertEqual(rows[1]['rider_member_or_casual'], 'member')
+
+    def test_rejects_malformed_filters(self):
+        self.assertEqual(self.client.get('/api/rides/export', {'start': 'yesterday'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/rides/export', {'format': 'xml'}).status_code, 400)
+
+
+class RideListTests(TestCase):
+    def test_pages_through_every_ride_in_order(self):
+        create_rides(25)
+        Ride.objects.filter(started_at__hour=5).update(started_at=timezone.make_aware(datetime(2024, 3, 1, 4)))
+
+        ride_ids = []
+        url = '/api/rides/?page_size=4'
+        while url:
+            with self.assertNumQueries(1):
+                page = self.client.get(url).json()
+            ride_ids += [ride['ride_id'] for ride in page['results']]
+            url = page['next']
+
+        expected = list(Ride.objects.order_by('started_at', 'ride_id').values_list('ride_id', flat=True))
+        self.assertEqual(ride_ids, expected)
+
+    def test_lists_related_names(self):
+        create_rides(3)
+
+        ride = self.client.get('/api/rides/', {'start_station': 2}).json()['results'][0]
+
+        self.assertEqual((ride['start_station'], ride['start_station_name'], ride['bike_type']), (2, "Station 2", "classic"))
+
+    def test_rejects_a_tampered_cursor(self):
+        self.assertEqual(self.client.get('/api/rides/', {'cursor': 'bm90IGEgY3Vyc29y'}).status_code, 404)
+
+
+class ODMatrixTests(TestCase):
+    def setUp(self):
+        clear_caches()
+        create_rides(20)
+
+    def test_counts_rides_per_station_pair(self):
+        triplets = self.client.get('/api/od-matrix', {'end': '2024-03-01T10:00:00'}).json()['triplets']
+
+        self.assertEqual(triplets, [[1, 2, 2], [2, 3, 2], [3, 4, 2], [4, 5, 2], [5, 1, 2]])
+
+    @unittest.skipIf(views.np is None, "numpy is not installed")
+    def test_npy_payload(self):
+        import numpy
+
+        response = self.client.get('/api/od-matrix', {'format': 'npy'})
+
+        matrix = numpy.load(io.BytesIO(response.content))
+        self.assertEqual(matrix.shape, (5, 3))
+        self.assertEqual(matrix[:, 2].sum(), 20)
+
+    def test_cached_until_a_new_file_is_loaded(self):
+        self.client.get('/api/od-matrix')
+        with self.assertNumQueries(1):  # Only the dataset version
+            self.client.get('/api/od-matrix')
+
+        create_rides(5, file_name="202404-citibike-tripdata.csv")
+
+        triplets = self.client.get('/api/od-matrix').json()['triplets']
+        self.assertEqual(sum(rides for _, _, rides in triplets), 25)
+
+
+class ResponseCacheTests(TestCase):
+    def setUp(self):
+        clear_caches()
+        create_rides(10)
+
+    def test_revalidates_with_etag_and_last_modified(self):
+        response = self.client.get('/api/od-matrix')
+
+        self.assertEqual(self.client.get('/api/od-matrix', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertEqual(
+            self.client.get('/api/od-matrix', HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+        self.assertNotEqual(self.client.get('/api/od-matrix', {'station': 1})['ETag'], response['ETag'])
+
+    def test_etag_decides_over_last_modified(self):
+        response = self.client.get('/api/od-matrix')
+        last_modified = response['Last-Modified']
+
+        self.assertEqual(self.client.get('/api/od-matrix', HTTP_IF_NONE_MATCH='"other"',
+                                         HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 200)
+        self.assertEqual(self.client.get('/api/od-matrix', HTTP_IF_NONE_MATCH=f'"other", W/{response["ETag"]}',
+                                         HTTP_IF_MODIFIED_SINCE='Thu, 01 Jan 1970 00:00:00 GMT').status_code, 304)
+        self.assertEqual(self.client.get('/api/od-matrix', HTTP_IF_NONE_MATCH='*').status_code, 304)
+
+    def test_finishing_a_file_bumps_the_version(self):
+        version, _ = get_dataset_version()
+        processed_file = ProcessedFile.objects.get()
+        processing_file = ProcessingFile.objects.create(
+            file_name="gone.csv", file_path="gone.csv", parent_zip_last_modified=timezone.now(), size=1)
+
+        with mock.patch.object(citybike_import.CityBikeDataImport, 'move_file_from_processing_to_processed'):
+            citybike_import.CityBikeDataImport().finish_processed_file(processing_file, processed_file, 10)
+
+        self.assertNotEqual(get_dataset_version()[0], version)
+
+    def test_lru_evicts_the_least_recently_used(self):
+        lru = LRUCache(max_size=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+
+        self.assertEqual((lru.get('a'), lru.get('b'), lru.get('c')), (1, None, 3))
+
+
+class DateParsingTests(TestCase):
+    def test_detects_the_format_of_each_file_type(self):
+        importer = citybike_import.CityBikeDataImport()
+        old_rows = [{"starttime": "1/1/2014 0:01", "stoptime": "1/1/2014 0:14"}]
+        new_rows = [{"started_at": "2021-02-01 00:00:53.371", "ended_at": "2021-02-01 00:10:11.802"}]
+
+        self.assertEqual(importer.detect_date_format(OLD_FORMAT_HEADER, old_rows), '%m/%d/%Y %H:%M')
+        self.assertEqual(importer.detect_date_format(["started_at", "ended_at"], new_rows), '%Y-%m-%d %H:%M:%S.%f')
+
+    def test_convert_dates_matches_dateutil(self):
+        importer = citybike_import.CityBikeDataImport()
+        date_strs = ["2017-04-01 00:00:58", "2017-04-01 13:05:00", "April 2 2017 10:00", ""]
+
+        dates = importer.convert_dates(date_strs, '%Y-%m-%d %H:%M:%S')
+
+        expected = [timezone.make_aware(importer.convert_date(date_str)) for date_str in date_strs[:3]]
+        self.assertEqual(dates, expected + [None])
+
+
+class BulkLoadModeTests(ImportTestCase):
+    def pragma(self, name):
+        with connection.cursor() as cursor:
+            cursor.execute(f"PRAGMA {name}")
+            return cursor.fetchone()[0]
+
+    def test_bulk_load_mode_restores_connection_settings(self):
+        importer = citybike_import.CityBikeDataImport(bulk_load=True)
+        synchronous, cache_size = self.pragma('synchronous'), self.pragma('cache_size')
+        batch_size = importer.get_batch_size(Ride)
+
+        with importer.bulk_load_mode():
+            self.assertEqual(self.pragma('synchronous'), 1)  # NORMAL
+            self.assertEqual(self.pragma('cache_size'), citybike_import.BULK_LOAD_PRAGMAS['cache_size'])
+            fields = len(Ride._meta.concrete_fields)
+            self.assertEqual(
+                importer.get_batch_size(Ride),
+                min(importer.sqlite_variable_limit() // fields, citybike_import.MAX_BATCH_SIZE))
+            # Uncapped, so the number of fields is what decides the batch size
+            with mock.patch.object(citybike_import, 'MAX_BATCH_SIZE', 10 ** 9):
+                self.assertEqual(importer.get_batch_size(Ride), importer.sqlite_variable_limit() // fields)
+
+        self.assertEqual(self.pragma('synchronous'), synchronous)
+        self.assertEqual(self.pragma('cache_size'), cache_size)
+        self.assertEqual(importer.get_batch_size(Ride), batch_size)
+
+    def test_bulk_load_import(self):
+        self.add_processing_file("201704-citibike-tripdata.csv", 50)
+
+        citybike_import.CityBikeDataImport(bulk_load=True).process_files()
+
+        self.assertEqual(Ride.objects.count(), 50)
+
+
+class RideWriterTests(ImportTestCase):
+    def test_raw_writer_matches_orm_writer(self):
+        for file_name, write_csv in (("201704-citibike-tripdata.csv", write_old_format_csv),
+                                     ("202403-citibike-tripdata.csv", write_new_format_csv)):
+            self.add_processing_file(file_name, 60, write_csv)
+
+        citybike_import.CityBikeDataImport(ride_writer='orm').process_files()
+        orm_rides = self.ride_values()
+
+        Ride.objects.all().delete()
+        for file_name in ("201704-citibike-tripdata.csv", "202403-citibike-tripdata.csv"):
+            self.reset_processing_file(file_name)
+        citybike_import.CityBikeDataImport(ride_writer='raw').process_files()
+
+        self.assertEqual(len(orm_rides), 120)
+        self.assertEqual(self.ride_values(), orm_rides)
+
+
+class TripdataRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves server.files like the tripdata bucket does, including Range requests.
+    """
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('Range')))
+        content = self.server.files.get(self.path.lstrip('/'))
+        if content is None:
+            self.send_error(404)
+            return
+
+        start = 0
+        if self.headers.get('Range'):
+            start = int(self.headers['Range'].split('=')[1].split('-')[0])
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{len(content) - 1}/{len(content)}")
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(content) - start))
+        self.end_headers()
+        self.wfile.write(content[start:])
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DownloadTests(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), TripdataRequestHandler)
+        self.server.files = {f"2024{month:02d}-citibike-tripdata.zip": os.urandom(300_000 + month) for month in range(1, 6)}
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        self.download_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.download_dir, ignore_errors=True)
+        patcher = mock.patch.object(citybike_import, 'DOWNLOAD_DIR', self.download_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.importer = citybike_import.CityBikeDataImport()
+        self.importer.target_base_url = f"http://127.0.0.1:{self.server.server_port}/"
+        self.zip_files = [
+            {'filename': file_name, 'size': str(len(content)), 'last_modified': '2024-06-01T10:00:00.000Z'}
+            for file_name, content in self.server.files.items()
+        ]
+
+    def read(self, file_name):
+        with open(os.path.join(self.download_dir, file_name), 'rb') as file:
+            return file.read()
+
+    def test_downloads_every_archive(self):
+        downloaded = self.importer.download_files(self.zip_files)
+
+        self.assertEqual([zip_file['filename'] for zip_file, _ in downloaded], list(self.server.files))
+        for file_name, content in self.server.files.items():
+            self.assertEqual(self.read(file_name), content)
+
+    def test_resumes_a_partial_download(self):
+        file_name, content = next(iter(self.server.files.items()))
+        with open(os.path.join(self.download_dir, file_name + ".part"), 'wb') as file:
+            file.write(content[:1000])
+
+        self.importer.download_files(self.zip_files[:1])
+
+        self.assertEqual(self.server.requests, [(f"/{file_name}", "bytes=1000-")])
+        self.assertEqual(self.read(file_name), content)
+
+    def test_skips_archives_that_match_the_local_copy(self):
+        self.importer.download_files(self.zip_files)
+        self.server.requests.clear()
+
+        downloaded = self.importer.download_files(self.zip_files)
+
+        self.assertEqual(self.server.requests, [])
+        self.assertEqual(len(downloaded), len(self.zip_files))
+
+
+class FileRegistryTests(TestCase):
+    def setUp(self):
+        self.importer = citybike_import.CityBikeDataImport()
+        self.last_modified = timezone.make_aware(datetime(2024, 6, 1, 10))
+        ProcessedFile.objects.create(
+            file_name="a.csv", file_path="a.csv", parent_zip_name="a.zip", parent_zip_last_modified=self.last_modified,
+            size=100, completed=True)
+        ProcessedFile.objects.create(
+            file_name="b.csv", file_path="b.csv", parent_zip_name="b.zip", parent_zip_last_modified=self.last_modified,
+            size=200, completed=True)
+        ProcessedFile.objects.create(
+            file_name="d.csv", file_path="d.csv", parent_zip_name="d.zip", parent_zip_last_modified=self.last_modified,
+            size=400)  # Its load was interrupted
+
+    def test_matches_processed_files_on_the_whole_tuple(self):
+        for file_name, size, last_modified in [
+            ("a.csv", 100, self.last_modified),  # Unchanged
+            ("b.csv", 100, self.last_modified),  # Size of a.csv, the __in filters matched it
+            ("c.csv", 200, self.last_modified),  # New
+            ("d.csv", 400, self.last_modified),  # Not completed
+        ]:
+            ProcessingFile.objects.create(
+                file_name=file_name, file_path=file_name, parent_zip_last_modified=last_modified, size=size)
+
+        self.assertEqual(self.importer.get_processed_files(), ["a.csv"])
+
+    def test_skips_unchanged_archives_before_downloading(self):
+        zip_files = [
+            {'filename': "a.zip", 'size': "100", 'last_modified': '2024-06-01T10:00:00.000Z'},
+            {'filename': "b.zip", 'size': "200", 'last_modified': '2024-06-02T10:00:00.000Z'},
+            {'filename': "c.zip", 'size': "300", 'last_modified': '2024-06-01T10:00:00.000Z'},
+            {'filename': "d.zip", 'size': "400", 'last_modified': '2024-06-01T10:00:00.000Z'},
+        ]
+
+        self.assertEqual(
+            [zip_file['filename'] for zip_file in self.importer.filter_unchanged_archives(zip_files)],
+            ["b.zip", "c.zip", "d.zip"])
+
+
+class ReingestTests(ImportTestCase):
+    def run_import(self, zip_path, interrupt_after_chunks=None):
+        """
+        Runs steps 1.0 to 4.0 on one local zip file in chunks of 100 rows, optionally failing
+        the load after some chunks the way a crash or a killed process would.
+        """
+        zip_file = {'filename': os.path.basename(zip_path), 'size': str(os.path.getsize(zip_path)),
+                    'last_modified': '2024-06-01T10:00:00.000Z'}
+        importer = citybike_import.CityBikeDataImport(columnar=False)
+        importer.get_files_from_web = lambda: [zip_file]
+        importer.download_files = lambda zip_files: [(zip_file, zip_path) for zip_file in zip_files]
+        read_chunks = importer.read_chunks
+        importer.read_chunks = lambda reader, chunk_size=100: read_chunks(reader, chunk_size)
+        if interrupt_after_chunks is not None:
+            load_rows = importer.load_rows
+            loaded_chunks = []
+
+            def interrupted_load_rows(parsed_rows, processed_file):
+                if len(loaded_chunks) == interrupt_after_chunks:
+                    raise RuntimeError("Interrupted")
+                loaded_chunks.append(parsed_rows)
+                return load_rows(parsed_rows, processed_file)
+            importer.load_rows = interrupted_load_rows
+        importer.execute_steps()
+        return importer
+
+    def test_interrupted_load_is_loaded_again(self):
+        csv_path = os.path.join(self.data_dir, "201704-citibike-tripdata.csv")
+        write_old_format_csv(csv_path, 300)
+        zip_path = os.path.join(self.data_dir, "201704-citibike-tripdata.zip")
+        with zipfile.ZipFile(zip_path, 'w') as zip_ref:
+            zip_ref.write(csv_path, os.path.basename(csv_path))
+
+        self.run_import(zip_path, interrupt_after_chunks=1)
+        self.assertEqual(Ride.objects.count(), 100)
+        self.assertFalse(ProcessedFile.objects.get().completed)
+
+        importer = self.run_import(zip_path)
+        processed_file = ProcessedFile.objects.get()
+        self.assertTrue(processed_file.completed)
+        self.assertEqual(processed_file.number_of_rows, 300)
+        self.assertEqual(processed_file.rides.count(), 300)
+        self.assertEqual(importer.report.counters['zip_files_unchanged'], 0)
+
+        importer = self.run_import(zip_path)  # Now it is done, the zip file is skipped
+        self.assertEqual(importer.report.counters['zip_files_unchanged'], 1)
+        self.assertEqual(Ride.objects.count(), 300)
+
+    def test_files_loaded_before_zip_names_were_recorded_are_skipped(self):
+        csv_path = os.path.join(self.data_dir, "201704-citibike-tripdata.csv")
+        write_old_format_csv(csv_path, 300)
+        zip_path = os.path.join(self.data_dir, "201704-citibike-tripdata.zip")
+        with zipfile.ZipFile(zip_path, 'w') as zip_ref:
+            zip_ref.write(csv_path, os.path.basename(csv_path))
+        self.run_import(zip_path)
+        ProcessedFile.objects.update(parent_zip_name='')  # As migration 0015 left the files loaded before it
+        rides = list(Ride.objects.order_by('ride_id').values_list('ride_id', flat=True))
+
+        importer = self.run_import(zip_path)  # Downloaded once more, and recognised in step 3.0
+        self.assertEqual(importer.report.counters['zip_files_unchanged'], 0)
+        self.assertEqual(importer.report.counters['files_already_loaded'], 1)
+        self.assertEqual(ProcessedFile.objects.get().parent_zip_name, "201704-citibike-tripdata.zip")
+        self.assertEqual(list(Ride.objects.order_by('ride_id').values_list('ride_id', flat=True)), rides)
+
+        importer = self.run_import(zip_path)
+        self.assertEqual(importer.report.counters['zip_files_unchanged'], 1)
+
+    def test_interrupted_load_is_swapped_in_from_staging(self):
+        csv_path = os.path.join(self.data_dir, "201704-citibike-tripdata.csv")
+        write_old_format_csv(csv_path, 300)
+        zip_path = os.path.join(self.data_dir, "201704-citibike-tripdata.zip")
+        with zipfile.ZipFile(zip_path, 'w') as zip_ref:
+            zip_ref.write(csv_path, os.path.basename(csv_path))
+
+        self.run_import(zip_path, interrupt_after_chunks=1)
+        partial_rides = list(Ride.objects.order_by('ride_id').values_list('ride_id', flat=True))
+        # The reload is interrupted too, readers keep seeing the partial load rather than a mix
+        self.run_import(zip_path, interrupt_after_chunks=2)
+        self.assertEqual(list(Ride.objects.order_by('ride_id').values_list('ride_id', flat=True)), partial_rides)
+        self.assertEqual(StagedRide.objects.count(), 200)
+
+        importer = self.run_import(zip_path)
+        self.assertTrue(importer.report.files["201704-citibike-tripdata.csv"]['reloaded'])
+        self.assertEqual(Ride.objects.count(), 300)
+        self.assertFalse(StagedRide.objects.exists())
+        self.assertTrue(ProcessedFile.objects.get().completed)
+
+        incremental = StationDailyStatsTests.stats_values(self)
+        StationDailyStats.objects.all().delete()
+        rebuild_station_daily_stats(ProcessedFile.objects.get())
+        self.assertEqual(StationDailyStatsTests.stats_values(self), incremental)
+
+    def test_reloading_a_changed_file_replaces_its_rides(self):
+        stats_values = StationDailyStatsTests.stats_values
+        self.add_processing_file("201705-citibike-tripdata.csv", 40)
+        self.add_processing_file("201704-citibike-tripdata.csv", 120)
+        citybike_import.CityBikeDataImport().process_files()
+        other_rides = list(Ride.objects.filter(source_file__file_name="201705-citibike-tripdata.csv")
+                           .order_by('ride_id').values_list(*RIDE_FIELDS))
+
+        for ride_writer in ('orm', 'raw'):
+            with self.subTest(ride_writer=ride_writer):
+                os.remove(os.path.join(self.processed_dir, "201704-citibike-tripdata.csv"))
+                self.add_processing_file("201704-citibike-tripdata.csv", 90)
+                citybike_import.CityBikeDataImport(ride_writer=ride_writer).process_files()
+
+                processed_file = ProcessedFile.objects.get(file_name="201704-citibike-tripdata.csv")
+                reloaded_rides = list(processed_file.rides.order_by('ride_id').values_list(*RIDE_FIELDS))
+                self.assertEqual(processed_file.number_of_rows, 90)
+                self.assertEqual(processed_file.size, os.path.getsize(
+                    os.path.join(self.processed_dir, "201704-citibike-tripdata.csv")))
+                self.assertEqual(len(reloaded_rides), 90)
+                self.assertEqual(Ride.objects.count(), 130)
+                self.assertFalse(StagedRide.objects.exists())
+                self.assertEqual(
+                    list(Ride.objects.filter(source_file__file_name="201705-citibike-tripdata.csv")
+                         .order_by('ride_id').values_list(*RIDE_FIELDS)), other_rides)
+
+                incremental = stats_values(self)
+                StationDailyStats.objects.all().delete()
+                for processed_file in ProcessedFile.objects.all():
+                    rebuild_station_daily_stats(processed_file)
+                self.assertEqual(stats_values(self), incremental)
+
+
+class RunReportTests(ImportTestCase):
+    def test_reports_each_file_and_the_dimension_caches(self):
+        self.add_processing_file("201704-citibike-tripdata.csv", 200)
+        importer = citybike_import.CityBikeDataImport(columnar=False)
+
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            importer.process_files()
+        report_path = os.path.join(self.data_dir, "report.json")
+        importer.report.write(report_path)
+        with open(report_path) as file:
+            report = json.load(file)
+
+        self.assertEqual(stdout.getvalue(), "")  # Rows are logged, sampled, rather than printed
+        file_report = report['files']["201704-citibike-tripdata.csv"]
+        self.assertEqual((file_report['rows_parsed'], file_report['rows_inserted']), (200, 200))
+        self.assertGreater(file_report['queries'], 0)
+        self.assertEqual(report['counters']['rows_inserted'], 200)
+        # The file uses stations 1 to 7, each one misses the cache the first time it is seen
+        self.assertEqual(report['counters']['station_cache_misses'], 7)
+        self.assertEqual(report['cache_hit_rates']['station'], round(1 - 7 / 400, 4))
+
+
+class QueryBudgetTests(ImportTestCase):
+    def read_rows(self, file_name, number_of_rows):
+        file_path = os.path.join(self.processing_dir, file_name)
+        write_old_format_csv(file_path, number_of_rows)
+        with open(file_path, newline='', encoding='utf-8') as file:
+            reader = csv.DictReader(file)
+            return reader.fieldnames, list(reader)
+
+    def test_chunk_queries_only_grow_with_the_insert_batches(self):
+        header, rows = self.read_rows("201704-citibike-tripdata.csv", 2000)
+        processed_file = create_rides(0, file_name="201704-citibike-tripdata.csv")
+        importer = citybike_import.CityBikeDataImport(columnar=False)
+        importer.preload_dimensions()
+        batch_size = importer.get_batch_size(Ride)
+
+        for chunk in (rows[:200], rows[200:]):
+            with QueryProfiler() as profiler:
+                importer.normalize_rows(header, chunk, processed_file)
+            # One INSERT per batch of rides, plus the new stations, the new bikes and three for the rollup
+            self.assertLessEqual(profiler.count, math.ceil(len(chunk) / batch_size) + 5)
+        self.assertTrue(profiler.slowest[0]['plan'])
+
+    @override_settings(API_PROFILE_QUERIES=True)
+    def test_api_request_budgets(self):
+        create_rides(300)
+        clear_caches()
+
+        self.assertEqual(self.client.get('/api/rides/', {'page_size': 100})['X-Query-Count'], "1")
+        # The dataset version, then the matrix until it is cached
+        self.assertEqual(self.client.get('/api/od-matrix')['X-Query-Count'], "2")
+        self.assertEqual(self.client.get('/api/od-matrix')['X-Query-Count'], "1")
+
+
+@unittest.skipIf(archive.pa is None, "pyarrow is not installed")
+class ParquetArchiveTests(ImportTestCase):
+    def setUp(self):
+        super().setUp()
+        self.archive_dir = os.path.join(self.data_dir, "Archive")
+        patcher = mock.patch.object(citybike_import, 'ARCHIVE_DIR', self.archive_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_archive_matches_the_db(self):
+        self.add_processing_file("201704-citibike-tripdata.csv", 3000)  # 2017-04-01 to 2017-04-02
+        self.add_processing_file("202403-citibike-tripdata.csv", 200, write_new_format_csv)
+        citybike_import.CityBikeDataImport(archive=True).process_files()
+
+        self.assertEqual(sorted(os.listdir(self.archive_dir)), ["year=2017", "year=2024"])
+        table = archive.read_rides(self.archive_dir, columns=['ride_id', 'duration_seconds', 'distance_m'])
+        self.assertEqual(
+            sorted(zip(*table.to_pydict().values())),
+            list(Ride.objects.order_by('ride_id').values_list('ride_id', 'duration_seconds', 'distance_m')))
+        self.assertTrue(all(table.column('duration_seconds').to_pylist()))
+
+        start = timezone.make_aware(datetime(2017, 4, 1, 6))
+        end = timezone.make_aware(datetime(2017, 4, 1, 12))
+        table = archive.read_rides(self.archive_dir, columns=['ride_id', 'end_station_id'], start=start, end=end,
+                                   start_station=3)
+        self.assertEqual(table.column_names, ['ride_id', 'end_station_id'])
+        self.assertGreater(table.num_rows, 0)
+        self.assertEqual(
+            sorted(zip(*table.to_pydict().values())),
+            list(Ride.objects.filter(started_at__gte=start, started_at__lt=end, start_station_id=3)
+                 .order_by('ride_id').values_list('ride_id', 'end_station_id')))
+
+    def test_reloading_a_file_replaces_its_archive(self):
+        self.add_processing_file("201704-citibike-tripdata.csv", 300)
+        citybike_import.CityBikeDataImport(archive=True).process_files()
+        os.remove(os.path.join(self.processed_dir, "201704-citibike-tripdata.csv"))
+        self.add_processing_file("201704-citibike-tripdata.csv", 100)
+        citybike_import.CityBikeDataImport(archive=True).process_files()
+
+        table = archive.read_rides(self.archive_dir, columns=['ride_id'])
+        self.assertEqual(sorted(table.column('ride_id').to_pylist()),
+                         list(Ride.objects.order_by('ride_id').values_list('ride_id', flat=True)))
+
+
+@unittest.skipIf(station_index.np is None, "numpy is not installed")
+class StationIndexTests(ImportTestCase):
+    def setUp(self):
+        super().setUp()
+        self.index_dir = os.path.join(self.data_dir, "StationIndex")
+        patcher = mock.patch.object(citybike_import, 'STATION_INDEX_DIR', self.index_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_index_answers_like_the_db(self):
+        self.add_processing_file("201704-citibike-tripdata.csv", 3000)
+        self.add_processing_file("202403-citibike-tripdata.csv", 300, write_new_format_csv)
+        citybike_import.CityBikeDataImport(station_index=True).process_files()
+        index = station_index.StationIndex(self.index_dir)
+
+        start = timezone.make_aware(datetime(2017, 4, 1, 6, 30))
+        end = timezone.make_aware(datetime(2017, 4, 2, 3))
+        rides = Ride.objects.filter(start_station_id=3, started_at__gte=start, started_at__lt=end)
+        self.assertGreater(rides.count(), 0)
+        self.assertEqual(index.count(3, start, end), rides.count())
+
+        histogram = index.histogram(3, start, end)
+        self.assertEqual(len(histogram), 21)
+        for hour in (0, 5, 20):
+            bin_start = start + timedelta(hours=hour)
+            self.assertEqual(histogram[hour], rides.filter(
+                started_at__gte=bin_start, started_at__lt=bin_start + timedelta(hours=1)).count())
+        by_hour = index.hour_of_day_counts(3, start, end)
+        self.assertEqual(by_hour[7], rides.filter(started_at__hour=7).count())
+        self.assertEqual(by_hour.sum(), rides.count())
+
+    def test_update_only_touches_changed_files(self):
+        self.add_processing_file("201704-citibike-tripdata.csv", 100)
+        self.add_processing_file("201705-citibike-tripdata.csv", 100)
+        citybike_import.CityBikeDataImport(station_index=True).process_files()
+
+        self.assertEqual(station_index.update_station_index(self.index_dir), {'built': 0, 'removed': 0, 'kept': 2})
+        ProcessedFile.objects.filter(file_name="201705-citibike-tripdata.csv").delete()
+        create_rides(10, file_name="202403-citibike-tripdata.csv")
+        self.assertEqual(station_index.update_station_index(self.index_dir), {'built': 1, 'removed': 1, 'kept': 1})
+        self.assertEqual(station_index.StationIndex(self.index_dir).count(
+            2, timezone.make_aware(datetime(2024, 3, 1)), timezone.make_aware(datetime(2024, 3, 2))), 2)
+
+    def test_update_leaves_other_files_alone(self):
+        create_rides(10)
+        unrelated = os.path.join(self.index_dir, "x", "keepme")
+        os.makedirs(unrelated)
+        with open(os.path.join(unrelated, "important.txt"), 'w') as file:
+            file.write("keep")
+        os.makedirs(os.path.join(self.index_dir, "file-999.building"))
+
+        self.assertEqual(station_index.update_station_index(self.index_dir), {'built': 1, 'removed': 0, 'kept': 0})
+        self.assertEqual(sorted(os.listdir(self.index_dir)), [f"file-{ProcessedFile.objects.get().file_id}", "x"])
+        self.assertTrue(os.path.exists(os.path.join(unrelated, "important.txt")))
+
+    def test_histogram_rejects_an_end_before_its_start(self):
+        create_rides(10)
+        station_index.update_station_index(self.index_dir)
+        index = station_index.StationIndex(self.index_dir)
+        start = timezone.make_aware(datetime(2024, 3, 2))
+
+        with self.assertRaises(ValueError):
+            index.histogram(1, start, start - timedelta(hours=1))
+        self.assertEqual(len(index.histogram(1, start, start)), 0)
+
+
+class SpatialIndexTests(TestCase):
+    def setUp(self):
+        generator = random.Random(7)
+        Station.objects.bulk_create(
+            Station(station_name=f"Station {i}", lat=40.65 + generator.random() * 0.2, lon=-74.05 + generator.random() * 0.15)
+            for i in range(300))
+
+    def test_nearby_matches_a_full_scan(self):
+        response = self.client.get('/api/stations/nearby', {'lat': 40.75, 'lon': -73.98, 'k': 7})
+
+        expected = sorted(Station.objects.all(), key=lambda s: (haversine_m(40.75, -73.98, s.lat, s.lon), s.station_id))[:7]
+        stations = response.json()['stations']
+        self.assertEqual([station['station_id'] for station in stations], [station.station_id for station in expected])
+        self.assertEqual(stations[0]['distance_m'], round(haversine_m(40.75, -73.98, expected[0].lat, expected[0].lon), 1))
+
+    def test_bbox_matches_the_db(self):
+        box = {'min_lat': 40.7, 'min_lon': -74.0, 'max_lat': 40.72, 'max_lon': -73.95}
+        stations = self.client.get('/api/stations/bbox', box).json()['stations']
+
+        expected = Station.objects.filter(lat__gte=40.7, lat__lte=40.72, lon__gte=-74.0, lon__lte=-73.95).order_by('station_id')
+        self.assertGreater(len(stations), 0)
+        self.assertEqual([station['station_id'] for station in stations], [station.station_id for station in expected])
+
+    def test_new_station_is_found(self):
+        self.client.get('/api/stations/nearby', {'lat': 41.5, 'lon': -73.0})
+        station = Station.objects.create(station_name="Far away", lat=41.5, lon=-73.0)
+
+        stations = self.client.get('/api/stations/nearby', {'lat': 41.5, 'lon': -73.0, 'k': 1}).json()['stations']
+        self.assertEqual(stations[0]['station_id'], station.station_id)
+
+    def test_rejects_bad_parameters(self):
+        self.assertEqual(self.client.get('/api/stations/nearby', {'lat': 40.75}).status_code, 400)
+        self.assertEqual(self.client.get('/api/stations/nearby', {'lat': 'x', 'lon': 1}).status_code, 400)
+        self.assertEqual(self.client.get('/api/stations/bbox', {'min_lat': 41, 'min_lon': -74, 'max_lat': 40, 'max_lon': -73}).status_code, 400)
+        for lat in ('nan', 'inf', '-inf', '1e6', '90.5'):
+            self.assertEqual(self.client.get('/api/stations/nearby', {'lat': lat, 'lon': -73.98}).status_code, 400)
+        self.assertEqual(self.client.get('/api/stations/bbox', {'min_lat': 40, 'min_lon': 'nan', 'max_lat': 41, 'max_lon': -73}).status_code, 400)
+        self.assertEqual(self.client.get('/api/stations/bbox', {'min_lat': 40, 'min_lon': -181, 'max_lat': 41, 'max_lon': -73}).status_code, 400)
+
+    def test_far_away_point_scans_instead_of_searching_rings(self):
+        with mock.patch.object(StationGrid, 'scan', autospec=True, side_effect=StationGrid.scan) as scan:
+            stations = self.client.get('/api/stations/nearby', {'lat': -60, 'lon': 100, 'k': 3}).json()['stations']
+
+        scan.assert_called_once()
+        expected = sorted(Station.objects.all(), key=lambda s: (haversine_m(-60, 100, s.lat, s.lon), s.station_id))[:3]
+        self.assertEqual([station['station_id'] for station in stations], [station.station_id for station in expected])
+
+    def test_skips_stations_without_coordinates(self):
+        Station.objects.create(station_name="No coordinates", lat=0, lon=0)
+
+        self.assertEqual(self.client.get('/api/stations/bbox', {'min_lat': -1, 'min_lon': -1, 'max_lat': 1, 'max_lon': 1}).json()['stations'], [])
+        nearest = self.client.get('/api/stations/nearby', {'lat': 0.1, 'lon': 0.1, 'k': 1}).json()['stations'][0]
+        self.assertNotEqual(nearest['station_name'], "No coordinates")
+
+
+class StationResolverTests(ImportTestCase):
+    def test_new_format_codes_stay_distinct(self):
+        self.add_processing_file("202403-citibike-tripdata.csv", 300, write_new_format_csv)
+        importer = citybike_import.CityBikeDataImport()
+        importer.process_files()
+
+        codes = dict(Station.objects.values_list('station_code', 'station_id'))
+        self.assertEqual(sorted(codes), [
+            '5900.10', '5901.11', '5902.12', '5903.10', '5904.11', '5905.12',
+            '6100.00', '6101.01', '6102.00', '6103.01'])
+        self.assertTrue(all(station_id >= ALLOCATED_STATION_ID_START for station_id in codes.values()))
+        self.assertEqual(Ride.objects.filter(start_station_id=codes['5903.10']).count(), 50)
+        self.assertEqual(Ride.objects.filter(end_station__isnull=True).count(), 34)  # Every 9th row has no end code
+        self.assertEqual(importer.report.counters['station_rows_unresolved'], 34)
+
+    def test_repeated_stations_are_resolved_without_queries(self):
+        table = connection.ops.quote_name(Station._meta.db_table)
+
+        def station_queries(file_name):
+            self.add_processing_file(file_name, 300)  # 7 start and 5 end stations, repeated on every row
+            importer = citybike_import.CityBikeDataImport()
+            with mock.patch.object(citybike_import, 'CHUNK_SIZE', 100), CaptureQueriesContext(connection) as queries:
+                importer.process_files()
+            statements = [query['sql'].split()[0].upper() for query in queries if table in query['sql']]
+            return statements, importer.report.counters['station_cache_misses']
+
+        # One read of every station when the run starts, the new ones inserted once, with the first chunk
+        self.assertEqual(station_queries("201704-citibike-tripdata.csv"), (['SELECT', 'INSERT'], 7))
+        self.assertEqual(station_queries("201705-citibike-tripdata.csv"), (['SELECT'], 0))
+        self.assertEqual(Station.objects.count(), 7)
+
+    def test_canonical_codes_and_merges(self):
+        resolver = StationResolver([(72, '', "W 52 St & 11 Ave", 40.767, -73.993), (5, 'HB105', "Hoboken", 40.73, -74.03)])
+        new_stations = {}
+
+        self.assertEqual(resolver.resolve('72.0', "W 52 St & 11 Ave", '40.767', '-73.993', new_stations), 72)
+        self.assertEqual(resolver.resolve(' 072', "W 52 St", '40.767', '-73.993', new_stations), 72)
+        self.assertEqual(resolver.resolve('jc013', "Grove St", '40.7192', '-74.0431', new_stations),
+                         resolver.resolve('JC013', "Grove St", 40.7192, -74.0431, new_stations))
+        self.assertEqual(resolver.resolve('5', "Station 5", 40.7, -73.9, new_stations), ALLOCATED_STATION_ID_START + 1)
+        self.assertIsNone(resolver.resolve('', "unknown", 0, 0, new_stations))
+
+        self.assertEqual(sorted(new_stations), [ALLOCATED_STATION_ID_START, ALLOCATED_STATION_ID_START + 1])
+        self.assertEqual(new_stations[ALLOCATED_STATION_ID_START].station_code, 'JC013')
+        self.assertEqual(resolver.pop_stats(), {
+            'station_names_merged': 1, 'station_id_collisions': 1, 'station_rows_unresolved': 1})
+
+
+class RideMetricsTests(ImportTestCase):
+    def setUp(self):
+        super().setUp()
+        self.add_processing_file("201704-citibike-tripdata.csv", 100)
+        self.add_processing_file("202403-citibike-tripdata.csv", 90, write_new_format_csv)
+        citybike_import.CityBikeDataImport().process_files()
+
+    def test_import_stores_duration_and_distance(self):
+        stations = {station.station_id: station for station in Station.objects.all()}
+        for ride in Ride.objects.select_related('source_file'):
+            self.assertEqual(ride.duration_seconds, 600 if ride.source_file.file_name.startswith("2017") else 900)
+            if ride.end_station_id is None:
+                self.assertIsNone(ride.distance_m)
+                continue
+            start, end = stations[ride.start_station_id], stations[ride.end_station_id]
+            self.assertEqual(ride.distance_m, round(haversine_m(start.lat, start.lon, end.lat, end.lon)))
+        self.assertEqual(Ride.objects.filter(distance_m=0).count(),
+                         Ride.objects.filter(start_station=F('end_station')).count())
+
+        response = self.client.get('/api/rides/export', {'min_distance': 1000, 'max_duration': 600})
+        rides = b"".join(response.streaming_content).splitlines()
+        self.assertGreater(len(rides), 0)
+        self.assertEqual(len(rides), Ride.objects.filter(distance_m__gte=1000, duration_seconds__lte=600).count())
+
+    def test_backfill_fills_in_older_rides(self):
+        expected = self.ride_values()
+        Ride.objects.filter(source_file__file_name="201704-citibike-tripdata.csv").update(duration_seconds=None, distance_m=None)
+
+        call_command('backfill_ride_metrics', '--all', '--batch-size', '7', stdout=io.StringIO())
+        self.assertEqual(self.ride_values(), expected)
+
+    def test_backfill_replaces_cached_responses(self):
+        clear_caches()
+        Ride.objects.filter(source_file__file_name="201704-citibike-tripdata.csv").update(duration_seconds=None, distance_m=None)
+        params = {'max_duration': 600}
+        before = self.client.get('/api/od-matrix', params)
+        self.assertEqual(before.json()['triplets'], [])
+
+        call_command('backfill_ride_metrics', "201704-citibike-tripdata.csv", stdout=io.StringIO())
+        after = self.client.get('/api/od-matrix', params)
+        self.assertNotEqual(after['ETag'], before['ETag'])
+        self.assertEqual(sum(count for _, _, count in after.json()['triplets']),
+                         Ride.objects.filter(duration_seconds__lte=600).count())
+
+        version = get_dataset_version()
+        rebuild_station_daily_stats(ProcessedFile.objects.get(file_name="201704-citibike-tripdata.csv"))
+        self.assertNotEqual(get_dataset_version(), version)
+
+    def test_backfill_needs_known_file_names(self):
+        with self.assertRaisesMessage(CommandError, "No ProcessedFile named missing.csv"):
+            call_command('backfill_ride_metrics', "201704-citibike-tripdata.csv", "missing.csv", stdout=io.StringIO())
+        with self.assertRaisesMessage(CommandError, "Name at least one ProcessedFile or pass --all."):
+            call_command('backfill_ride_metrics', stdout=io.StringIO())
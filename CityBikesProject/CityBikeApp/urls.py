@@ -2,4 +2,9 @@ from django.urls import path
 from . import views
 
 urlpatterns = [
-]
\ No newline at end of file
+    path('rides/', views.RideListView.as_view(), name='ride-list'),
+    path('rides/export', views.export_rides, name='rides-export'),
+    path('od-matrix', views.od_matrix, name='od-matrix'),
+    path('stations/nearby', views.stations_nearby, name='stations-nearby'),
+    path('stations/bbox', views.stations_bbox, name='stations-bbox'),
+]
@@ -1,8 +1,253 @@
+import csv
+import io
+import itertools
+import json
+import math
+from datetime import datetime, time
+
 from django.shortcuts import render
 from rest_framework.views import APIView
-from django.http import StreamingHttpResponse
+from django.db.models import Count, Q
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET
+from rest_framework import generics
 from rest_framework.decorators import api_view
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
-from .models import ProcessedFile
-from .serializers import ProcessedFileSerializer
+from .cache import cached_api_view
+from .models import ProcessedFile, Ride
+from .pagination import RideKeysetPagination
+from .serializers import ProcessedFileSerializer, RideSerializer
+from .spatial import get_station_grid
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, only the npy format of the od-matrix needs it
+    np = None
+
+EXPORT_FIELDS = [
+    'ride_id', 'started_at', 'ended_at', 'start_station_id', 'end_station_id', 'bike_id',
+    'rider_birth_year', 'rider_gender', 'rider_member_or_casual', 'source_file_id', 'duration_seconds', 'distance_m',
+]
+# Inclusive range filters on the stored ride metrics, see CityBikeApp.ride_metrics
+RANGE_FILTERS = {
+    'min_duration': 'duration_seconds__gte',
+    'max_duration': 'duration_seconds__lte',
+    'min_distance': 'distance_m__gte',
+    'max_distance': 'distance_m__lte',
+}
+EXPORT_CHUNK_SIZE = 2000  # Rows fetched from the db cursor at a time while exporting
+MAX_NEARBY_STATIONS = 100  # Largest k of stations/nearby
+
+
+def parse_timestamp(value):
+    """
+    Parses an ISO 8601 date or datetime query parameter into an aware datetime.
+    Naive values are read in the default time zone.
+    """
+    parsed = parse_datetime(value)
+    if parsed is None:
+        date = parse_date(value)
+        if date is None:
+            raise ValueError(f"'{value}' is not an ISO 8601 date or datetime")
+        parsed = datetime.combine(date, time.min)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def filter_rides(params, rides=None):
+    """
+    Applies the ride filters shared by the API views.
+
+    Parameters:
+    - params (QueryDict): The query parameters. Supported are start and end (started_at, end exclusive),
+      station (start or end station), start_station, end_station, source_file (ProcessedFile name),
+      min_duration and max_duration (seconds), min_distance and max_distance (meters).
+    - rides (QuerySet): The rides to filter, all rides by default.
+
+    Returns:
+    - QuerySet: The filtered rides. Raises ValueError for malformed parameters.
+    """
+    rides = Ride.objects.all() if rides is None else rides
+    if params.get('start'):
+        rides = rides.filter(started_at__gte=parse_timestamp(params['start']))
+    if params.get('end'):
+        rides = rides.filter(started_at__lt=parse_timestamp(params['end']))
+    for param in ('station', 'start_station', 'end_station'):
+        if not params.get(param):
+            continue
+        try:
+            station_id = int(params[param])
+        except ValueError:
+            raise ValueError(f"{param} must be a station id")
+        if param == 'station':
+            rides = rides.filter(Q(start_station_id=station_id) | Q(end_station_id=station_id))
+        else:
+            rides = rides.filter(**{f"{param}_id": station_id})
+    if params.get('source_file'):
+        rides = rides.filter(source_file__file_name=params['source_file'])
+    for param, lookup in RANGE_FILTERS.items():
+        if not params.get(param):
+            continue
+        try:
+            rides = rides.filter(**{lookup: int(params[param])})
+        except ValueError:
+            raise ValueError(f"{param} must be a whole number")
+    return rides
+
+
+class Echo:
+    """
+    A file-like object that hands back what is written to it, for streaming csv.writer output.
+    """
+    def write(self, value):
+        return value
+
+
+@require_GET
+@cached_api_view
+def export_rides(request):
+    """
+    Streams the rides matching the filter_rides parameters as NDJSON (format=ndjson, the default) or CSV (format=csv).
+    Rows are read from a server-side iterator as tuples, so memory stays flat however many rides match.
+    """
+    export_format = request.GET.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'csv'):
+        return JsonResponse({'error': "format must be ndjson or csv"}, status=400)
+    try:
+        rides = filter_rides(request.GET)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    rows = rides.order_by('ride_id').values_list(*EXPORT_FIELDS).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    if export_format == 'csv':
+        writer = csv.writer(Echo())
+        lines = (writer.writerow([value.isoformat() if isinstance(value, datetime) else value for value in row])
+                 for row in rows)
+        response = StreamingHttpResponse(
+            itertools.chain([writer.writerow(EXPORT_FIELDS)], lines), content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="rides.csv"'
+        return response
+
+    encoder = json.JSONEncoder(default=lambda value: value.isoformat())
+    lines = (encoder.encode(dict(zip(EXPORT_FIELDS, row))) + "\n" for row in rows)
+    return StreamingHttpResponse(lines, content_type='application/x-ndjson')
+
+
+@require_GET
+@cached_api_view
+def od_matrix(request):
+    """
+    Returns the origin-destination matrix of the rides matching the filter_rides parameters:
+    the number of rides per (start station, end station) pair, as sparse triplets.
+    format=json (the default) gives {"triplets": [[start, end, rides], ...]}, format=npy the same
+    triplets as an int64 array of shape (n, 3) in NumPy's .npy format.
+
+    The matrix comes from one GROUP BY over the ride_od_time_idx index, cached_api_view keeps it until a file is loaded.
+    """
+    response_format = request.GET.get('format', 'json')
+    if response_format not in ('json', 'npy'):
+        return JsonResponse({'error': "format must be json or npy"}, status=400)
+    if response_format == 'npy' and np is None:
+        return JsonResponse({'error': "format=npy needs numpy installed on the server"}, status=400)
+    try:
+        rides = filter_rides(request.GET)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    triplets = [list(row) for row in (
+        rides.filter(start_station__isnull=False, end_station__isnull=False)
+        .values_list('start_station_id', 'end_station_id').annotate(rides=Count('ride_id'))
+        .order_by('start_station_id', 'end_station_id'))]
+
+    if response_format == 'npy':
+        buffer = io.BytesIO()
+        np.save(buffer, np.array(triplets, dtype=np.int64).reshape(-1, 3))
+        return HttpResponse(buffer.getvalue(), content_type='application/octet-stream')
+    return JsonResponse({'triplets': triplets})
+
+
+def parse_coordinates(params, names):
+    """
+    Reads coordinate query parameters, all of them required. Names containing "lat" are latitudes,
+    the others longitudes.
+
+    Returns:
+    - list of float: The values in the order of names.
+
+    Raises:
+    - ValueError: If one is missing, not a number or out of range.
+    """
+    values = []
+    for name in names:
+        try:
+            value = float(params[name])
+        except KeyError:
+            raise ValueError(f"{name} is required")
+        except ValueError:
+            raise ValueError(f"{name} must be a number")
+        limit = 90 if 'lat' in name else 180
+        if not math.isfinite(value) or not -limit <= value <= limit:
+            raise ValueError(f"{name} must be between -{limit} and {limit}")
+        values.append(value)
+    return values
+
+
+def station_json(station, distance=None):
+    station_id, station_name, lat, lon = station
+    data = {'station_id': station_id, 'station_name': station_name, 'lat': lat, 'lon': lon}
+    if distance is not None:
+        data['distance_m'] = round(distance, 1)
+    return data
+
+
+@require_GET
+def stations_nearby(request):
+    """
+    Returns the k (10 by default) stations nearest to lat/lon, nearest first, from the station grid index.
+    """
+    try:
+        lat, lon = parse_coordinates(request.GET, ['lat', 'lon'])
+        k = int(request.GET.get('k', 10))
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    if not 1 <= k <= MAX_NEARBY_STATIONS:
+        return JsonResponse({'error': f"k must be between 1 and {MAX_NEARBY_STATIONS}"}, status=400)
+
+    nearest = get_station_grid().nearest(lat, lon, k)
+    return JsonResponse({'stations': [station_json(station, distance) for distance, station in nearest]})
+
+
+@require_GET
+def stations_bbox(request):
+    """
+    Returns the stations inside min_lat/min_lon/max_lat/max_lon, by station id, from the station grid index.
+    """
+    try:
+        min_lat, min_lon, max_lat, max_lon = parse_coordinates(request.GET, ['min_lat', 'min_lon', 'max_lat', 'max_lon'])
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    if min_lat > max_lat or min_lon > max_lon:
+        return JsonResponse({'error': "min_lat and min_lon must not be above max_lat and max_lon"}, status=400)
+
+    stations = get_station_grid().bbox(min_lat, min_lon, max_lat, max_lon)
+    return JsonResponse({'stations': [station_json(station) for station in stations]})
+
+
+class RideListView(generics.ListAPIView):
+    """
+    Lists rides matching the filter_rides parameters, ordered by start time, with keyset pagination.
+    """
+    serializer_class = RideSerializer
+    pagination_class = RideKeysetPagination
+
+    def get_queryset(self):
+        rides = Ride.objects.select_related('start_station', 'end_station', 'bike')
+        try:
+            return filter_rides(self.request.query_params, rides)
+        except ValueError as e:
+            raise ValidationError({'error': str(e)})
@@ -3,6 +3,7 @@ import shutil
 import os
 import tempfile
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
 from datetime import datetime
 import json
@@ -11,25 +12,227 @@ import zipfile
 import django
 import os
 import csv
+import io
+import itertools
+import math
+import re
+import argparse
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import ExitStack, contextmanager, nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from email.utils import format_datetime
 from datetime import datetime
 import django
 from django.conf import settings
-from django.db.models import Max
+from django.db import DEFAULT_DB_ALIAS, connection, connections, models, transaction
+from django.db.models import Exists, Max, OuterRef, Subquery
+from django.utils import timezone
+
+try:
+    import resource
+except ImportError:  # Not available on Windows, peak memory is reported as None there
+    resource = None
+
+try:
+    import numpy as np
+    import pandas as pd
+except ImportError:  # pandas is optional, without it rows are parsed one dict at a time
+    np = None
+    pd = None
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'CityBikesProject.settings')
 django.setup()
 
-from CityBikeApp.models import ProcessedFile, ProcessingFile, Station, Bike, Ride
+from CityBikeApp.archive import archive_processed_file
+from CityBikeApp.models import ProcessedFile, ProcessingFile, Station, Bike, Ride, StagedRide
+from CityBikeApp.profiling import QueryProfiler
+from CityBikeApp.ride_metrics import add_ride_metrics
+from CityBikeApp.rollups import replace_station_day_counts, update_station_daily_stats
+from CityBikeApp.station_index import build_segment
+from CityBikeApp.stations import StationResolver
 
 
-logging.basicConfig(level=logging.DEBUG,
-                    format='%(asctime)s - %(levelname)s - %(message)s',
-                    filename='citybike_data_import.log',
-                    filemode='w')
 logger = logging.getLogger("IMPORT")
 
 PROCESSING_DIR = "/Users/joeyhoward/Desktop/CityBikeData/Processing"
 PROCESSED_DIR = "/Users/joeyhoward/Desktop/CityBikeData/Processed"
+DOWNLOAD_DIR = "/Users/joeyhoward/Desktop/CityBikeData/Downloads"
+ARCHIVE_DIR = "/Users/joeyhoward/Desktop/CityBikeData/Archive"  # Parquet copy of the loaded rides, see CityBikeApp.archive
+STATION_INDEX_DIR = "/Users/joeyhoward/Desktop/CityBikeData/StationIndex"  # See CityBikeApp.station_index
+DOWNLOAD_WORKERS = 4  # Number of zip files downloaded at once
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # Bytes written per read of a download
+ZIP_MEMBER_SEPARATOR = "!/"  # Separates the zip path and the member name in the file_path of a streamed file
+CHUNK_SIZE = 10000  # Number of csv rows held in memory and inserted at a time
+PARALLEL_RANGE_SIZE = 16 * 1024 * 1024  # Bytes of a csv parsed by one worker task
+LOG_FILE = 'citybike_data_import.log'
+
+# Date formats seen in the tripdata files, tried in order when detecting the format of a file
+DATE_FORMATS = [
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%d %H:%M:%S.%f',
+    '%m/%d/%Y %H:%M:%S',
+    '%m/%d/%Y %H:%M',
+    '%Y-%m-%d %H:%M',
+]
+DATE_SAMPLE_SIZE = 100  # Number of rows sampled to detect the date format of a file
+
+# Column renames applied by the columnar parser, the same mapping parse_row does one row at a time
+OLD_FORMAT_COLUMNS = {
+    'start station id': 'start_station_id',
+    'start station name': 'start_station_name',
+    'start station latitude': 'start_station_lat',
+    'start station longitude': 'start_station_lon',
+    'end station id': 'end_station_id',
+    'end station name': 'end_station_name',
+    'end station latitude': 'end_station_lat',
+    'end station longitude': 'end_station_lon',
+    'bikeid': 'bike_id',
+    'birth year': 'rider_birth_year',
+    'gender': 'rider_gender',
+    'starttime': 'started_at',
+    'stoptime': 'ended_at',
+    'usertype': 'rider_member_or_casual',
+}
+NEW_FORMAT_COLUMNS = {
+    'rideable_type': 'bike_type',
+    'start_lat': 'start_station_lat',
+    'start_lng': 'start_station_lon',
+    'end_lat': 'end_station_lat',
+    'end_lng': 'end_station_lon',
+    'member_casual': 'rider_member_or_casual',
+}
+# Values of the parsed fields a file format has no column for
+OLD_FORMAT_DEFAULTS = {
+    'start_station_name': 'unknown',
+    'end_station_name': 'unknown',
+    'bike_type': 'unknown',
+    'rider_member_or_casual': 'unknown',
+}
+NEW_FORMAT_DEFAULTS = {
+    'rider_birth_year': 0,
+    'rider_gender': 0,
+}
+# Connection settings of the SQLite bulk-load mode, restored once step 4.0 is done
+BULK_LOAD_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -262144,  # Negative values are in KiB, so 256 MB
+    'temp_store': 'MEMORY',
+}
+MAX_BATCH_SIZE = 500  # Rows per INSERT, past this larger statements stop paying off
+
+NUMBER_PATTERN = r'[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?'
+
+# Keys of a ride dict, in the order load_rows builds them from parsed columns
+RIDE_KEYS = (
+    'ride_id', 'started_at', 'ended_at', 'start_station_id', 'end_station_id', 'bike_id',
+    'rider_birth_year', 'rider_gender', 'rider_member_or_casual', 'source_file_id',
+)
+
+# The new format has no bike ids, so rides share one placeholder Bike per bike type
+BIKE_TYPE_MAP = {
+    'electric_bike': 'electric',
+    'classic_bike': 'classic',
+    'docked_bike': 'classic',
+}
+PLACEHOLDER_BIKE_IDS = {'electric': -1, 'classic': -2, 'unknown': -3}
+ROW_LOG_SAMPLE_RATE = 1000  # One row in this many is logged, raw and parsed, when DEBUG logging is on
+
+
+def peak_rss_mb():
+    """
+    Returns:
+    - float or None: The peak resident memory of this process so far in MB, None where it cannot be read.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+class RunReport:
+    """
+    Collects the wall time, db queries and peak memory of each step and each file of an import run,
+    along with run wide counters such as bytes downloaded, rows parsed and inserted, and dimension cache lookups.
+    """
+    def __init__(self):
+        self.started_at = timezone.now()
+        self.start_time = time.perf_counter()
+        self.steps = {}
+        self.files = {}
+        self.counters = Counter()
+        self.query_profile = None  # QueryProfiler.as_dict of step 4.0, when the import profiles its queries
+        self.lock = threading.Lock()  # Downloads count their bytes from several threads
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    @contextmanager
+    def measure(self, section, name):
+        """
+        Times a block and counts the queries it issues on the db connection of this thread.
+
+        Parameters:
+        - section (dict): self.steps or self.files.
+        - name (str): The step or file the block is for.
+
+        Yields:
+        - dict: The record of the block in section, for adding details to.
+        """
+        record = section.setdefault(name, {})
+        profiler = QueryProfiler(top=0)
+        start_time = time.perf_counter()
+        try:
+            with profiler:
+                yield record
+        finally:
+            record['seconds'] = round(time.perf_counter() - start_time, 3)
+            record['queries'] = profiler.count
+            record['sql_seconds'] = round(profiler.seconds, 3)
+            record['peak_rss_mb'] = peak_rss_mb()
+
+    def as_dict(self):
+        counters = dict(self.counters)
+        cache_hit_rates = {}
+        for dimension in ('station', 'bike'):
+            lookups = counters.get(f"{dimension}_lookups", 0)
+            if lookups:
+                cache_hit_rates[dimension] = round(1 - counters.get(f"{dimension}_cache_misses", 0) / lookups, 4)
+        return {
+            'started_at': self.started_at.isoformat(),
+            'seconds': round(time.perf_counter() - self.start_time, 3),
+            'peak_rss_mb': peak_rss_mb(),
+            'counters': counters,
+            'cache_hit_rates': cache_hit_rates,
+            'steps': self.steps,
+            'files': self.files,
+            'query_profile': self.query_profile,
+        }
+
+    def write(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.as_dict(), file, indent=2)
+
+class ParsedColumns:
+    """
+    A chunk of rows as the columnar parser returns it: one list per field, with the keys of parse_row.
+    load_rows builds the rides straight from the lists instead of going through one dict per parsed row.
+    """
+    def __init__(self, columns):
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns['started_at'])
+
+    def chunks(self, chunk_size):
+        for start in range(0, len(self), chunk_size):
+            yield ParsedColumns({field: values[start:start + chunk_size] for field, values in self.columns.items()})
 
 ##########################################################################
 #                                                                        #
@@ -46,8 +249,12 @@ PROCESSED_DIR = "/Users/joeyhoward/Desktop/CityBikeData/Processed"
 #      1.1 Get all the file names from the target URL ending in .zip     #
 #                                                                        #
 #  2.0 Extract and organize all files in zip files                       #
+#      Skip zip files whose csv files are already loaded unchanged       #
+#      Download the zip files, several at once, resuming partial ones    #
+#      and skipping ones already downloaded                              #
 #      For each file in the list:                                        #
 #      2.1 Unzip the file in a temporary directory                       #
+#          (or, streaming from zip, only list the csv files in the zip)  #
 #      2.2 Move all the files to the processing directory                #
 #      2.3 Record files in processing dir to be added to db later        #
 #      2.4 Clean up the temporary directory                              #
@@ -60,14 +267,23 @@ PROCESSED_DIR = "/Users/joeyhoward/Desktop/CityBikeData/Processed"
 #                                                                        #
 #  4.0 Extract and Load data into the database                           #
 #      For every file Processing Dir:                                    #
-#      4.1 Pull out the rows                                             #              
-#      4.2 Normalize the data in the rows                                #    
-#      4.3 Bulk Insert that data into the DB                             #
+#      4.1 Stream the rows out of the file in chunks                     #
+#      4.2 Normalize the data in each chunk                              #
+#          (stations are resolved by their code, see StationResolver)    #
+#          (and each ride gets its duration and distance)                #
+#      4.3 Bulk Insert that chunk into the DB before reading the next    #
+#          and add it to the StationDailyStats rollup                    #
+#          (a file loaded before is staged instead, and its new rides    #
+#          replace the old ones in one transaction once it is loaded)    #
+#          (and write its rides to the Parquet archive, with --archive)  #
+#          (and compile its station index segment, with --station-index) #
 #      4.4 Move File from Processing to Processed                        #
 #      4.5 Create db Record of ProcessedFile                             #
 #      4.6 Delete db record of ProcessingFile                            #
 #      4.2 Move file to the processed directory                          #
 #                                                                        #
+#  Every step and file is timed into a RunReport, see report_path      #
+#                                                                        #
 #  Author: Joseph Howard                                                 #
 #  Date: April 12, 2024                                                  #
 #                                                                        #
@@ -75,18 +291,63 @@ PROCESSED_DIR = "/Users/joeyhoward/Desktop/CityBikeData/Processed"
 
 
 class CityBikeDataImport:
-    def __init__(self):
+    def __init__(self, workers=1, columnar=False, bulk_load=False, ride_writer='orm', stream_from_zip=False,
+                 report_path=None, profile_queries=False, archive=False, station_index=False):
+        self.workers = workers  # Number of processes parsing files in step 4.0
+        # Read csv files straight out of the downloaded zip files rather than extracting them
+        self.stream_from_zip = stream_from_zip
+        self.bulk_load = bulk_load  # Tune the SQLite connection for step 4.0, see bulk_load_mode
+        # 'orm' inserts rides with bulk_create, 'raw' with executemany (COPY on PostgreSQL)
+        self.ride_writer = ride_writer
+        # Timings and counters of the run, written as JSON to report_path (if set) when execute finishes
+        self.report = RunReport()
+        self.report_path = report_path
+        # Also write the rides of every loaded file to the Parquet archive in ARCHIVE_DIR (needs pyarrow)
+        self.archive = archive
+        # Also compile the departures of every loaded file into the station index in STATION_INDEX_DIR (needs numpy)
+        self.station_index = station_index
+        # Keep the slowest statements of step 4.0 and their query plans in the report, see QueryProfiler
+        self.profile_queries = profile_queries
+        # Rides inserted and seconds spent inserting them for the current file
+        self.rides_inserted = 0
+        self.insert_seconds = 0.0
+        # Parse chunks as pandas columns (needs pandas) instead of one dict per row. Opt-in until
+        # benchmark_import shows it ahead of the row parser
+        self.columnar = columnar and pd is not None
+        if columnar and pd is None:
+            logger.warning("pandas is not installed, parsing one row at a time")
         self.target_base_url = 'https://s3.amazonaws.com/tripdata/'
         self.api_base_url = "http://127.0.0.1:8000/api/"
         logger.info(
             f"Initialized CityBikeDataImport with base URL: {self.target_base_url}")
+        # The model rides are inserted into, StagedRide while a file loaded before is reloaded
+        self.ride_model = Ride
+        # Resolves station codes to Stations and the ids of the Bikes already in the db, see preload_dimensions
+        self.station_resolver = None
+        self.known_bike_ids = None
 
     def execute(self):
+        """
+        Runs steps 1.0 to 4.0 and then logs the run report and writes it to report_path,
+        also when a step fails.
+        """
+        try:
+            self.execute_steps()
+        finally:
+            report = self.report.as_dict()
+            logger.info(f"Run report: {json.dumps(report)}")
+            if self.report_path:
+                self.report.write(self.report_path)
+                logger.info(f"Wrote the run report to {self.report_path}")
+
+    def execute_steps(self):
         # 1.0 "Collect list of files from the target URL"
         try:
             logger.info(
                 f"Starting 1.0 Getting file names from {self.target_base_url}")
-            files = self.get_files_from_web()
+            with self.report.measure(self.report.steps, '1.0'):
+                files = self.get_files_from_web()
+            self.report.count('zip_files_listed', len(files))
             if len(files) == 0:
                 logger.error("No files found. Exiting.")
                 return
@@ -101,22 +362,34 @@ class CityBikeDataImport:
         try:
             logger.info(
                 "Starting 2.0 Putting files in the processing directory")
+            step_report = ExitStack()
+            step_report.enter_context(self.report.measure(self.report.steps, '2.0'))
             counter = 0  # MOD Counter to limit the number of files processed
             files_to_process = []
+            files_to_download = []
             for zip_file in files:
                 counter += 1  # MOD Counter to limit the number of files processed
                 if counter % 3 == 0:  # MOD Limit the number of files processed
                     continue  # MOD Counter to limit the number of files processed
                 if counter > 14:  # MOD Counter to limit the number of files processed
                     break  # MOD Counter to limit the number of files processed
+                files_to_download.append(zip_file)
+            files_to_download = self.filter_unchanged_archives(files_to_download)
 
+            for zip_file, local_zip_path in self.download_files(files_to_download):
                 logger.info(f"Processing {zip_file['filename']}")
-                extracted_files = self.extract_and_organize_files(zip_file)
+                if self.stream_from_zip:
+                    extracted_files = self.list_zip_members(zip_file, local_zip_path)
+                else:
+                    extracted_files = self.extract_and_organize_files(zip_file, local_zip_path)
                 files_to_process.extend(extracted_files)
             self.add_files_to_ProcessingFile(files_to_process)
+            step_report.close()
+            self.report.count('files_extracted', len(files_to_process))
             logger.info("Ending 2.0 All files in the processing directory")
         except Exception as e:
             self.add_files_to_ProcessingFile(files_to_process)
+            step_report.close()
             logger.error("Failed to process files")
             logger.error(e)
             return
@@ -125,9 +398,12 @@ class CityBikeDataImport:
         try:
             logger.info(
                 "Starting 3.0 Filtering out files that are already downloaded")
-            files_to_delete = self.get_processed_files()
-            if len(files_to_delete) > 0:
-                self.delete_files_and_records(files_to_delete)
+            with self.report.measure(self.report.steps, '3.0'):
+                files_to_delete = self.get_processed_files()
+                self.record_parent_zip_names()
+                if len(files_to_delete) > 0:
+                    self.delete_files_and_records(files_to_delete)
+            self.report.count('files_already_loaded', len(files_to_delete))
             logger.info(
                 "Ending 3.0 Filtered out files that are already downloaded")
         except Exception as e:
@@ -140,7 +416,8 @@ class CityBikeDataImport:
 
         try:
             logger.info("Starting 4.0 Extracting and loading data into the database")
-            self.process_files()
+            with self.report.measure(self.report.steps, '4.0'):
+                self.process_files()
             logger.info("Ending 4.0 Extracting and loading data into the database")
         except Exception as e:
             logger.error("Failed to extract and load data into the database")
@@ -174,34 +451,113 @@ class CityBikeDataImport:
                 files.append(file_data)
         return files
 
-    def extract_and_organize_files(self, zip_file_attributes):
+    def filter_unchanged_archives(self, zip_files):
         """
-        Extracts a zip file to a temporary directory, moves all extracted files to the specified processing directory,
-        and cleans up the temporary directory.
+        Drops the zip files whose csv files were already loaded from the same version of the zip file,
+        matched on the exact (zip file name, size, last modified) of the listing, so they are not downloaded again.
+        Only completed loads count, the zip file of an interrupted load is downloaded again.
+
+        Parameters:
+        - zip_files (list of dict): File metadata as returned by get_files_from_web.
+
+        Returns:
+        - list of dict: The zip files that are new or changed.
+        """
+        loaded_archives = set(ProcessedFile.objects.filter(
+            parent_zip_name__in=[zip_file['filename'] for zip_file in zip_files], completed=True,
+        ).values_list('parent_zip_name', 'size', 'parent_zip_last_modified'))
+
+        changed_files = []
+        for zip_file in zip_files:
+            last_modified = datetime.fromisoformat(zip_file['last_modified'].replace('Z', '+00:00'))
+            if (zip_file['filename'], int(zip_file['size']), last_modified) in loaded_archives:
+                logger.info(f"Skipped {zip_file['filename']}, its files are already loaded.")
+                self.report.count('zip_files_unchanged')
+                continue
+            changed_files.append(zip_file)
+        return changed_files
+
+    def download_files(self, zip_files):
+        """
+        Downloads zip files from the target URL into the download directory, DOWNLOAD_WORKERS at a time
+        over one pooled session.
 
         Parameters:
-        - zip_file_path (str): The file path for the zip file to extract.
-        - processing_dir (str): The directory to move extracted files to for further processing.
+        - zip_files (list of dict): File metadata as returned by get_files_from_web.
 
         Returns:
-        - list of str: A list of file paths for the files moved to the processing directory.
+        - list of tuple: (file metadata, local zip path) for every file that downloaded, in the order given.
         """
+        os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+        with requests.Session() as session:
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=DOWNLOAD_WORKERS)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+                local_zip_paths = list(executor.map(lambda zip_file: self.download_file(session, zip_file), zip_files))
+
+        return [(zip_file, local_zip_path)
+                for zip_file, local_zip_path in zip(zip_files, local_zip_paths) if local_zip_path]
 
-        zip_file_url = f"{self.target_base_url}{zip_file_attributes['filename']}"
-        local_zip_path = os.path.join(tempfile.gettempdir(), zip_file_attributes['filename'])
+    def download_file(self, session, zip_file_attributes):
+        """
+        Downloads one zip file. A copy whose size and modification time match the listing is kept as is,
+        and a partial download left by an earlier run is resumed with an HTTP Range request.
+
+        Parameters:
+        - session (requests.Session): The session to download with.
+        - zip_file_attributes (dict): File metadata as returned by get_files_from_web.
+
+        Returns:
+        - str or None: The path of the downloaded zip file, None if the download failed.
+        """
+        file_name = zip_file_attributes['filename']
+        local_zip_path = os.path.join(DOWNLOAD_DIR, file_name)
+        partial_zip_path = local_zip_path + ".part"
+        last_modified = datetime.fromisoformat(zip_file_attributes['last_modified'].replace('Z', '+00:00'))
+        size = int(zip_file_attributes['size'])
+
+        if (os.path.exists(local_zip_path) and os.path.getsize(local_zip_path) == size
+                and int(os.path.getmtime(local_zip_path)) == int(last_modified.timestamp())):
+            logger.info(f"Skipped downloading {file_name}, the local copy is up to date.")
+            self.report.count('zip_files_already_downloaded')
+            return local_zip_path
 
-        # Download the file
         try:
-            with requests.get(zip_file_url, stream=True) as r:
+            offset = os.path.getsize(partial_zip_path) if os.path.exists(partial_zip_path) else 0
+            headers = {}
+            if 0 < offset < size:
+                # If-Range makes the server send the whole file again if it changed since the partial download
+                headers = {'Range': f"bytes={offset}-", 'If-Range': format_datetime(last_modified, usegmt=True)}
+
+            with session.get(f"{self.target_base_url}{file_name}", stream=True, headers=headers) as r:
                 r.raise_for_status()
-                with open(local_zip_path, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=8192):
+                mode = 'ab' if r.status_code == 206 else 'wb'
+                with open(partial_zip_path, mode) as f:
+                    for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
                         f.write(chunk)
-            logging.info(f"Downloaded {zip_file_attributes['filename']} successfully.")
-        except requests.RequestException as e:
-            logging.error(
-                f"Failed to download the file {zip_file_attributes['filename']}. Error: {str(e)}")
-            return []
+                        self.report.count('bytes_downloaded', len(chunk))
+
+            os.replace(partial_zip_path, local_zip_path)
+            os.utime(local_zip_path, (last_modified.timestamp(), last_modified.timestamp()))
+            logger.info(f"Downloaded {file_name} successfully{' (resumed)' if mode == 'ab' else ''}.")
+            return local_zip_path
+        except (requests.RequestException, OSError) as e:
+            logger.error(f"Failed to download the file {file_name}, rerun to resume. Error: {str(e)}")
+            return None
+
+    def extract_and_organize_files(self, zip_file_attributes, local_zip_path):
+        """
+        Extracts a downloaded zip file to a temporary directory, moves all extracted files to the processing directory,
+        and cleans up the temporary directory.
+
+        Parameters:
+        - zip_file_attributes (dict): File metadata of the zip file as returned by get_files_from_web.
+        - local_zip_path (str): The file path for the zip file to extract.
+
+        Returns:
+        - list of dict: Metadata of the files moved to the processing directory.
+        """
 
         extracted_files = []
         first_file_found = False  # MOD Flag to indicate if at least one file has been processed
@@ -222,7 +578,7 @@ class CityBikeDataImport:
                                     PROCESSING_DIR, file)
                                 shutil.move(temp_file_path,
                                             processing_file_path)
-                                extracted_files.append({'filename':file, 'size':zip_file_attributes['size'], 'last_modified':zip_file_attributes['last_modified']})
+                                extracted_files.append({'filename':file, 'size':zip_file_attributes['size'], 'last_modified':zip_file_attributes['last_modified'], 'parent_zip_name':zip_file_attributes['filename']})
                                 first_file_found = True  # MOD Set the flag after moving the first file
                                 break  # MOD Only process the first file in the directory
                     if first_file_found:
@@ -233,6 +589,36 @@ class CityBikeDataImport:
         logger.debug(f"Moved {len(extracted_files)} files to {PROCESSING_DIR}")
         return extracted_files
 
+    def list_zip_members(self, zip_file_attributes, local_zip_path):
+        """
+        Lists the csv files in a downloaded zip file so they can be streamed out of it in step 4.0,
+        without extracting them to disk.
+
+        Parameters:
+        - zip_file_attributes (dict): File metadata of the zip file as returned by get_files_from_web.
+        - local_zip_path (str): The file path of the zip file.
+
+        Returns:
+        - list of dict: Metadata of the csv files, their file_path points into the zip file.
+        """
+        member_files = []
+        with zipfile.ZipFile(local_zip_path, 'r') as zip_ref:
+            for member in zip_ref.namelist():
+                file = os.path.basename(member)
+                if file.startswith('.') or not file.endswith('.csv') or member.startswith('__MACOSX'):
+                    continue
+                member_files.append({
+                    'filename': file,
+                    'file_path': f"{local_zip_path}{ZIP_MEMBER_SEPARATOR}{member}",
+                    'size': zip_file_attributes['size'],
+                    'last_modified': zip_file_attributes['last_modified'],
+                    'parent_zip_name': zip_file_attributes['filename']
+                })
+                break  # MOD Only process the first file in the zip, as extract_and_organize_files does
+
+        logger.debug(f"Found {len(member_files)} files to stream from {zip_file_attributes['filename']}")
+        return member_files
+
     def add_files_to_ProcessingFile(self, file_details):
         processing_files = []
         for detail in file_details:
@@ -241,7 +627,8 @@ class CityBikeDataImport:
                     detail['last_modified'].replace('Z', '+00:00'))
                 processing_file = ProcessingFile(
                     file_name=detail['filename'],
-                    file_path=PROCESSING_DIR + detail['filename'],
+                    file_path=detail.get('file_path', PROCESSING_DIR + detail['filename']),
+                    parent_zip_name=detail.get('parent_zip_name', ''),
                     parent_zip_last_modified=last_modified,
                     size=detail['size'],
                     number_of_rows=0
@@ -263,23 +650,47 @@ class CityBikeDataImport:
 
     def get_processed_files(self):
         """
-        Retrieves a list of filenames from the ProcessingFile table that exist in the ProcessedFile table.
+        Retrieves a list of filenames from the ProcessingFile table that exist in the ProcessedFile table
+        with the same (file_name, size, parent_zip_last_modified), in one correlated EXISTS query.
+        Files whose load did not complete are not matched, so step 4.0 loads them again.
         """
-        matched_files = ProcessingFile.objects.filter(
-            file_name__in=ProcessedFile.objects.values_list('file_name', flat=True),
-            size__in=ProcessedFile.objects.values_list('size', flat=True),
-            parent_zip_last_modified__in=ProcessedFile.objects.values_list(
-                'parent_zip_last_modified', flat=True)
-        ).values_list('file_name', flat=True)
+        matched_files = ProcessingFile.objects.filter(Exists(ProcessedFile.objects.filter(
+            file_name=OuterRef('file_name'),
+            size=OuterRef('size'),
+            parent_zip_last_modified=OuterRef('parent_zip_last_modified'),
+            completed=True,
+        ))).values_list('file_name', flat=True)
 
         return list(matched_files)
 
+    def record_parent_zip_names(self):
+        """
+        Fills in the parent_zip_name of completed ProcessedFiles loaded before it was recorded, from the
+        ProcessingFile that get_processed_files matches them with, so filter_unchanged_archives skips their
+        zip file from the next run on. The size and last modified they are matched on are the zip file's already.
+
+        Returns:
+        - int: The number of ProcessedFiles updated.
+        """
+        matching_files = ProcessingFile.objects.filter(
+            file_name=OuterRef('file_name'),
+            size=OuterRef('size'),
+            parent_zip_last_modified=OuterRef('parent_zip_last_modified'),
+        ).exclude(parent_zip_name='')
+        updated = ProcessedFile.objects.filter(parent_zip_name='', completed=True).filter(
+            Exists(matching_files)).update(parent_zip_name=Subquery(matching_files.values('parent_zip_name')[:1]))
+        if updated:
+            logger.info(f"Recorded the zip file of {updated} file(s) loaded before zip files were recorded.")
+        return updated
+
     def delete_files_and_records(self, files_to_delete):
         """
         Deletes files in the processing directory that are already in the database and their corresponding records.
         """
         for file in files_to_delete:
             file_path = os.path.join(PROCESSING_DIR, file)
+            if not os.path.exists(file_path):
+                continue  # Streamed from a zip file, nothing was extracted
             try:
                 os.remove(file_path)
                 logger.info(f"Deleted {file} from the processing directory.")
@@ -297,30 +708,280 @@ class CityBikeDataImport:
                 "Failed to delete records from the ProcessingFile model. DELETE FILES IN PROCESSED AND RECORDS IN ProcessingFiles then RERUN.")
             logger.error(e)
 
-    def process_files(self):
+    def process_files(self, range_size=PARALLEL_RANGE_SIZE):
+        self.preload_dimensions()
         files = sorted(
             [os.path.join(PROCESSING_DIR, f) for f in os.listdir(PROCESSING_DIR)],
             key=lambda x: os.path.getmtime(x),
             reverse=True  # Youngest files first
         ) 
+        file_names = [os.path.basename(file_path) for file_path in files]
+        file_names = [f for f in file_names if f.endswith('.csv') and not f.startswith('._')]
+        # Files that stay inside their downloaded zip file, see list_zip_members
+        zip_member_names = list(
+            ProcessingFile.objects.filter(file_path__contains=ZIP_MEMBER_SEPARATOR)
+            .exclude(file_name__in=file_names).values_list('file_name', flat=True))
 
-        for file_path in files:
-            file_name = os.path.basename(file_path)
-            if file_name.endswith('.csv') and not file_name.startswith('._'):
+        profiler = QueryProfiler() if self.profile_queries else nullcontext()
+        with self.bulk_load_mode(), profiler:
+            if self.workers > 1:
+                # A compressed member cannot be split into byte ranges, so those load serially
+                self.process_files_in_parallel(file_names, range_size)
+                file_names = []
+
+            for file_name in file_names + zip_member_names:
                 self.process_file(file_name)
-            
+        if self.profile_queries:
+            self.report.query_profile = profiler.as_dict()
+
+    @contextmanager
+    def bulk_load_mode(self):
+        """
+        Switches the SQLite connection to the BULK_LOAD_PRAGMAS and lets bulk_create use every
+        variable SQLite allows per statement, rather than Django's assumed 999.
+        The previous settings are restored on exit. Does nothing unless bulk_load is set or on other databases.
+        """
+        if not self.bulk_load or connection.vendor != 'sqlite':
+            yield
+            return
+        if connection.in_atomic_block:
+            logger.warning("Bulk-load mode skipped, SQLite settings cannot change inside a transaction")
+            yield
+            return
+
+        previous_pragmas = {}
+        with connection.cursor() as cursor:
+            for pragma, value in BULK_LOAD_PRAGMAS.items():
+                cursor.execute(f"PRAGMA {pragma}")
+                previous_pragmas[pragma] = cursor.fetchone()[0]
+                cursor.execute(f"PRAGMA {pragma} = {value}")
+        previous_max_query_params = connection.features.max_query_params
+        connection.features.max_query_params = self.sqlite_variable_limit()
+        logger.debug(f"Bulk-load mode on, previous settings {previous_pragmas}")
+
+        try:
+            yield
+        finally:
+            connection.features.max_query_params = previous_max_query_params
+            with connection.cursor() as cursor:
+                for pragma, value in previous_pragmas.items():
+                    cursor.execute(f"PRAGMA {pragma} = {value}")
+            logger.debug("Bulk-load mode off")
+
+    def sqlite_variable_limit(self):
+        """
+        Returns:
+        - int: The maximum number of ? parameters in one statement on the SQLite connection.
+        """
+        connection.ensure_connection()
+        if hasattr(connection.connection, 'getlimit'):  # Python 3.11+
+            return connection.connection.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+        return connection.features.max_query_params
 
-    def process_file(self, file_name): 
+    def get_batch_size(self, model):
+        """
+        Returns:
+        - int: How many rows of a model fit in one INSERT under the connection's variable limit,
+          at most MAX_BATCH_SIZE.
+        """
+        batch_size = connection.features.max_query_params // len(model._meta.concrete_fields)
+        return max(1, min(batch_size, MAX_BATCH_SIZE))
+
+    def process_files_in_parallel(self, file_names, range_size=PARALLEL_RANGE_SIZE):
+        """
+        Parses byte ranges of the files in a pool of worker processes while this process does all the inserts.
+        SQLite only allows one writer, so the parsed rows are loaded here in file and range order,
+        which gives the same rows in the same order as process_file.
+
+        Parameters:
+        - file_names (list of str): The files in the processing directory to load, in load order.
+        - range_size (int): The approximate number of bytes parsed by one worker task.
+        """
+        tasks = []
+        for file_name in file_names:
+            file_path = os.path.join(PROCESSING_DIR, file_name)
+            header, ranges = self.split_file(file_path, range_size)
+            with open(file_path, mode='r', encoding='utf-8') as file:
+                date_format = self.detect_date_format(
+                    header, list(itertools.islice(csv.DictReader(file), DATE_SAMPLE_SIZE)))
+            for index, (start, end) in enumerate(ranges):
+                task_args = (file_path, header, start, end, date_format, self.columnar)
+                tasks.append((file_name, task_args, index == 0, index == len(ranges) - 1))
+        logger.debug(f"Parsing {len(file_names)} files as {len(tasks)} ranges with {self.workers} workers")
+
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=init_parse_worker) as executor:
+            # Keep a bounded number of parsed ranges in flight so memory does not grow with the files
+            pending = deque()
+            task_iter = iter(tasks)
+            for task in itertools.islice(task_iter, self.workers * 2):
+                pending.append((task, executor.submit(parse_file_range, *task[1])))
+
+            while pending:
+                task, future = pending.popleft()
+                next_task = next(task_iter, None)
+                if next_task is not None:
+                    pending.append((next_task, executor.submit(parse_file_range, *next_task[1])))
+
+                file_name, _, is_first_range, is_last_range = task
+                if is_first_range:
+                    # A file spans several tasks, so its report is open from its first range to its last
+                    file_report = ExitStack()
+                    file_report.enter_context(self.report.measure(self.report.files, file_name))
+                    processing_file, processed_file = self.create_processed_file_record(file_name)
+                    number_of_rows = 0
+                parsed = future.result()
+                chunks = parsed.chunks(CHUNK_SIZE) if isinstance(parsed, ParsedColumns) else self.read_chunks(iter(parsed))
+                for parsed_rows in chunks:
+                    number_of_rows += self.load_rows(parsed_rows, processed_file)
+                if is_last_range:
+                    self.finish_processed_file(processing_file, processed_file, number_of_rows)
+                    file_report.close()
+
+    def split_file(self, file_path, range_size=PARALLEL_RANGE_SIZE):
+        """
+        Splits the data rows of a csv into byte ranges that start and end on line boundaries.
+        Assumes no quoted field spans more than one line, which holds for the tripdata files.
+
+        Returns:
+        - tuple: The header of the file and a list of (start, end) byte offsets, at least one range per file.
+        """
+        with open(file_path, mode='rb') as file:
+            header = next(csv.reader([file.readline().decode('utf-8')]))
+            start = file.tell()
+            file_size = os.fstat(file.fileno()).st_size
+            ranges = []
+            while start < file_size:
+                file.seek(max(start + range_size - 1, start))
+                file.readline()
+                end = min(file.tell(), file_size)
+                ranges.append((start, end))
+                start = end
+        return header, ranges or [(start, start)]
+
+    def process_file(self, file_name):
+        with self.report.measure(self.report.files, file_name):
+            self.load_file(file_name)
+
+    def load_file(self, file_name):
         # 4.1 Pull out the rows
         logger.debug(f"Pulling out data from {file_name}")
 
-        file_path = os.path.join(PROCESSING_DIR, file_name)
+        processing_file, processed_file = self.create_processed_file_record(file_name)
+
+        number_of_rows = 0
         logger.debug(f"Opening {file_name} to parse and upload")
-        with open(file_path, mode='r', encoding='utf-8') as file:
-            reader = csv.DictReader(file)
-            header = reader.fieldnames
-            rows = list(reader)[:2]  ## MOD Read only the first 2 records for processing
-            self.normalize_rows(header, rows, file_path)
+        with self.open_file(processing_file) as file:
+            if self.columnar:
+                chunks = pd.read_csv(file, dtype=str, na_filter=False, chunksize=CHUNK_SIZE)
+            else:
+                reader = csv.DictReader(file)
+                chunks = self.read_chunks(reader)
+            date_format = None
+            for rows in chunks:
+                header = list(rows.columns) if self.columnar else reader.fieldnames
+                if date_format is None:
+                    date_format = self.detect_date_format(header, rows)
+                self.normalize_rows(header, rows, processed_file, date_format)
+                number_of_rows += len(rows)
+
+        self.finish_processed_file(processing_file, processed_file, number_of_rows)
+
+    @contextmanager
+    def open_file(self, processing_file):
+        """
+        Opens a file to load as text, from the processing directory or streamed out of its zip file.
+        Newlines are left to the csv reader, so a line break inside a quoted field stays as it is in the file.
+        """
+        zip_path, separator, member = processing_file.file_path.partition(ZIP_MEMBER_SEPARATOR)
+        if separator:
+            with zipfile.ZipFile(zip_path, 'r') as zip_ref, zip_ref.open(member) as member_file:
+                yield io.TextIOWrapper(member_file, encoding='utf-8', newline='')
+        else:
+            file_path = os.path.join(PROCESSING_DIR, processing_file.file_name)
+            with open(file_path, mode='r', encoding='utf-8', newline='') as file:
+                yield file
+
+    def read_chunks(self, reader, chunk_size=None):
+        """
+        Lazily pulls rows out of a csv reader so only one chunk is held in memory at a time.
+
+        Parameters:
+        - reader (csv.DictReader): The reader to pull rows from.
+        - chunk_size (int): The maximum number of rows in each chunk, CHUNK_SIZE by default.
+
+        Returns:
+        - generator of list of dict: The rows of the file, chunk_size rows at a time.
+        """
+        chunk_size = chunk_size or CHUNK_SIZE
+        while True:
+            chunk = list(itertools.islice(reader, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+    def detect_date_format(self, header, rows):
+        """
+        Finds the first of DATE_FORMATS that parses every start and end time in a sample of rows.
+
+        Parameters:
+        - header (list of str): The header of the file, which tells the old and new format apart.
+        - rows (list of dict): Rows of the file, only the first DATE_SAMPLE_SIZE are looked at.
+
+        Returns:
+        - str or None: The strptime format, None if no format matches the sample.
+        """
+        date_columns = ("starttime", "stoptime") if "tripduration" in header else ("started_at", "ended_at")
+        if pd is not None and isinstance(rows, pd.DataFrame):
+            rows = rows.head(DATE_SAMPLE_SIZE).to_dict('records')
+        samples = [row.get(column) for row in rows[:DATE_SAMPLE_SIZE] for column in date_columns]
+        samples = [sample for sample in samples if sample]
+        for date_format in DATE_FORMATS:
+            try:
+                for sample in samples:
+                    datetime.strptime(sample, date_format)
+            except ValueError:
+                continue
+            logger.debug(f"Detected date format {date_format}")
+            return date_format
+        logger.debug("No date format matched, falling back to dateutil")
+        return None
+
+    def convert_dates(self, date_strs, date_format=None):
+        """
+        Parses a column of date strings with one fixed format. Values that do not match it
+        fall back to convert_date. Naive datetimes are made aware in the default time zone,
+        which is what Django would otherwise do for every ride on save.
+
+        Parameters:
+        - date_strs (list of str): The column to parse.
+        - date_format (str): A strptime format, usually from detect_date_format.
+
+        Returns:
+        - list of datetime: The parsed dates, None where a value could not be parsed.
+        """
+        default_timezone = timezone.get_default_timezone()
+        dates = [None] * len(date_strs)
+        if date_format and pd is not None and date_strs:
+            parsed = pd.to_datetime(pd.Series(date_strs, dtype=object), format=date_format, errors='coerce')
+            parsed = parsed.dt.tz_localize(default_timezone, ambiguous='NaT', nonexistent='NaT')
+            is_parsed = parsed.notna().to_numpy()
+            for index, date in enumerate(pd.DatetimeIndex(parsed).to_pydatetime()):
+                if is_parsed[index]:
+                    dates[index] = date
+        elif date_format:
+            for index, date_str in enumerate(date_strs):
+                try:
+                    dates[index] = datetime.strptime(date_str, date_format).replace(tzinfo=default_timezone)
+                except (TypeError, ValueError):
+                    pass
+
+        for index, date in enumerate(dates):
+            if date is None and date_strs[index]:
+                date = self.convert_date(date_strs[index])
+                if date is not None and timezone.is_naive(date):
+                    date = date.replace(tzinfo=default_timezone)
+                dates[index] = date
+        return dates
 
     def convert_date(self, date_str):
         try:
@@ -329,17 +990,26 @@ class CityBikeDataImport:
             # Return the datetime object
             return dt
         except ValueError:
-            print(f"Error parsing date: {date_str}")
+            logger.warning(f"Error parsing date: {date_str}")
             return None
 
-    def parse_row(self, row, is_old_format):
+    def convert_int(self, value, default=0):
+        """
+        Returns:
+        - int: The number in a file's value truncated like parse_frame does, default if the value is blank,
+          \\N or not a finite number.
+        """
+        if value is None or not re.fullmatch(NUMBER_PATTERN, str(value)):
+            return default
+        number = float(value)
+        return int(number) if math.isfinite(number) else default
+
+    def parse_row(self, row, is_old_format, parse_dates=True):
         if is_old_format:
-            if row.get("birth year") == "\\N":
-                row["birth year"] = 0
             row_data = {
                 'ride_id': row.get("ride_id"),
-                'start_station_id': row.get("start station sd"),
-                'start_station_name': row.get("start station same", "unknown"),
+                'start_station_id': row.get("start station id"),
+                'start_station_name': row.get("start station name", "unknown"),
                 'start_station_lat': row.get("start station latitude"),
                 'start_station_lon': row.get("start station longitude"),
                 'end_station_id': row.get("end station id"),
@@ -347,10 +1017,10 @@ class CityBikeDataImport:
                 'end_station_lat': row.get("end station latitude"),
                 'end_station_lon': row.get("end station longitude"),
                 'bike_id': row.get("bikeid"),
-                'rider_birth_year': int(float(str(row.get("birth year")))),
-                'rider_gender': row.get("gender"),
-                'started_at': self.convert_date(row["starttime"]),
-                'ended_at': self.convert_date(row["stoptime"]),
+                'rider_birth_year': self.convert_int(row.get("birth year")),
+                'rider_gender': self.convert_int(row.get("gender")),
+                'started_at': self.convert_date(row["starttime"]) if parse_dates else row["starttime"],
+                'ended_at': self.convert_date(row["stoptime"]) if parse_dates else row["stoptime"],
                 'bike_type': row.get("bike_type", 'unknown'),  # bike_type is not available in old format
                 'rider_member_or_casual': row.get("usertype", 'unknown')  # member_type is not available in old format
             }
@@ -359,8 +1029,8 @@ class CityBikeDataImport:
             row_data = {
                 'ride_id': row.get("ride_id"),
                 'bike_type': row.get("rideable_type"),
-                'started_at': self.convert_date(row["started_at"]),
-                'ended_at': self.convert_date(row["ended_at"]),
+                'started_at': self.convert_date(row["started_at"]) if parse_dates else row["started_at"],
+                'ended_at': self.convert_date(row["ended_at"]) if parse_dates else row["ended_at"],
                 'start_station_id': row.get("start_station_id"),
                 'start_station_name': row.get("start_station_name"),
                 'end_station_id': row.get("end_station_id"),
@@ -379,82 +1049,481 @@ class CityBikeDataImport:
         return row_data
     
 
-    def normalize_rows(self, header, rows, file_path):
-        #4.2 Normalize the data in the rows
-        logger.debug(f"Normalizing {len(rows)} records from {file_path}")
+    def create_processed_file_record(self, file_name):
+        """
+        Creates (or updates) the ProcessedFile record the rides of a file are attached to.
+        If the file already has rides, from an older version of it or an interrupted load, the new rides
+        are staged instead and the record keeps describing the old ones until swap_staged_rides.
+
+        Returns:
+        - tuple: The ProcessingFile record for the file and its ProcessedFile record.
+        """
+        processing_file = ProcessingFile.objects.get(file_name=file_name)
+        self.rides_inserted = 0
+        self.insert_seconds = 0.0
+
+        processed_file = ProcessedFile.objects.filter(file_name=file_name).first()
+        if processed_file is not None and processed_file.rides.exists():
+            logger.info(f"Reloading {file_name}, its rides are staged and replace the loaded ones at the end")
+            StagedRide.objects.filter(source_file=processed_file).delete()  # Left over by an interrupted reload
+            self.ride_model = StagedRide
+            return processing_file, processed_file
+        self.ride_model = Ride
 
-        processing_file = ProcessingFile.objects.get(file_name=os.path.basename(file_path))
-        
         # Create a processed file record to be a foreign key for the rides
         processed_file, created_processed_file = ProcessedFile.objects.update_or_create(
             file_name=processing_file.file_name,
             defaults={
                 'file_path': processing_file.file_path.replace("Processing", "Processed"),
+                'parent_zip_name': processing_file.parent_zip_name,
                 'parent_zip_last_modified': processing_file.parent_zip_last_modified,
                 'size': processing_file.size,
-                'number_of_rows': len(rows)
+                'number_of_rows': 0,
+                'completed': False,
             }
         )
-        
+
         logger.info(f"Created or Updated ProcessedFile record {processed_file}")
+        return processing_file, processed_file
+
+    def preload_dimensions(self):
+        """
+        Caches every Station and the ids of every Bike already in the database so that rows can be
+        resolved to their dimensions without a query per row.
+        """
+        self.station_resolver = StationResolver.from_db()
+        self.known_bike_ids = set(Bike.objects.values_list('bike_id', flat=True))
+        logger.debug(
+            f"Cached {len(self.station_resolver.used_ids)} stations and {len(self.known_bike_ids)} bikes")
+
+    def resolve_station(self, parsed_row, prefix, new_stations):
+        """
+        Resolves the start or end station of a parsed row to a Station id by its code, see StationResolver.
+
+        Parameters:
+        - parsed_row (dict): The row as returned by parse_row.
+        - prefix (str): 'start' or 'end'.
+        - new_stations (dict): Stations seen in this chunk that are not in the db yet, keyed by id.
+          Unseen stations are added to it.
+
+        Returns:
+        - int or None: The station id, None if the row has no station code and no known station name.
+        """
+        return self.station_resolver.resolve(
+            parsed_row.get(f"{prefix}_station_id"), parsed_row.get(f"{prefix}_station_name"),
+            parsed_row.get(f"{prefix}_station_lat"), parsed_row.get(f"{prefix}_station_lon"), new_stations)
+
+    def resolve_bike(self, parsed_row, new_bikes):
+        """
+        Resolves the bike of a parsed row to a Bike id using the dimension cache.
+        Rows without a bike id are attached to the placeholder Bike of their bike type.
+
+        Parameters:
+        - parsed_row (dict): The row as returned by parse_row.
+        - new_bikes (dict): Bikes seen in this chunk that are not in the db yet, keyed by id.
+          Unseen bikes are added to it.
+
+        Returns:
+        - int: The bike id.
+        """
+        bike_type = parsed_row.get('bike_type') or 'unknown'
+        bike_type = BIKE_TYPE_MAP.get(bike_type, bike_type)
+        if bike_type not in PLACEHOLDER_BIKE_IDS:
+            bike_type = 'unknown'
+
+        try:
+            bike_id = int(float(parsed_row.get('bike_id')))
+        except (TypeError, ValueError, OverflowError):
+            bike_id = PLACEHOLDER_BIKE_IDS[bike_type]
+
+        if bike_id not in self.known_bike_ids and bike_id not in new_bikes:
+            new_bikes[bike_id] = Bike(bike_id=bike_id, bike_type=bike_type)
+        return bike_id
 
-        ride_objects = []
+    def parse_rows(self, header, rows, date_format=None):
+        """
+        Maps raw csv rows of either file format onto the fields of a ride. Does not touch the db.
+        The start and end times are parsed a whole column at a time with convert_dates.
+        A pandas DataFrame of rows is handed to the columnar parser, parse_frame.
+        """
+        if pd is not None and isinstance(rows, pd.DataFrame):
+            return self.parse_frame(rows, "tripduration" in header, date_format)
+
+        rows = list(rows)
         is_old_format = "tripduration" in header
+        if date_format is None:
+            date_format = self.detect_date_format(header, rows)
+
+        # Dyanmically map the fields based on the header
+        parsed_rows = [self.parse_row(row, is_old_format, parse_dates=False) for row in rows]
+        if logger.isEnabledFor(logging.DEBUG):
+            # A sample of the rows, picked after the loop so the loop costs nothing extra
+            for row, parsed_row in zip(rows[::ROW_LOG_SAMPLE_RATE], parsed_rows[::ROW_LOG_SAMPLE_RATE]):
+                logger.debug(f"Parsed {row} as {parsed_row}")
+
+        for column in ('started_at', 'ended_at'):
+            dates = self.convert_dates([parsed_row[column] for parsed_row in parsed_rows], date_format)
+            for parsed_row, date in zip(parsed_rows, dates):
+                parsed_row[column] = date
+        return parsed_rows
+
+    def parse_frame(self, frame, is_old_format, date_format=None):
+        """
+        Columnar counterpart of parse_rows. The format mapping is applied as column renames and
+        the type conversions of parse_row and load_rows run on whole columns.
+
+        Parameters:
+        - frame (pandas.DataFrame): A chunk of the csv read with dtype=str and no NA filtering.
+        - is_old_format (bool): Whether the file uses the old column names.
+        - date_format (str): The strptime format of the start and end times.
+
+        Returns:
+        - ParsedColumns: The parsed rows, typed, with the same keys as parse_row.
+        """
+        if is_old_format:
+            frame = frame.rename(columns=OLD_FORMAT_COLUMNS)
+            defaults = OLD_FORMAT_DEFAULTS
+        else:
+            frame = frame.rename(columns=NEW_FORMAT_COLUMNS)
+            defaults = NEW_FORMAT_DEFAULTS
+
+        def column(field):
+            if field in frame:
+                return frame[field]
+            return pd.Series(defaults.get(field), index=frame.index, dtype=object)
+
+        def to_float(series):
+            # astype(float) parses like float() does, pd.to_numeric can be off in the last digit
+            series = series.astype(str)
+            return series.where(series.str.fullmatch(NUMBER_PATTERN), np.nan).astype(float)
+
+        def to_int(series, default=None):
+            numbers = np.trunc(to_float(series))
+            numbers = numbers.where(np.isfinite(numbers)).astype('Int64').astype(object)
+            return numbers.where(numbers.notna(), default)
+
+        def to_list(series):
+            return series.tolist()
+
+        ride_ids = column('ride_id').astype(str)
+        members = column('rider_member_or_casual')
+        parsed = {
+            'ride_id': to_int(ride_ids.where(ride_ids.str.fullmatch(r'\d+'), '')),
+            'start_station_id': column('start_station_id'),  # Station codes stay text, see StationResolver
+            'start_station_name': column('start_station_name'),
+            'start_station_lat': to_float(column('start_station_lat')).fillna(0.0),
+            'start_station_lon': to_float(column('start_station_lon')).fillna(0.0),
+            'end_station_id': column('end_station_id'),
+            'end_station_name': column('end_station_name'),
+            'end_station_lat': to_float(column('end_station_lat')).fillna(0.0),
+            'end_station_lon': to_float(column('end_station_lon')).fillna(0.0),
+            'bike_id': to_int(column('bike_id')),
+            'rider_birth_year': to_int(column('rider_birth_year'), 0),  # also covers the \N birth years
+            'rider_gender': to_int(column('rider_gender'), 0),
+            'bike_type': column('bike_type'),
+            'rider_member_or_casual': members.where(members.astype(bool), 'unknown'),
+        }
+        columns = {field: to_list(values) for field, values in parsed.items()}
+        for field in ('started_at', 'ended_at'):
+            columns[field] = self.convert_dates(column(field).tolist(), date_format)
+        return ParsedColumns(columns)
+
+    def normalize_rows(self, header, rows, processed_file, date_format=None):
+        #4.2 Normalize the data in the rows
+        logger.debug(f"Normalizing {len(rows)} records from {processed_file.file_name}")
+        return self.load_rows(self.parse_rows(header, rows, date_format), processed_file)
+
+    def load_rows(self, parsed_rows, processed_file):
+        """
+        Resolves the stations and bikes of parsed rows and bulk inserts them as rides.
+
+        Parameters:
+        - parsed_rows (list of dict or ParsedColumns): The rows as returned by parse_rows.
+        - processed_file (ProcessedFile): The file the rides are attached to.
+
+        Returns:
+        - int: The number of rides inserted.
+        """
+        if self.station_resolver is None or self.known_bike_ids is None:
+            self.preload_dimensions()
+
+        new_stations = {}
+        new_bikes = {}
+        if isinstance(parsed_rows, ParsedColumns):
+            rides = self.build_rides_from_columns(parsed_rows, processed_file, new_stations, new_bikes)
+        else:
+            rides = self.build_rides(parsed_rows, processed_file, new_stations, new_bikes)
+        # Duration and straight-line distance of the whole chunk at once
+        add_ride_metrics(rides, self.station_resolver.coordinates)
+
+        # One transaction per chunk, so the chunk costs one commit rather than one per statement
+        with transaction.atomic():
+            # Write the unseen dimensions before the rides that reference them
+            if new_stations:
+                logger.debug(f"Adding {len(new_stations)} records to the Station model")
+                Station.objects.bulk_create(
+                    new_stations.values(), batch_size=self.get_batch_size(Station), ignore_conflicts=True)
+            if new_bikes:
+                logger.debug(f"Adding {len(new_bikes)} records to the Bike model")
+                Bike.objects.bulk_create(
+                    new_bikes.values(), batch_size=self.get_batch_size(Bike), ignore_conflicts=True)
+
+            # 4.3 Bulk Insert that data into the DB
+            logger.debug(f"Adding {len(rides)} records to the Ride model")
+            start_time = time.perf_counter()
+            self.insert_rides(rides)
+            insert_seconds = time.perf_counter() - start_time
+
+            # Keep the daily station rollup in step with the rides, in the same transaction.
+            # Staged rides are counted when they are swapped in
+            if self.ride_model is Ride:
+                update_station_daily_stats(rides)
+        self.known_bike_ids.update(new_bikes)
+        self.report.count('station_lookups', sum(
+            (ride['start_station_id'] is not None) + (ride['end_station_id'] is not None) for ride in rides))
+        self.report.count('station_cache_misses', len(new_stations))
+        for name, value in self.station_resolver.pop_stats().items():
+            self.report.count(name, value)
+        self.report.count('bike_lookups', len(rides))
+        self.report.count('bike_cache_misses', len(new_bikes))
+
+        self.rides_inserted += len(rides)
+        self.insert_seconds += insert_seconds
+        logger.debug(
+            f"Successfully added {len(rides)} records to the Ride model "
+            f"({self.rides_per_second(len(rides), insert_seconds)} rides/sec, {self.ride_writer} writer)")
+        return len(rides)
+
+    def build_rides(self, parsed_rows, processed_file, new_stations, new_bikes):
+        """
+        Turns parsed rows into ride dicts keyed by Ride column, resolving their stations and bikes.
+        Stations and bikes that are not in the db yet are collected in new_stations and new_bikes.
+        """
+        rides = []
+        for parsed_row in parsed_rows:
+            # Resolve the Station and Bike ids from the cache, collecting unseen ones
+            start_station_id = self.resolve_station(parsed_row, 'start', new_stations)
+            end_station_id = self.resolve_station(parsed_row, 'end', new_stations)
+            bike_id = self.resolve_bike(parsed_row, new_bikes)
+
+            # The new format's ride ids are hex strings, those rides get an id from the db
+            ride_id = parsed_row.get('ride_id')
+            if not str(ride_id).isdigit():
+                ride_id = None
+
+            # Rides stay plain dicts keyed by column until the writer turns them into rows
+            rides.append({
+                'ride_id': ride_id,
+                'started_at': parsed_row.get('started_at'),
+                'ended_at': parsed_row.get('ended_at'),
+                'start_station_id': start_station_id,
+                'end_station_id': end_station_id,
+                'bike_id': bike_id,
+                'rider_birth_year': int(parsed_row.get('rider_birth_year', 0)),
+                'rider_gender': int(parsed_row.get('rider_gender', 0)),
+                'rider_member_or_casual': parsed_row.get('rider_member_or_casual') or 'unknown',
+                'source_file_id': processed_file.file_id,
+            })
+        return rides
+
+    def build_rides_from_columns(self, parsed, processed_file, new_stations, new_bikes):
+        """
+        Columnar counterpart of build_rides. Stations and bikes are resolved once per distinct value
+        of the chunk and mapped back onto the rows, and the rides are zipped straight from the columns.
+        """
+        columns = parsed.columns
+        start_station_ids, end_station_ids = self.station_resolver.resolve_columns([
+            (columns[f"{prefix}_station_id"], columns[f"{prefix}_station_name"],
+             columns[f"{prefix}_station_lat"], columns[f"{prefix}_station_lon"])
+            for prefix in ('start', 'end')
+        ], new_stations)
+        bike_keys = list(zip(columns['bike_id'], columns['bike_type']))
+        bikes = {key: self.resolve_bike({'bike_id': key[0], 'bike_type': key[1]}, new_bikes)
+                 for key in dict.fromkeys(bike_keys)}
+
+        values = zip(
+            columns['ride_id'], columns['started_at'], columns['ended_at'], start_station_ids, end_station_ids,
+            map(bikes.__getitem__, bike_keys), columns['rider_birth_year'], columns['rider_gender'],
+            columns['rider_member_or_casual'], itertools.repeat(processed_file.file_id))
+        return [dict(zip(RIDE_KEYS, ride)) for ride in values]
+
+    def insert_rides(self, rides):
+        """
+        Inserts rides into self.ride_model with the configured writer. Both writers store identical rows.
+
+        Parameters:
+        - rides (list of dict): The rides to insert, keyed by Ride column (attname).
+        """
+        if self.ride_writer == 'raw':
+            self.insert_rides_raw(rides)
+        else:
+            model = self.ride_model
+            model.objects.bulk_create([model(**ride) for ride in rides], batch_size=self.get_batch_size(model))
+
+    def insert_rides_raw(self, rides):
+        """
+        Inserts rides through the DB-API cursor, skipping model instances and field validation.
+        Uses executemany with one prepared INSERT, or COPY FROM STDIN on PostgreSQL.
+        Rides without a ride_id are inserted without the column so the db assigns one.
+
+        load_rows already builds the integer, float and text values with the right Python types,
+        the other columns (the datetimes) go through get_db_prep_save just as bulk_create does.
+        """
+        db = connections[DEFAULT_DB_ALIAS]  # The connection proxy costs a lookup per attribute access
+        passthrough_fields = (models.IntegerField, models.FloatField, models.CharField, models.ForeignKey)
+        model = self.ride_model
+        # StagedRide has its own primary key, the rides only carry the Ride columns
+        ride_columns = {field.attname for field in Ride._meta.concrete_fields}
+        fields = {field.attname: field for field in model._meta.concrete_fields if field.attname in ride_columns}
+        with_id = [ride for ride in rides if ride['ride_id'] is not None]
+        without_id = [ride for ride in rides if ride['ride_id'] is None]
+
+        with db.cursor() as cursor:
+            columns_without_id = [column for column in fields if column != 'ride_id']
+            for group, columns in ((with_id, list(fields)), (without_id, columns_without_id)):
+                if not group:
+                    continue
+                column_fields = [fields[column] for column in columns]
+                rows = [[ride[column] for column in columns] for ride in group]
+                for index, field in enumerate(column_fields):
+                    if not isinstance(field, passthrough_fields):
+                        for row in rows:
+                            row[index] = field.get_db_prep_save(row[index], db)
+
+                table = db.ops.quote_name(model._meta.db_table)
+                column_names = ", ".join(db.ops.quote_name(field.column) for field in column_fields)
+                if db.vendor == 'postgresql':
+                    self.copy_rows(cursor, f"COPY {table} ({column_names}) FROM STDIN", rows)
+                else:
+                    placeholders = ", ".join(["%s"] * len(column_fields))
+                    cursor.executemany(f"INSERT INTO {table} ({column_names}) VALUES ({placeholders})", rows)
+
+    def copy_rows(self, cursor, copy_sql, rows):
+        """
+        Streams rows into a PostgreSQL COPY FROM STDIN, with psycopg 3 or psycopg2.
+        """
+        raw_cursor = cursor.cursor
+        if hasattr(raw_cursor, 'copy'):  # psycopg 3
+            with raw_cursor.copy(copy_sql) as copy:
+                for row in rows:
+                    copy.write_row(row)
+            return
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
         for row in rows:
-            print("raw",row)
-            # Dyanmically map the fields based on the header
-            parsed_row =  self.parse_row(row, is_old_format)
-            print("parsed", parsed_row)
-
-            # Create or get Station and Bike instances
-            if parsed_row.get("start_station_id"):
-                station_id = int(float(parsed_row.get("start_station_id")))
-            else:
-                station_id = None
-            start_station, _ = Station.objects.get_or_create(
-                
-                station_id=station_id,
-                defaults={'station_name': parsed_row.get('start_station_name'), 'lat': float(row.get('start_lat', 0)), 'lon': float(row.get('start_lng', 0))}
-            )
+            writer.writerow(['\\N' if value is None else value for value in row])
+        buffer.seek(0)
+        raw_cursor.copy_expert(f"{copy_sql} WITH (FORMAT csv, NULL '\\N')", buffer)
 
-            if parsed_row.get("end_station_id"):
-                station_id = int(float(parsed_row.get("end_station_id")))
-            else:
-                station_id = None
-
-            end_station, _ = Station.objects.get_or_create(
-                station_id=station_id,
-                defaults={'station_name': parsed_row.get('end_station_name'), 'lat': float(row.get('end_lat', 0)), 'lon': float(row.get('end_lng', 0))}
-            )
-
-            bike, _ = Bike.objects.get_or_create(
-                bike_id=parsed_row.get('bike_id'),
-                bike_type=parsed_row.get('bike_type')
-            )
-
-            ride = Ride(
-                ride_id=row.get('ride_id'),
-                started_at=parsed_row.get('started_at'),
-                ended_at=parsed_row.get('ended_at'),
-                start_station=start_station,
-                end_station=end_station,
-                bike=bike,
-                rider_birth_year=int(parsed_row.get('rider_birth_year', 0)),
-                rider_gender=int(parsed_row.get('rider_gender', 0)),
-                rider_member_or_casual=parsed_row.get('user_type', 'unknown'),
-                source_file=processed_file
-            )
-            ride_objects.append(ride)
-            
+    def rides_per_second(self, rides, seconds):
+        return round(rides / seconds) if seconds else 0
 
-        logger.debug(f"Adding {len(ride_objects)} records to the Ride model")
-        Ride.objects.bulk_create(ride_objects, batch_size=998)
-        logger.debug(f"Successfully added {len(ride_objects)} records to the Ride model")
-        self.move_file_from_processing_to_processed(os.path.basename(file_path))
+    def finish_processed_file(self, processing_file, processed_file, number_of_rows):
+        """
+        Records the final row count of a fully loaded file, moves it to the processed directory
+        and deletes its ProcessingFile record.
+        """
+        reloaded = self.ride_model is StagedRide
+        if reloaded:
+            self.swap_staged_rides(processing_file, processed_file, number_of_rows)
+        else:
+            processed_file.number_of_rows = number_of_rows
+            processed_file.completed = True
+            # Bumps the API dataset version
+            processed_file.save(update_fields=['number_of_rows', 'completed', 'processed_at'])
+        self.report.files.setdefault(processed_file.file_name, {}).update({
+            'rows_parsed': number_of_rows,
+            'rows_inserted': self.rides_inserted,
+            'insert_seconds': round(self.insert_seconds, 3),
+            'rides_per_second': self.rides_per_second(self.rides_inserted, self.insert_seconds),
+            'reloaded': reloaded,
+        })
+        self.report.count('rows_parsed', number_of_rows)
+        self.report.count('rows_inserted', self.rides_inserted)
+        if self.archive:
+            self.archive_file(processed_file)
+        if self.station_index:
+            self.index_file(processed_file)
+        logger.info(
+            f"Loaded {number_of_rows} records from {processed_file.file_name}, inserted at "
+            f"{self.rides_per_second(self.rides_inserted, self.insert_seconds)} rides/sec "
+            f"with the {self.ride_writer} writer")
+
+        if ZIP_MEMBER_SEPARATOR not in processing_file.file_path:
+            self.move_file_from_processing_to_processed(processing_file.file_name)
         logger.debug(f"Deleting {processing_file.file_name} from the ProcessingFile model")
         processing_file.delete()
         return
     
+    def archive_file(self, processed_file):
+        """
+        Writes the rides of a loaded file to the Parquet archive. A failure is logged and does not undo the load,
+        rerun the archive_rides command for the file.
+        """
+        start_time = time.perf_counter()
+        try:
+            rides = archive_processed_file(processed_file, ARCHIVE_DIR)
+        except Exception as e:
+            logger.error(f"Failed to archive {processed_file.file_name}, run manage.py archive_rides for it. Error: {e}")
+            return
+        self.report.files.setdefault(processed_file.file_name, {})['archive_seconds'] = round(
+            time.perf_counter() - start_time, 3)
+        logger.info(f"Archived {rides} rides of {processed_file.file_name} to {ARCHIVE_DIR}")
+
+    def index_file(self, processed_file):
+        """
+        Compiles the station index segment of a loaded file. A failure is logged and does not undo the load,
+        the build_station_index command catches the index up.
+        """
+        start_time = time.perf_counter()
+        try:
+            rides = build_segment(processed_file, STATION_INDEX_DIR)
+        except Exception as e:
+            logger.error(f"Failed to index {processed_file.file_name}, run manage.py build_station_index. Error: {e}")
+            return
+        self.report.files.setdefault(processed_file.file_name, {})['index_seconds'] = round(
+            time.perf_counter() - start_time, 3)
+        logger.info(f"Indexed {rides} departures of {processed_file.file_name} in {STATION_INDEX_DIR}")
+
+    def swap_staged_rides(self, processing_file, processed_file, number_of_rows):
+        """
+        Replaces the rides of a reloaded file with its staged rides in one transaction, so readers see
+        either the old or the new version of the file. StationDailyStats is moved by the difference
+        between the two versions, and the ProcessedFile record is updated to describe the new one.
+        """
+        db = connections[DEFAULT_DB_ALIAS]
+        old_rides = Ride.objects.filter(source_file=processed_file)
+        staged_rides = StagedRide.objects.filter(source_file=processed_file)
+        columns = [field.column for field in Ride._meta.concrete_fields]
+        start_time = time.perf_counter()
+        with transaction.atomic():
+            replace_station_day_counts(old_rides, staged_rides)
+            old_rides._raw_delete(old_rides.db)  # Nothing references a ride, so skip the delete collector
+
+            with db.cursor() as cursor:
+                # Staged rides without a ride id from the file get one from Ride, in file order
+                for with_id, group_columns in ((True, columns), (False, [c for c in columns if c != 'ride_id'])):
+                    column_names = ", ".join(db.ops.quote_name(column) for column in group_columns)
+                    cursor.execute(
+                        f"INSERT INTO {db.ops.quote_name(Ride._meta.db_table)} ({column_names}) "
+                        f"SELECT {column_names} FROM {db.ops.quote_name(StagedRide._meta.db_table)} "
+                        f"WHERE source_file_id = %s AND ride_id IS {'NOT ' if with_id else ''}NULL "
+                        f"ORDER BY staged_ride_id",
+                        [processed_file.file_id])
+            staged_rides._raw_delete(staged_rides.db)
+
+            processed_file.file_path = processing_file.file_path.replace("Processing", "Processed")
+            processed_file.parent_zip_name = processing_file.parent_zip_name
+            processed_file.parent_zip_last_modified = processing_file.parent_zip_last_modified
+            processed_file.size = processing_file.size
+            processed_file.number_of_rows = number_of_rows
+            processed_file.completed = True
+            processed_file.save()  # Bumps the API dataset version
+        self.ride_model = Ride
+        logger.info(f"Swapped the reloaded rides of {processed_file.file_name} in, "
+                    f"in {time.perf_counter() - start_time:.2f} seconds")
+
     def move_file_from_processing_to_processed(self,file_name):
         processing_file = os.path.join(PROCESSING_DIR, file_name)
         processed_file = os.path.join(PROCESSED_DIR, file_name)
@@ -465,10 +1534,77 @@ class CityBikeDataImport:
             logger.error(f"Failed to move {file_name} from processing to processed directory")
             logger.error(e)
             return
-    
-    
-    
+
+
+_worker_import = None
+
+
+def configure_logging(filemode='a'):
+    """
+    Logs to LOG_FILE. Only the script run truncates it (filemode='w'), at start up. The parse workers append,
+    under the spawn start method they import this module again and would truncate the log of the run.
+    Does nothing when logging is configured already, as in workers forked from the script.
+    """
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s - %(levelname)s - %(message)s',
+                        filename=LOG_FILE,
+                        filemode=filemode)
+
+
+def init_parse_worker():
+    """
+    Runs once in every worker process of process_files_in_parallel.
+    """
+    global _worker_import
+    configure_logging()
+    _worker_import = CityBikeDataImport()
+
+
+def parse_file_range(file_path, header, start, end, date_format=None, columnar=False):
+    """
+    Parses the csv rows between two byte offsets of a file.
+    Runs in a worker process and does not touch the db.
+
+    Returns:
+    - list of dict or ParsedColumns: The rows as returned by CityBikeDataImport.parse_rows.
+    """
+    with open(file_path, mode='rb') as file:
+        file.seek(start)
+        data = file.read(end - start)
+    if columnar:
+        if not data:
+            return []
+        frame = pd.read_csv(io.BytesIO(data), names=header, header=None, dtype=str, na_filter=False)
+        return _worker_import.parse_rows(header, frame, date_format)
+    reader = csv.DictReader(io.StringIO(data.decode('utf-8'), newline=''), fieldnames=header)
+    return _worker_import.parse_rows(header, reader, date_format)
+
 
 if __name__ == "__main__":
-    Import = CityBikeDataImport()
+    arg_parser = argparse.ArgumentParser(description="Download and load CityBike trip data.")
+    arg_parser.add_argument('--workers', type=int, default=1,
+                            help="Number of processes parsing files in step 4.0 (default: 1)")
+    arg_parser.add_argument('--columnar', action='store_true',
+                            help="Parse csv chunks as pandas columns instead of one dict per row (needs pandas)")
+    arg_parser.add_argument('--bulk-load', action='store_true',
+                            help="Tune the SQLite connection for a large import during step 4.0")
+    arg_parser.add_argument('--ride-writer', choices=['orm', 'raw'], default='orm',
+                            help="Insert rides with bulk_create (orm) or executemany/COPY (raw)")
+    arg_parser.add_argument('--stream-from-zip', action='store_true',
+                            help="Read csv files straight out of the downloaded zip files instead of extracting them")
+    arg_parser.add_argument('--report', metavar='PATH',
+                            help="Write the timings and counters of the run to this JSON file")
+    arg_parser.add_argument('--profile-queries', action='store_true',
+                            help="Add the slowest statements of step 4.0 and their query plans to the run report")
+    arg_parser.add_argument('--archive', action='store_true',
+                            help="Also write the loaded rides to the Parquet archive in ARCHIVE_DIR (needs pyarrow)")
+    arg_parser.add_argument('--station-index', action='store_true',
+                            help="Also compile the station index in STATION_INDEX_DIR (needs numpy)")
+    args = arg_parser.parse_args()
+
+    configure_logging(filemode='w')
+    Import = CityBikeDataImport(workers=args.workers, columnar=args.columnar, bulk_load=args.bulk_load,
+                                ride_writer=args.ride_writer, stream_from_zip=args.stream_from_zip, report_path=args.report,
+                                profile_queries=args.profile_queries, archive=args.archive,
+                                station_index=args.station_index)
     Import.execute()
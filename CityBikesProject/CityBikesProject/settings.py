@@ -42,6 +42,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'CityBikeApp.profiling.QueryProfilerMiddleware',  # Only active when API_PROFILE_QUERIES is on
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -132,3 +133,10 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Cache (an alias from CACHES) the API views share their responses through, None keeps a bounded LRU per process
+API_CACHE_ALIAS = None
+API_CACHE_LRU_SIZE = 128
+
+# Count and time the queries of every API request, see CityBikeApp.profiling.QueryProfilerMiddleware
+API_PROFILE_QUERIES = False